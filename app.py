@@ -8,49 +8,120 @@ import pandas as pd
 
 import prototype as proto
 
+proto.configure_logging()
 
-def step1_clean_and_prepare_from_upload(pcs: pd.DataFrame, inv: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+def step1_clean_and_prepare_from_upload(pcs: pd.DataFrame, inv: pd.DataFrame,
+                                        lean: bool = proto.LEAN_FRAME,
+                                        period: proto.ReportingPeriod | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     Replicates prototype.step1_read_excel_data cleaning for uploaded DataFrames.
-    Applies: trimming/uppercase, date parsing, column renames, Q2 2025 filter, and inventory unit cleanup.
+    Applies: reporting window filter (first, before any cleanup), trimming/uppercase, date parsing,
+    column renames, and inventory unit cleanup.
+    With lean=True the string columns become categoricals (prototype.to_lean_frame).
     """
-    # Data cleanup and standardization (following prototype Step 1.2)
-    pcs = pcs.copy()
+    if period is None:
+        period = proto.parse_period(proto.REPORTING_PERIOD)
+
+    # Reporting period filter pushed down ahead of cleanup (matches prototype behavior)
     inv = inv.copy()
+    if "PU Date F" in pcs.columns:
+        initial_row_count = len(pcs)
+        pcs = proto.apply_period_filter(pcs, period)
+        st.info(f"{period.label} date filter applied: {initial_row_count} → {len(pcs)} rows")
+    else:
+        pcs = pcs.copy()
 
+    # Data cleanup and standardization (following prototype Step 1.2)
     # Normalize core columns if present
-    for col in ["Truck", "Trailer", "Ship City", "Cons City"]:
-        if col in pcs.columns:
-            pcs[col] = pcs[col].astype(str).str.strip()
+    if lean:
+        pcs, inv = proto.to_lean_frame(pcs, inv)
+    else:
+        for col in ["Truck", "Trailer", "Ship City", "Cons City"]:
+            if col in pcs.columns:
+                pcs[col] = pcs[col].astype(str).str.strip()
 
-    for col in ["Ship St", "Cons St"]:
-        if col in pcs.columns:
-            pcs[col] = pcs[col].astype(str).str.upper().str.strip()
+        for col in ["Ship St", "Cons St"]:
+            if col in pcs.columns:
+                pcs[col] = pcs[col].astype(str).str.upper().str.strip()
 
     # Date processing and rename to match prototype
-    if "PU Date F" in pcs.columns:
-        pcs["PU Date F"] = pd.to_datetime(pcs["PU Date F"], errors="coerce")
     if "Del Date F" in pcs.columns:
         pcs["Del Date F"] = pd.to_datetime(pcs["Del Date F"], errors="coerce")
 
     pcs = pcs.rename(columns={"PU Date F": "PU", "Del Date F": "DEL"})
 
-    # Q2 2025 filter (April 1 - June 30, 2025) to match prototype behavior
-    if "PU" in pcs.columns:
-        initial_row_count = len(pcs)
-        pcs = pcs[(pcs["PU"] >= "2025-04-01") & (pcs["PU"] <= "2025-06-30")]
-        st.info(f"Q2 2025 date filter applied: {initial_row_count} → {len(pcs)} rows")
-
     # Inventory cleanup
-    if "Unit" in inv.columns:
+    if "Unit" in inv.columns and not lean:
         inv["Unit"] = inv["Unit"].astype(str).str.strip()
 
     return pcs, inv
 
 
-def run_pipeline(pcs_df: pd.DataFrame, inv_df: pd.DataFrame, api_key: str, max_concurrent: int = 10) -> pd.DataFrame:
+def plan_pipeline(pcs_df: pd.DataFrame, inv_df: pd.DataFrame, max_concurrent: int = 10,
+                  routing_backend: str = "here", lean: bool = proto.LEAN_FRAME,
+                  period: proto.ReportingPeriod | None = None) -> dict:
+    """Steps 1–3 as in run_pipeline, then prototype.plan_step5 (no network)"""
+    pcs_clean, inv_clean = step1_clean_and_prepare_from_upload(pcs_df, inv_df, lean=lean, period=period)
+    pcs_with_refs = proto.step3_detect_round_trips(proto.step2_filter_fleet_data(pcs_clean, inv_clean))
+    if proto.VIRTUAL_RETURNS:
+        pcs_with_refs = proto.step4_add_virtual_returns(pcs_with_refs)
+    return proto.plan_step5(pcs_with_refs, routing_backend, max_concurrent=max_concurrent)
+
+
+def show_plan(plan: dict):
+    """Run preview: HERE calls per endpoint, cache hits, quota share and estimated time"""
+    cols = st.columns(4)
+    cols[0].metric("Distinct routes", plan["routes"], help=f"{plan['loads']} loads")
+    cols[1].metric("Locations to geocode", plan["locations_to_geocode"],
+                   help=f"{plan['locations_cached']} of {plan['locations']} already in the geocoding cache")
+    cols[2].metric("HERE calls", plan["here_calls_total"],
+                   help=None if plan["quota_pct"] is None else f"{plan['quota_pct']:.1f}% of the monthly quota")
+    cols[3].metric("Estimated time", f"{plan['estimated_seconds'] / 60:.1f} min")
+    st.table(pd.DataFrame([
+        {
+            "Endpoint": endpoint,
+            "Expected calls": calls,
+            "Mean latency (s)": round(plan["latency"][endpoint]["mean_s"], 2),
+            "Latency samples": plan["latency"][endpoint]["samples"],
+        }
+        for endpoint, calls in plan["here_calls"].items()
+    ]))
+    if plan["routes_archived"]:
+        st.caption(f"{plan['routes_archived']} of {plan['routes']} routes are already in the route archive.")
+    if plan["rejected_loads"]:
+        st.caption("Not routed (pre-flight gate): "
+                   + ", ".join(f"{count} {status}" for status, count in plan["rejected_loads"].items()) + ".")
+
+
+async def stream_step5(pcs: pd.DataFrame, states_gdf, api_key: str, max_concurrent: int,
+                       backend: proto.RoutingBackend) -> pd.DataFrame:
+    """
+    Consume prototype.step5_stream: progress bar and the latest finished rows while routing runs;
+    each batch also updates the IFTA rollups
+    """
+    progress = st.progress(0.0, text="Routing...")
+    latest = st.empty()
+    batches = []
+    async for batch in proto.step5_stream(pcs, states_gdf, api_key, max_concurrent=max_concurrent, backend=backend):
+        proto.update_ifta_rollups(proto.replaceable_rows(batch.frame, backend.name))
+        batches.append(batch)
+        progress.progress(
+            batch.loads_done / max(batch.loads_total, 1),
+            text=f"{batch.loads_done}/{batch.loads_total} loads routed – {batch.failed_loads} failed – "
+                 f"ETA {batch.eta_s / 60:.1f} min",
+        )
+        latest.dataframe(batch.frame, use_container_width=True)
+    latest.empty()
+    progress.empty()
+    return proto.collect_step5_batches(pcs, batches)
+
+
+def run_pipeline(pcs_df: pd.DataFrame, inv_df: pd.DataFrame, api_key: str, max_concurrent: int = 10,
+                 routing_backend: str = "here", lean: bool = proto.LEAN_FRAME,
+                 period: proto.ReportingPeriod | None = None,
+                 boundary_level: str = proto.STATE_BOUNDARY_LEVEL) -> pd.DataFrame:
     # Step 1 equivalent: clean uploaded data
-    pcs_clean, inv_clean = step1_clean_and_prepare_from_upload(pcs_df, inv_df)
+    pcs_clean, inv_clean = step1_clean_and_prepare_from_upload(pcs_df, inv_df, lean=lean, period=period)
 
     # Step 2
     pcs_filtered = proto.step2_filter_fleet_data(pcs_clean, inv_clean)
@@ -58,15 +129,17 @@ def run_pipeline(pcs_df: pd.DataFrame, inv_df: pd.DataFrame, api_key: str, max_c
     # Step 3
     pcs_with_refs = proto.step3_detect_round_trips(pcs_filtered)
 
+    # Step 4 (only when VIRTUAL_RETURNS is set)
+    if proto.VIRTUAL_RETURNS:
+        pcs_with_refs = proto.step4_add_virtual_returns(pcs_with_refs)
+
     # Step 5 prerequisites
-    states_gdf = proto.load_state_boundaries()
+    states_gdf = proto.load_state_boundaries(boundary_level)
+    backend = proto.make_routing_backend(routing_backend, api_key)
 
-    # Step 5 concurrent mileage
-    result_df = asyncio.run(
-        proto.step5_calculate_mileage_concurrent(
-            pcs_with_refs, states_gdf, api_key, max_concurrent=max_concurrent
-        )
-    )
+    # Step 5 concurrent mileage, streamed so progress and finished rows show while routing runs
+    result_df = asyncio.run(stream_step5(pcs_with_refs, states_gdf, api_key, max_concurrent, backend))
+    proto.store_results(result_df, pcs_with_refs)
 
     return result_df
 
@@ -81,7 +154,33 @@ st.markdown(
 
 with st.sidebar:
     api_key_input = st.text_input("HERE API Key", type="password", help="Required for routing (HERE v8)")
+    period_input = st.text_input(
+        "Reporting period", value=proto.REPORTING_PERIOD,
+        help="Quarter (2025Q2), year (2025) or date range (2025-04-01:2025-06-30), filtered on PU date",
+    )
     max_concurrent = st.number_input("Max concurrent requests", min_value=1, max_value=30, value=10, step=1)
+    routing_backend = st.selectbox(
+        "Routing backend", options=["here", "local"],
+        index=0 if proto.ROUTING_BACKEND == "here" else 1,
+        format_func=lambda name: {"here": "HERE API", "local": "Local road graph"}[name],
+        help="Local road graph needs `road_router.py build` to have been run first",
+    )
+    boundary_levels = proto.available_boundary_levels()
+    boundary_level = st.selectbox(
+        "State boundaries", options=boundary_levels,
+        index=boundary_levels.index(proto.STATE_BOUNDARY_LEVEL) if proto.STATE_BOUNDARY_LEVEL in boundary_levels else 0,
+        format_func=lambda level: "Full resolution" if level == "full" else f"Simplified ({level} m)",
+        help="Simplified levels are built with `prototype.py boundaries` (see boundaries/accuracy_report.csv)",
+    )
+    lean_frame = st.checkbox(
+        "Lean memory mode", value=proto.LEAN_FRAME,
+        help="Keep truck/trailer/city/state columns as categoricals (large multi-year exports)",
+    )
+    force_recompute = st.checkbox(
+        "Force recompute", value=False,
+        help="Ignore stored results for an identical workbook and re-run Steps 1–5",
+    )
+    preview_button = st.button("Preview plan", help="Steps 1–3 only: expected HERE calls and run time, nothing is sent")
     run_button = st.button("Run Calculation", type="primary")
 
 uploaded_file = st.file_uploader("Excel file (.xlsx)", type=["xlsx"]) 
@@ -89,11 +188,54 @@ uploaded_file = st.file_uploader("Excel file (.xlsx)", type=["xlsx"])
 expected_pcs_sheet = "Export Research"
 expected_inv_sheet = "Inventory details"
 
+if preview_button:
+    if not uploaded_file:
+        st.error("Please upload an Excel file.")
+        st.stop()
+
+    try:
+        period = proto.parse_period(period_input)
+    except ValueError as e:
+        st.error(str(e))
+        st.stop()
+
+    cache_key = proto.result_cache_key(
+        uploaded_file.getvalue(),
+        proto.pipeline_config(period=period, routing_backend=routing_backend, state_boundaries=boundary_level),
+    )
+    if not force_recompute and proto.load_cached_results(cache_key) is not None:
+        st.info("Identical workbook already processed with the same settings – a run would serve stored "
+                "results with no HERE calls.")
+    else:
+        try:
+            with st.spinner("Planning (Steps 1–3, no HERE calls)..."):
+                pcs_df = pd.read_excel(uploaded_file, sheet_name=expected_pcs_sheet, keep_default_na=False)
+                inv_df = pd.read_excel(uploaded_file, sheet_name=expected_inv_sheet, usecols=["Unit", "Company"])
+                plan = plan_pipeline(pcs_df, inv_df, max_concurrent=max_concurrent,
+                                     routing_backend=routing_backend, lean=lean_frame, period=period)
+            st.subheader("Run plan")
+            show_plan(plan)
+        except Exception as e:
+            st.exception(e)
+
 if run_button:
     if not uploaded_file:
         st.error("Please upload an Excel file.")
         st.stop()
 
+    try:
+        period = proto.parse_period(period_input)
+    except ValueError as e:
+        st.error(str(e))
+        st.stop()
+
+    # Identical workbook + same pipeline config → serve stored results without re-running
+    cache_key = proto.result_cache_key(
+        uploaded_file.getvalue(),
+        proto.pipeline_config(period=period, routing_backend=routing_backend, state_boundaries=boundary_level),
+    )
+    cached_df = None if force_recompute else proto.load_cached_results(cache_key)
+
     # Determine API key
     api_key = None
     if api_key_input:
@@ -105,22 +247,39 @@ if run_button:
         except Exception:
             api_key = None
 
-    if not api_key:
+    if not api_key and proto.HERE_CASSETTE == "replay":
+        api_key = "replay"  # HERE requests are answered from the recorded cassette
+
+    if not api_key and cached_df is None and routing_backend == "here":
         st.error("HERE API key is required (enter in sidebar or configure `secrets.toml`).")
         st.stop()
 
     try:
-        with st.spinner("Reading Excel sheets..."):
-            # Read the two required sheets
-            pcs_df = pd.read_excel(uploaded_file, sheet_name=expected_pcs_sheet, keep_default_na=False)
-            inv_df = pd.read_excel(uploaded_file, sheet_name=expected_inv_sheet, usecols=["Unit", "Company"])
-
-        st.success(
-            f"Loaded {len(pcs_df)} rows from `{expected_pcs_sheet}` and {len(inv_df)} rows from `{expected_inv_sheet}`."
-        )
-
-        with st.spinner("Running pipeline (Steps 1–5)... this may take several minutes"):
-            result_df = run_pipeline(pcs_df, inv_df, api_key, max_concurrent=max_concurrent)
+        if cached_df is not None:
+            result_df = cached_df
+            st.info("Identical workbook already processed with the same settings – showing stored results. "
+                    "Tick **Force recompute** in the sidebar to re-run.")
+        else:
+            with st.spinner("Reading Excel sheets..."):
+                # Read the two required sheets
+                pcs_df = pd.read_excel(uploaded_file, sheet_name=expected_pcs_sheet, keep_default_na=False)
+                inv_df = pd.read_excel(uploaded_file, sheet_name=expected_inv_sheet, usecols=["Unit", "Company"])
+
+            st.success(
+                f"Loaded {len(pcs_df)} rows from `{expected_pcs_sheet}` and {len(inv_df)} rows from `{expected_inv_sheet}`."
+            )
+
+            with st.spinner("Running pipeline (Steps 1–5)... this may take several minutes"):
+                result_df = run_pipeline(
+                    pcs_df, inv_df, api_key, max_concurrent=max_concurrent,
+                    routing_backend=routing_backend, lean=lean_frame, period=period,
+                    boundary_level=boundary_level,
+                )
+
+            if result_df is not None and not result_df.empty:
+                if proto.save_cached_results(cache_key, result_df) is None:
+                    st.info("Result not stored for re-uploads: it contains estimated or failed (GEOCODE_ERR) rows, "
+                            "so the next run of this workbook routes them again.")
 
         if result_df is None or result_df.empty:
             st.warning("No results produced.")
@@ -134,7 +293,7 @@ if run_button:
         st.download_button(
             label="Download CSV",
             data=csv_bytes,
-            file_name="state_miles_results.csv",
+            file_name=f"state_miles_{period.label}.csv",
             mime="text/csv",
         )
 
@@ -150,6 +309,7 @@ if run_button:
             "Del Date F",
             "State",
             "Miles",
+            "Status",
         ]
         formatted_df = result_df.copy()
         # Ensure date formatting
@@ -158,6 +318,12 @@ if run_button:
         if "Del Date F" in formatted_df.columns:
             formatted_df["Del Date F"] = pd.to_datetime(formatted_df["Del Date F"], errors="coerce").dt.strftime("%m/%d/%Y")
 
+        # Miles shows the error status (GEOCODE_ERR, pre-flight rejections) on failed loads in the export (feedback.md section 5)
+        if "Status" in formatted_df.columns:
+            formatted_df["Miles"] = formatted_df["Miles"].astype(object).where(
+                ~formatted_df["Status"].isin(proto.ERROR_STATUSES), formatted_df["Status"].astype(object)
+            )
+
         formatted_df = formatted_df[[c for c in output_columns if c in formatted_df.columns]]
         excel_buf = io.BytesIO()
         with pd.ExcelWriter(excel_buf, engine="openpyxl") as writer:
@@ -165,10 +331,16 @@ if run_button:
         st.download_button(
             label="Download Excel (formatted)",
             data=excel_buf.getvalue(),
-            file_name="state_miles_results.xlsx",
+            file_name=f"state_miles_{period.label}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
 
+        rollups = proto.get_ifta_rollups()
+        if rollups is not None:
+            st.subheader(f"IFTA totals by state – {period.label}")
+            st.caption("From the IFTA rollups: every workbook processed for this period, latest run of each load.")
+            st.dataframe(rollups.totals(period, by=["state"]), use_container_width=True)
+
         st.success("Done.")
 
     except Exception as e:
@@ -4,28 +4,42 @@ IFTA PCS Trips Processing System - Complete Prototype
 Based on plan.md requirements with phases 1-6 implementation
 """
 
+from __future__ import annotations
+
 import os
 import sys
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import TYPE_CHECKING, Dict, List, Tuple, Optional
 import warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
 warnings.filterwarnings('ignore', message='invalid value encountered in intersection')  # Suppress shapely geometric warnings
 
 import pandas as pd
 import numpy as np
-import requests
-import polyline
-import shapely.geometry as geom
-import geopandas as gpd
-import toml
-import aiohttp
 import asyncio
 from datetime import datetime
 import logging
 import math
 import json
 import time
+import functools
+import re
+import contextlib
+import contextvars
+import socket
+import glob
+import hashlib
+import multiprocessing
+import pickle
+import sqlite3
+import statistics
+import subprocess
+import traceback
+import zlib
+
+if TYPE_CHECKING:  # Annotations only; the geo and HTTP stacks load lazily where they are used
+    import aiohttp
+    import geopandas as gpd
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Configuration & Constants
@@ -39,14 +53,78 @@ STATE_SHP = BASE_DIR / "cb_2024_us_state_500k.shp"
 OUTPUT_DIR = BASE_DIR / "output"
 DEBUG_DIR = BASE_DIR / "debug"  # Directory for phase-by-phase CSV outputs
 SECRETS_FILE = BASE_DIR / "secrets.toml"
+RESULT_CACHE_DIR = BASE_DIR / "cache" / "results"  # Stored step 5 results keyed by workbook hash + config
+ROAD_GRAPH_DIR = BASE_DIR / "road_graph"  # Preprocessed road network for the local router (road_router.py build)
+ROUTING_BACKEND = os.environ.get("ROUTING_BACKEND", "here")  # "here" (HERE API) or "local" (road graph)
+CIRCUITY_STATS_FILE = BASE_DIR / "cache" / "circuity_stats.sqlite"  # Road/geodesic distance ratios learned from successful routes
+LEGACY_CIRCUITY_STATS_FILE = BASE_DIR / "circuity_stats.json"  # Pre-SQLite samples, imported once into CIRCUITY_STATS_FILE
+VIRTUAL_RETURNS = os.environ.get("VIRTUAL_RETURNS", "0") == "1"  # Step 4: empty CA return legs for open AZ/NV trips
+VIRTUAL_RETURN_CITY = "SAN BERNARDINO"  # Virtual return destination (CA yard)
+VIRTUAL_RETURN_WINDOW_DAYS = 7  # A CA delivery picked up within this many days closes the trip instead
+LEAN_FRAME = os.environ.get("LEAN_FRAME", "0") == "1"  # Categorical string columns through Steps 1-3 (multi-year exports)
+HERE_MAX_RPS = float(os.environ.get("HERE_MAX_RPS", "20"))  # Global HERE request budget (geocode + routing) per second
+STEP5_WORKERS = int(os.environ.get("STEP5_WORKERS", "1"))  # >1: sharded Step 5 across worker processes
+SHARD_QUEUE_DIR = BASE_DIR / "cache" / "shards"  # SQLite work queues for sharded Step 5
+STATE_RASTER_DIR = BASE_DIR / "state_raster"  # Memory-mapped point-to-state grid (prototype.py build-raster)
+STATE_RASTER_RESOLUTION_M = float(os.environ.get("STATE_RASTER_RESOLUTION_M", "500"))  # Cell size in EPSG:5070 meters
+BOUNDARY_DIR = BASE_DIR / "boundaries"  # Topology-preserving simplified state polygons (prototype.py boundaries)
+STATE_BOUNDARY_LEVEL = os.environ.get("STATE_BOUNDARY_LEVEL", "full")  # "full" (STATE_SHP) or a built tolerance in meters, e.g. "200"
+BOUNDARY_TOLERANCES_M = (50, 200, 1000)  # Levels built by default
+BOUNDARY_REPORT_ROUTES = 500  # Archived routes in the simplification accuracy report
+ROUTE_SIMPLIFY_TOLERANCE_M = float(os.environ.get("ROUTE_SIMPLIFY_TOLERANCE_M", "0"))  # Douglas-Peucker tolerance before state attribution; 0 = off
+ROUTE_SIMPLIFY_MAX_TOLERANCE_M = 100.0  # Larger tolerances are capped (simplified runs must stay clear of borders)
+ROUTE_SIMPLIFY_CHUNK = 32  # Route vertices per border-proximity test
+ROUTE_ARCHIVE_FILE = BASE_DIR / "cache" / "route_archive.sqlite"  # Compressed HERE route geometry (reattribute mode)
+ROUTE_ARCHIVE = os.environ.get("ROUTE_ARCHIVE", "1") == "1"  # Archive every HERE route polyline
+IFTA_ROLLUP_FILE = BASE_DIR / "cache" / "ifta_rollups.sqlite"  # Miles by company/truck/state/month, updated as Step 5 streams
+IFTA_ROLLUPS = os.environ.get("IFTA_ROLLUPS", "1") == "1"  # Maintain the IFTA rollups
+RESULTS_STORE_DIR = OUTPUT_DIR / "store"  # Step 5 rows of every run as Parquet, one file per company/quarter
+RESULTS_STORE = os.environ.get("RESULTS_STORE", "1") == "1"  # Append each run to the results store
+HERE_CASSETTE = os.environ.get("HERE_CASSETTE", "")  # "record": capture HERE traffic, "replay": serve it with no network
+HERE_CASSETTE_FILE = Path(os.environ.get("HERE_CASSETTE_FILE", BASE_DIR / "cassettes" / "here.sqlite"))
+HERE_LATENCY_FILE = BASE_DIR / "cache" / "here_latency.json"  # Recent HERE response times per endpoint (run planner)
+HERE_HEDGE_PERCENTILE = float(os.environ.get("HERE_HEDGE_PERCENTILE", "95"))  # Re-send a HERE GET still unanswered at this latency percentile; 0 = off
+HERE_HEDGE_MAX_FRACTION = float(os.environ.get("HERE_HEDGE_MAX_FRACTION", "0.05"))  # At most this share of HERE requests is hedged
+HERE_BREAKER_FAILURES = int(os.environ.get("HERE_BREAKER_FAILURES", "10"))  # Consecutive HERE failures that open an endpoint's circuit
+HERE_BREAKER_ERROR_RATE = float(os.environ.get("HERE_BREAKER_ERROR_RATE", "0.5"))  # ...or this failure rate over the last 50 requests
+HERE_BREAKER_COOLDOWN_S = float(os.environ.get("HERE_BREAKER_COOLDOWN_S", "30"))  # Open circuit sends one probe after this long
+HERE_MONTHLY_QUOTA = int(os.environ.get("HERE_MONTHLY_QUOTA", "0"))  # HERE transactions per month (geocode + routing); 0 = no monthly budget
+HERE_DAILY_QUOTA = int(os.environ.get("HERE_DAILY_QUOTA", "0"))  # HERE transactions per UTC day; 0 = no daily budget
+HERE_QUOTA_SOFT_PCT = float(os.environ.get("HERE_QUOTA_SOFT_PCT", "80"))  # Past this share of a budget only high-priority requests go to HERE
+HERE_QUOTA_HARD_PCT = float(os.environ.get("HERE_QUOTA_HARD_PCT", "100"))  # At this share nothing more is sent
+HERE_QUOTA_PRIORITY_LOADS = int(os.environ.get("HERE_QUOTA_PRIORITY_LOADS", "5"))  # Routes serving this many loads are high priority
+HERE_QUOTA_FILE = BASE_DIR / "cache" / "here_quota.sqlite"  # Ledger of HERE transactions per endpoint and day
 COMPANY_NAME = "Ansh Freight"
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Reporting window: quarter ("2025Q2"), year ("2025") or range ("2025-04-01:2025-06-30"); Q2 2025 per feedback.md
+REPORTING_PERIOD = os.environ.get("REPORTING_PERIOD", "2025Q2")
+
+# HERE Routing v8 parameters (truck + fast per feedback.md section 3)
+HERE_ROUTE_PARAMS = {
+    "transportMode": "truck",
+    "routingMode": "fast",
+    "return": "summary,polyline",
+}
+
+# Offline geodesic fallback (used when routing fails but both endpoints are geocoded)
+CIRCUITY_FACTOR = os.environ.get("CIRCUITY_FACTOR")  # Fixed road/geodesic ratio; unset = learned from successful routes
+DEFAULT_CIRCUITY_FACTOR = 1.2  # Typical US truck route circuity until enough routes have been observed
+GEODESIC_STEP_KM = 5  # Densification step along the geodesic before state overlay
+
+# Bump when pipeline logic changes so stale cached results are not served
+RESULT_CACHE_VERSION = 4
+
+# Logging is configured by the entry points (CLI, app, Step 5 workers), not on import
 logger = logging.getLogger(__name__)
 
-# Ensure debug directory exists
-DEBUG_DIR.mkdir(exist_ok=True)
+def configure_logging():
+    """INFO-level timestamped log lines on the root logger"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def debug_path(name: str) -> Path:
+    """Path of a phase debug CSV; the debug directory is created on first write"""
+    DEBUG_DIR.mkdir(exist_ok=True)
+    return DEBUG_DIR / name
 
 # State abbreviation to full name mapping
 STATE_MAPPING = {
@@ -63,6 +141,28 @@ STATE_MAPPING = {
     'DC': 'District of Columbia'
 }
 
+# Warehouse/building identifiers stripped from city names (compiled once, see clean_location_name)
+_LOCATION_NOISE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'\s+\d+$',  # Remove trailing numbers (building numbers)
+    r'\s+#\d+.*$',  # Remove # followed by numbers
+    r'\s+BLDG.*$',  # Remove BLDG and everything after
+    r'\s+BUILDING.*$',  # Remove BUILDING and everything after  
+    r'\s+WAREHOUSE.*$',  # Remove WAREHOUSE and everything after
+    r'\s+DC\s*\d*$',  # Remove DC (Distribution Center) with optional numbers
+    r'\s+WH\s*\d*$',  # Remove WH (Warehouse) with optional numbers
+)]
+
+# Spelling variants that refer to the same place (alias keys only, display names keep the original)
+_LOCATION_ALIAS_PATTERNS = [
+    (re.compile(r'[^\w\s,]'), ' '),  # Punctuation: "ST. LOUIS" / "ST LOUIS", "O'FALLON" / "O FALLON"
+    (re.compile(r'\bST\b'), 'SAINT'),
+    (re.compile(r'\bSTE\b'), 'SAINTE'),
+    (re.compile(r'\bFT\b'), 'FORT'),
+    (re.compile(r'\bMT\b'), 'MOUNT'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\s*,\s*'), ','),
+]
+
 def clean_location_name(city: str) -> str:
     """
     Clean location names for better geocoding accuracy
@@ -75,25 +175,72 @@ def clean_location_name(city: str) -> str:
     city = str(city).strip()
    
     # Remove common warehouse/building identifiers
-    unwanted_patterns = [
-        r'\s+\d+$',  # Remove trailing numbers (building numbers)
-        r'\s+#\d+.*$',  # Remove # followed by numbers
-        r'\s+BLDG.*$',  # Remove BLDG and everything after
-        r'\s+BUILDING.*$',  # Remove BUILDING and everything after  
-        r'\s+WAREHOUSE.*$',  # Remove WAREHOUSE and everything after
-        r'\s+DC\s*\d*$',  # Remove DC (Distribution Center) with optional numbers
-        r'\s+WH\s*\d*$',  # Remove WH (Warehouse) with optional numbers
-    ]
-   
-    import re
-    for pattern in unwanted_patterns:
-        city = re.sub(pattern, '', city, flags=re.IGNORECASE)
+    for pattern in _LOCATION_NOISE_PATTERNS:
+        city = pattern.sub('', city)
    
     # Clean up extra spaces
     city = ' '.join(city.split())
    
     return city
 
+def canonical_location(city: str, state_abbr: str) -> str:
+    """Geocoding cache format: "CITY, State, USA" with a cleaned city and full state name"""
+    return f"{clean_location_name(city)}, {STATE_MAPPING.get(state_abbr, state_abbr)}, USA"
+
+def location_alias_key(canonical: str) -> str:
+    """Normalized key under which spelling variants of one location collide"""
+    key = canonical.upper()
+    for pattern, replacement in _LOCATION_ALIAS_PATTERNS:
+        key = pattern.sub(replacement, key)
+    return key.strip()
+
+class LocationIndex:
+    """
+    Canonical "CITY, State, USA" locations mapped to integer ids.
+    Spelling variants (ST./SAINT, FT/FORT, punctuation, case) are aliases of one id,
+    so geocode and route caches hit across them.
+    """
+
+    def __init__(self):
+        self.names: List[str] = []  # id -> canonical name (first spelling seen)
+        self.aliases: List[List[str]] = []  # id -> every spelling seen
+        self._ids: Dict[str, int] = {}  # alias key -> id
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, canonical: str) -> int:
+        key = location_alias_key(canonical)
+        loc_id = self._ids.get(key)
+        if loc_id is None:
+            loc_id = len(self.names)
+            self._ids[key] = loc_id
+            self.names.append(canonical)
+            self.aliases.append([canonical])
+        elif canonical not in self.aliases[loc_id]:
+            self.aliases[loc_id].append(canonical)
+        return loc_id
+
+    def encode(self, cities: pd.Series, states: pd.Series) -> np.ndarray:
+        """Location id per row; each distinct (city, state) pair is cleaned only once"""
+        codes, uniques = pd.factorize(cities.astype(str) + "\x1f" + states.astype(str))
+        ids = np.fromiter((self.add(canonical_location(*key.split("\x1f"))) for key in uniques),
+                          dtype=np.int32, count=len(uniques))
+        return ids[codes]
+
+    def share_coords(self, location_coords: dict) -> int:
+        """Copy cached coordinates to every spelling of a location; returns how many were filled in"""
+        filled = 0
+        for names in self.aliases:
+            coords = next((location_coords[name] for name in names if name in location_coords), None)
+            if coords is None:
+                continue
+            for name in names:
+                if name not in location_coords:
+                    location_coords[name] = coords
+                    filled += 1
+        return filled
+
 def load_api_key() -> str:
     """Load HERE API key from environment or secrets.toml"""
     key = os.environ.get("HERE_API_KEY")
@@ -101,6 +248,7 @@ def load_api_key() -> str:
         return key
     
     try:
+        import toml
         cfg = toml.load(SECRETS_FILE)
         key = cfg.get("HERE_API_KEY") or cfg.get("HERE_KEY")
         if key:
@@ -110,55 +258,157 @@ def load_api_key() -> str:
     
     raise RuntimeError("HERE_API_KEY not found in environment or secrets.toml")
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Reporting Periods
+# ──────────────────────────────────────────────────────────────────────────────
+
+_QUARTER_PATTERNS = [
+    re.compile(r'^(?P<year>\d{4})\s*-?\s*Q(?P<quarter>[1-4])$', re.IGNORECASE),  # 2025Q2, 2025-Q2
+    re.compile(r'^Q(?P<quarter>[1-4])\s*-?\s*(?P<year>\d{4})$', re.IGNORECASE),  # Q2 2025, Q2-2025
+]
+_YEAR_PATTERN = re.compile(r'^(?P<year>\d{4})$')
+_RANGE_PATTERN = re.compile(r'^(?P<start>\d{4}-\d{2}-\d{2})\s*(?::|\.\.)\s*(?P<end>\d{4}-\d{2}-\d{2})$')
+
+class ReportingPeriod:
+    """Inclusive PU-date window (whole days) used to filter loads at ingest"""
+
+    def __init__(self, start, end, label: str):
+        self.start = pd.Timestamp(start).normalize()
+        self.end = pd.Timestamp(end).normalize()
+        if self.end < self.start:
+            raise ValueError(f"Reporting period {label} ends before it starts")
+        self.label = label
+
+    def __repr__(self) -> str:
+        return f"ReportingPeriod({self.label}: {self.start.date()} → {self.end.date()})"
+
+    @classmethod
+    def quarter(cls, year: int, quarter: int) -> "ReportingPeriod":
+        start = pd.Timestamp(year=year, month=3 * quarter - 2, day=1)
+        return cls(start, start + pd.offsets.QuarterEnd(0), f"{year}Q{quarter}")
+
+    def mask(self, dates: pd.Series) -> pd.Series:
+        """True for dates inside the window (NaT is outside)"""
+        return (dates >= self.start) & (dates < self.end + pd.Timedelta(days=1))
+
+    def quarters(self) -> List["ReportingPeriod"]:
+        """Calendar quarters overlapping this window, clipped to it"""
+        periods = []
+        for quarter_start in pd.date_range(self.start - pd.offsets.QuarterBegin(startingMonth=1),
+                                           self.end, freq="QS-JAN"):
+            if quarter_start + pd.offsets.QuarterEnd(0) < self.start:
+                continue
+            period = ReportingPeriod.quarter(quarter_start.year, quarter_start.quarter)
+            period.start, period.end = max(period.start, self.start), min(period.end, self.end)
+            periods.append(period)
+        return periods
+
+def parse_period(spec: str) -> ReportingPeriod:
+    """Parse a reporting period: "2025Q2" / "Q2 2025" (quarter), "2025" (year), "2025-04-01:2025-06-30" (range)"""
+    spec = str(spec).strip()
+    for pattern in _QUARTER_PATTERNS:
+        match = pattern.match(spec)
+        if match:
+            return ReportingPeriod.quarter(int(match["year"]), int(match["quarter"]))
+    match = _YEAR_PATTERN.match(spec)
+    if match:
+        year = int(match["year"])
+        return ReportingPeriod(f"{year}-01-01", f"{year}-12-31", str(year))
+    match = _RANGE_PATTERN.match(spec)
+    if match:
+        return ReportingPeriod(match["start"], match["end"], f"{match['start']}_{match['end']}")
+    raise ValueError(f"Unrecognized reporting period: {spec!r} (expected e.g. 2025Q2, 2025 or 2025-04-01:2025-06-30)")
+
+def split_into_quarters(specs: List[str]) -> List[ReportingPeriod]:
+    """
+    Expand period specs into distinct calendar quarters, in order (batch mode unit of work).
+    Pieces of the same quarter from different specs merge into one window spanning them.
+    """
+    periods: Dict[str, ReportingPeriod] = {}
+    for spec in specs:
+        for period in parse_period(spec).quarters():
+            seen = periods.setdefault(period.label, period)
+            seen.start, seen.end = min(seen.start, period.start), max(seen.end, period.end)
+    return sorted(periods.values(), key=lambda period: period.start)
+
+def apply_period_filter(pcs: pd.DataFrame, period: ReportingPeriod, date_column: str = "PU Date F") -> pd.DataFrame:
+    """
+    Filter pushdown: parse only the PU date and drop out-of-period rows before any other
+    per-row cleanup, so rows outside the window are never cleaned or carried through Step 1.
+    """
+    dates = pd.to_datetime(pcs[date_column], errors='coerce')
+    in_period = period.mask(dates)
+    return pcs.loc[in_period].assign(**{date_column: dates[in_period]})
+
 # # ──────────────────────────────────────────────────────────────────────────────
 # # Phase 1: Data Import and Initial Processing
 # # ──────────────────────────────────────────────────────────────────────────────
 
-def step1_read_excel_data() -> Tuple[pd.DataFrame, pd.DataFrame]:
+def find_pcs_sheet(sheet_names: List[str]) -> str:
+    """PCS_SHEET, or the workbook's own "Export Research <date>" sheet (the name changes with each export)"""
+    if PCS_SHEET in sheet_names:
+        return PCS_SHEET
+    for sheet_name in sheet_names:
+        if sheet_name.strip().lower().startswith("export research"):
+            return sheet_name
+    raise ValueError(f"No 'Export Research' sheet found (sheets: {', '.join(sheet_names)})")
+
+def step1_read_excel_data(lean: bool = LEAN_FRAME, period: Optional[ReportingPeriod] = None,
+                          input_file: Optional[Path] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Phase 1: Read Excel data and perform initial cleanup
     Following plan.md Step 1.1 & 1.2
+    With lean=True the string columns become categoricals at ingest (see to_lean_frame)
+    The reporting period (default REPORTING_PERIOD) is applied right after reading
     """
     logger.info("Phase 1: Reading and cleaning Excel data...")
-    
-    if not INPUT_FILE.exists():
-        raise FileNotFoundError(f"Input file not found: {INPUT_FILE}")
+    if period is None:
+        period = parse_period(REPORTING_PERIOD)
+    input_file = Path(input_file or INPUT_FILE)
+
+    if not input_file.exists():
+        raise FileNotFoundError(f"Input file not found: {input_file}")
     
     # Read main trip data and inventory data
-    pcs = pd.read_excel(INPUT_FILE, sheet_name=PCS_SHEET, keep_default_na=False)
-    inv = pd.read_excel(INPUT_FILE, sheet_name=INV_SHEET, usecols=["Unit", "Company"])
-    logger.info(f"Read {len(pcs)} rows from {PCS_SHEET} sheet")
+    with pd.ExcelFile(input_file) as workbook:
+        pcs_sheet = find_pcs_sheet(workbook.sheet_names)
+        pcs = pd.read_excel(workbook, sheet_name=pcs_sheet, keep_default_na=False)
+        inv = pd.read_excel(workbook, sheet_name=INV_SHEET, usecols=["Unit", "Company"])
+    logger.info(f"Read {len(pcs)} rows from {pcs_sheet} sheet")
     logger.info(f"Read {len(inv)} rows from {INV_SHEET} sheet")
-    
+
+    # CRITICAL FIX: Filter for the reporting period first (Q2 2025 by default) - pushed down before cleanup
+    initial_row_count = len(pcs)
+    pcs = apply_period_filter(pcs, period)
+    logger.info(f"{period.label} date filter applied: {initial_row_count} → {len(pcs)} rows")
+
     # Data cleanup and standardization (following plan.md Step 1.2)
     logger.info("Performing data cleanup...")
-    pcs["Truck"] = pcs["Truck"].astype(str).str.strip()
-    pcs["Trailer"] = pcs["Trailer"].astype(str).str.strip()
-    pcs["Ship City"] = pcs["Ship City"].astype(str).str.strip()
-    pcs["Ship St"] = pcs["Ship St"].str.upper().str.strip()
-    pcs["Cons City"] = pcs["Cons City"].astype(str).str.strip()
-    pcs["Cons St"] = pcs["Cons St"].str.upper().str.strip()
-    
-    # Date processing
-    pcs["PU Date F"] = pd.to_datetime(pcs["PU Date F"], errors='coerce')
-    pcs["Del Date F"] = pd.to_datetime(pcs["Del Date F"], errors='coerce')
+    if lean:
+        pcs, inv = to_lean_frame(pcs, inv)
+    else:
+        pcs["Truck"] = pcs["Truck"].astype(str).str.strip()
+        pcs["Trailer"] = pcs["Trailer"].astype(str).str.strip()
+        pcs["Ship City"] = pcs["Ship City"].astype(str).str.strip()
+        pcs["Ship St"] = pcs["Ship St"].str.upper().str.strip()
+        pcs["Cons City"] = pcs["Cons City"].astype(str).str.strip()
+        pcs["Cons St"] = pcs["Cons St"].str.upper().str.strip()
     
+    # Date processing (PU already parsed by the period filter)
+    pcs["Del Date F"] = pd.to_datetime(pcs["Del Date F"], errors='coerce')
+
     # Rename columns for consistency (following plan.md)
-    pcs.rename(columns={"PU Date F": "PU", "Del Date F": "DEL"}, inplace=True)
-    
-    # CRITICAL FIX: Filter for Q2 2025 only (April 1 - June 30, 2025)
-    initial_row_count = len(pcs)
-    pcs = pcs[(pcs['PU'] >= '2025-04-01') & (pcs['PU'] <= '2025-06-30')]
-    logger.info(f"Q2 2025 date filter applied: {initial_row_count} → {len(pcs)} rows")
-    
+    pcs = pcs.rename(columns={"PU Date F": "PU", "Del Date F": "DEL"})
+
     # Inventory cleanup
-    inv['Unit'] = inv['Unit'].astype(str).str.strip()
+    if not lean:
+        inv['Unit'] = inv['Unit'].astype(str).str.strip()
     
     logger.info("Phase 1 completed successfully")
     
     # Save debug CSV outputs
-    pcs_debug_file = DEBUG_DIR / "phase1_pcs_cleaned.csv"
-    inv_debug_file = DEBUG_DIR / "phase1_inventory.csv"
+    pcs_debug_file = debug_path("phase1_pcs_cleaned.csv")
+    inv_debug_file = debug_path("phase1_inventory.csv")
     pcs.to_csv(pcs_debug_file, index=False)
     inv.to_csv(inv_debug_file, index=False)
     logger.info(f"Phase 1 debug files saved:")
@@ -167,6 +417,66 @@ def step1_read_excel_data() -> Tuple[pd.DataFrame, pd.DataFrame]:
     
     return pcs, inv
 
+def _clean_categoricals(columns: List[pd.Series], upper: bool = False) -> List[pd.Series]:
+    """
+    Strip (and optionally upper-case) string columns into categoricals sharing one sorted category set.
+    Each distinct raw value is cleaned once. Paired columns (Ship/Cons) share categories so values can be
+    copied between them (Step 3 route chaining), and sorted categories keep sort_values in string order.
+    """
+    codes, uniques = pd.factorize(pd.concat(columns, ignore_index=True))
+    cleaned = pd.Index(uniques).astype(str).str.strip()
+    if upper:
+        cleaned = cleaned.str.upper()
+    categories = pd.Index(np.sort(cleaned.unique().to_numpy(dtype=object)))
+    remap = categories.get_indexer(cleaned)
+    codes = np.where(codes >= 0, remap[codes], -1)
+
+    result, start = [], 0
+    for column in columns:
+        part = codes[start:start + len(column)]
+        result.append(pd.Series(pd.Categorical.from_codes(part, categories=categories), index=column.index, name=column.name))
+        start += len(column)
+    return result
+
+def to_lean_frame(pcs: pd.DataFrame, inv: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Lean-frame mode: Step 1.2 cleanup done on categories instead of every row.
+    Truck, Trailer, Ship/Cons City, Ship/Cons St, inventory Unit and Company become categoricals.
+    """
+    pcs["Truck"], = _clean_categoricals([pcs["Truck"]])
+    pcs["Trailer"], = _clean_categoricals([pcs["Trailer"]])
+    pcs["Ship City"], pcs["Cons City"] = _clean_categoricals([pcs["Ship City"], pcs["Cons City"]])
+    pcs["Ship St"], pcs["Cons St"] = _clean_categoricals([pcs["Ship St"], pcs["Cons St"]], upper=True)
+    inv["Unit"], = _clean_categoricals([inv["Unit"]])
+    inv["Company"] = inv["Company"].astype("category")
+    return pcs, inv
+
+def _numeric_text_mask(values: pd.Series) -> np.ndarray:
+    """True where the value parses as a number (evaluated once per category for categoricals)"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        numeric = pd.to_numeric(pd.Series(values.cat.categories), errors='coerce').notna().to_numpy()
+        codes = values.cat.codes.to_numpy()
+        return np.where(codes >= 0, numeric[np.maximum(codes, 0)], False)
+    return pd.to_numeric(values, errors='coerce').notna().to_numpy()
+
+def _join_inventory_by_code(pcs: pd.DataFrame, inv: pd.DataFrame) -> pd.DataFrame:
+    """
+    Lean-mode 2-D/2-E: match the first 4 truck digits against inventory Unit once per truck category,
+    then broadcast Company to rows through the categorical codes (no row-wise string merge).
+    """
+    trucks = pcs["Truck"].cat
+    truck_clean = pd.Index(trucks.categories.astype(str).str[:4])
+    company = inv["Company"].astype("category")
+    unit_rows = pd.Index(inv["Unit"].astype(str)).get_indexer(truck_clean)
+    company_codes = company.cat.codes.to_numpy()
+    category_company = np.where(unit_rows >= 0, company_codes[np.maximum(unit_rows, 0)], -1)
+    row_codes = trucks.codes.to_numpy()
+    pcs["Company"] = pd.Categorical.from_codes(
+        np.where(row_codes >= 0, category_company[np.maximum(row_codes, 0)], -1),
+        categories=company.cat.categories,
+    )
+    return pcs
+
 # # ──────────────────────────────────────────────────────────────────────────────
 # # Phase 2: Data Filtering and Preparation
 # # ──────────────────────────────────────────────────────────────────────────────
@@ -195,17 +505,23 @@ def step2_filter_fleet_data(pcs: pd.DataFrame, inv: pd.DataFrame) -> pd.DataFram
     logger.info(f"After filtering out OP trucks: {len(pcs)} rows")
     
     # 2-C: Keep only numeric truck numbers (additional robustness check)
-    pcs = pcs[pd.to_numeric(pcs["Truck"], errors='coerce').notna()]
+    pcs = pcs[_numeric_text_mask(pcs["Truck"])]
     logger.info(f"After keeping only numeric truck numbers: {len(pcs)} rows")
     
-    # 2-D: Handle 5-digit permit cards vs 4-digit inventory units
-    # Create cleaned truck number (first 4 digits) for inventory lookup
-    pcs['Truck_clean'] = pcs['Truck'].str[:4]
-    logger.info(f"Created Truck_clean column for inventory matching")
-    
-    # 2-E: Merge with inventory using cleaned truck numbers
-    pcs = pcs.merge(inv, how="left", left_on="Truck_clean", right_on="Unit")
-    logger.info(f"After merging with inventory: {len(pcs)} rows")
+    lean = isinstance(pcs["Truck"].dtype, pd.CategoricalDtype) and inv["Unit"].is_unique
+    if lean:
+        # 2-D/2-E (lean frame): inventory lookup on first 4 digits via categorical codes
+        pcs = _join_inventory_by_code(pcs.reset_index(drop=True), inv)
+        logger.info(f"After joining inventory by truck category: {len(pcs)} rows")
+    else:
+        # 2-D: Handle 5-digit permit cards vs 4-digit inventory units
+        # Create cleaned truck number (first 4 digits) for inventory lookup
+        pcs['Truck_clean'] = pcs['Truck'].astype(str).str[:4]
+        logger.info(f"Created Truck_clean column for inventory matching")
+        
+        # 2-E: Merge with inventory using cleaned truck numbers
+        pcs = pcs.merge(inv.astype({"Unit": str}), how="left", left_on="Truck_clean", right_on="Unit")
+        logger.info(f"After merging with inventory: {len(pcs)} rows")
     logger.info(f"Company-owned units found: {pcs['Company'].count()}")
     
     # 2-F: Keep company-owned units (CORRECTED from plan.md)
@@ -227,7 +543,7 @@ def step2_filter_fleet_data(pcs: pd.DataFrame, inv: pd.DataFrame) -> pd.DataFram
     logger.info(f"--------------------------------")
     
     # Save debug CSV output
-    debug_file = DEBUG_DIR / "phase2_filtered_fleet.csv"
+    debug_file = debug_path("phase2_filtered_fleet.csv")
     pcs.to_csv(debug_file, index=False)
     logger.info(f"Phase 2 debug file saved: {debug_file}")
     
@@ -246,7 +562,7 @@ def step3_detect_round_trips(pcs: pd.DataFrame) -> pd.DataFrame:
     """
     logger.info("Phase 3: Detecting round trip patterns and assigning references...")
     
-    pcs = pcs.copy()
+    # Step 2 always returns a fresh frame, so Ref/route chaining is written in place (no defensive copy)
     ref_counter = 1
     round_trips_found = 0
     
@@ -259,10 +575,9 @@ def step3_detect_round_trips(pcs: pd.DataFrame) -> pd.DataFrame:
     
     for trailer in unique_trailers:
         # Get all loads for this trailer (already sorted by PU date from Step 2)
-        trailer_loads = pcs[pcs['Trailer'] == trailer].copy()
-        trailer_indices = trailer_loads.index.tolist()
+        trailer_indices = pcs.index[pcs['Trailer'] == trailer].tolist()
         
-        logger.debug(f"Processing Trailer {trailer}: {len(trailer_loads)} loads")
+        logger.debug(f"Processing Trailer {trailer}: {len(trailer_indices)} loads")
         
         decimal_counter = 1
         prev_del_date = None
@@ -329,7 +644,7 @@ def step3_detect_round_trips(pcs: pd.DataFrame) -> pd.DataFrame:
             decimal_counter += 1
         
         # After processing all loads for this trailer, move to next reference group
-        if len(trailer_loads) > 0:
+        if len(trailer_indices) > 0:
             ref_counter += 1
     
     logger.info(f"Phase 3 completed:")
@@ -341,7 +656,7 @@ def step3_detect_round_trips(pcs: pd.DataFrame) -> pd.DataFrame:
     logger.info(f"--------------------------------")
     
     # Save debug CSV output
-    debug_file = DEBUG_DIR / "phase3_round_trips.csv"
+    debug_file = debug_path("phase3_round_trips.csv")
     pcs.to_csv(debug_file, index=False)
     logger.info(f"Phase 3 debug file saved: {debug_file}")
     
@@ -405,6 +720,471 @@ def load_geocoding_cache() -> dict:
 #         logger.warning(f"Geocoding error for {location}: {e}")
 #         return None, None
 
+class RateLimiter:
+    """
+    Process-wide request budget: each acquire() reserves the next free slot `1 / rate` apart.
+    No locks, so one instance serves every event loop and every concurrent Step 5 call.
+    """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+# Shared by geocoding and HERE routing (all workbooks in a batch draw from the same budget)
+here_rate_limiter = RateLimiter(HERE_MAX_RPS)
+
+HERE_GEOCODE_URL = "https://geocode.search.hereapi.com/v1/geocode"
+HERE_ROUTES_URL = "https://router.hereapi.com/v8/routes"
+HERE_ENDPOINTS = {HERE_GEOCODE_URL: "geocode", HERE_ROUTES_URL: "routing"}
+
+class HereLatencyStats:
+    """
+    Recent HERE response times per endpoint (persisted in HERE_LATENCY_FILE), used by the
+    run planner to estimate wall time. Saving merges with samples other processes wrote meanwhile.
+    """
+    MAX_SAMPLES = 2000
+
+    def __init__(self, samples: Optional[Dict[str, List[float]]] = None):
+        self.samples = {endpoint: list(values)[-self.MAX_SAMPLES:] for endpoint, values in (samples or {}).items()}
+        self._new: Dict[str, List[float]] = {}
+
+    @classmethod
+    def read_file(cls) -> Dict[str, List[float]]:
+        if not HERE_LATENCY_FILE.exists():
+            return {}
+        try:
+            with open(HERE_LATENCY_FILE, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Error loading HERE latency stats: {e}")
+            return {}
+
+    @classmethod
+    def load(cls) -> "HereLatencyStats":
+        return cls(cls.read_file())
+
+    def observe(self, endpoint: str, seconds: float):
+        self.samples.setdefault(endpoint, []).append(seconds)
+        self._new.setdefault(endpoint, []).append(seconds)
+        if len(self.samples[endpoint]) > 2 * self.MAX_SAMPLES:
+            self.samples[endpoint] = self.samples[endpoint][-self.MAX_SAMPLES:]
+
+    def save(self):
+        if not self._new:
+            return
+        try:
+            merged = self.read_file()
+            for endpoint, values in self._new.items():
+                merged[endpoint] = (merged.get(endpoint, []) + [round(v, 4) for v in values])[-self.MAX_SAMPLES:]
+            HERE_LATENCY_FILE.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = HERE_LATENCY_FILE.with_name(f"{HERE_LATENCY_FILE.name}.{os.getpid()}.tmp")
+            with open(tmp_file, 'w') as f:
+                json.dump(merged, f)
+            os.replace(tmp_file, HERE_LATENCY_FILE)
+            self._new = {}
+        except Exception as e:
+            logger.warning(f"Error saving HERE latency stats: {e}")
+
+    def count(self, endpoint: str) -> int:
+        return len(self.samples.get(endpoint, []))
+
+    def mean(self, endpoint: str) -> Optional[float]:
+        values = self.samples.get(endpoint)
+        return float(np.mean(values[-self.MAX_SAMPLES:])) if values else None
+
+    def percentile(self, endpoint: str, q: float) -> Optional[float]:
+        values = self.samples.get(endpoint)
+        return float(np.percentile(values[-self.MAX_SAMPLES:], q)) if values else None
+
+@functools.lru_cache(maxsize=1)
+def get_here_latency_stats() -> HereLatencyStats:
+    """The process's HERE latency samples (loaded once, saved at the end of Step 5)"""
+    return HereLatencyStats.load()
+
+class HereCassette:
+    """
+    Recorded HERE responses (status + zlib-compressed body) in one SQLite file, keyed by
+    URL + query parameters without the API key. Record mode stores every response that
+    arrives; replay mode answers from the file and never touches the network.
+    """
+
+    def __init__(self, path: Path, mode: str):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown HERE_CASSETTE mode: {mode!r} (expected 'record' or 'replay')")
+        if mode == "replay" and not Path(path).exists():
+            raise FileNotFoundError(f"HERE cassette not found for replay: {path}")
+        self.path, self.mode = Path(path), mode
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                request_key TEXT PRIMARY KEY, url TEXT, params TEXT, status INTEGER, body BLOB, recorded TEXT
+            )
+        """)
+        self.misses = 0
+
+    @staticmethod
+    def request_key(url: str, params: dict) -> Tuple[str, str]:
+        params_json = json.dumps({k: v for k, v in params.items() if k != "apiKey"}, sort_keys=True)
+        return hashlib.sha1(f"{url}?{params_json}".encode("utf-8")).hexdigest(), params_json
+
+    def record(self, url: str, params: dict, status: int, body: str):
+        request_key, params_json = self.request_key(url, params)
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                          (request_key, url, params_json, status, zlib.compress(body.encode("utf-8"), 6),
+                           datetime.now().isoformat(timespec="seconds")))
+
+    def lookup(self, url: str, params: dict) -> Optional[Tuple[int, str]]:
+        """Recorded (status, body) for this request, or None"""
+        row = self.conn.execute("SELECT status, body FROM responses WHERE request_key = ?",
+                                (self.request_key(url, params)[0],)).fetchone()
+        return None if row is None else (row[0], zlib.decompress(row[1]).decode("utf-8"))
+
+    def replay(self, url: str, params: dict) -> Tuple[int, str]:
+        recorded = self.lookup(url, params)
+        if recorded is None:
+            self.misses += 1
+            logger.warning(f"HERE cassette miss (not recorded): {url} {self.request_key(url, params)[1][:120]}")
+            return 599, "request not recorded in cassette"
+        return recorded
+
+@functools.lru_cache(maxsize=1)
+def get_here_cassette() -> Optional[HereCassette]:
+    """The HERE_CASSETTE record/replay cassette, or None for plain live traffic"""
+    if not HERE_CASSETTE:
+        return None
+    cassette = HereCassette(HERE_CASSETTE_FILE, HERE_CASSETTE)
+    logger.info(f"HERE cassette {cassette.mode}: {cassette.path}")
+    return cassette
+
+class HereQuotaLedger:
+    """
+    Persistent count of live HERE transactions (hedges included) per endpoint and UTC day, in one
+    SQLite file shared by every run, worker process and machine that sees it. Counts are buffered
+    and added to the file every FLUSH_EVERY requests; each flush also re-reads the month and day
+    totals, so other processes' usage shows up in the budget level.
+    Level against HERE_MONTHLY_QUOTA / HERE_DAILY_QUOTA: "ok", "soft" (only high-priority requests
+    go to HERE) or "hard" (none do).
+    """
+    FLUSH_EVERY = 25
+
+    def __init__(self, path: Path, monthly_quota: int = 0, daily_quota: int = 0,
+                 soft_pct: float = 80.0, hard_pct: float = 100.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.monthly_quota, self.daily_quota = monthly_quota, daily_quota
+        self.soft_pct, self.hard_pct = soft_pct, hard_pct
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                endpoint TEXT, day TEXT, requests INTEGER, PRIMARY KEY (endpoint, day)
+            )
+        """)
+        self.pending: Dict[Tuple[str, str], int] = {}
+        self._refresh()
+
+    @staticmethod
+    def today() -> str:
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+    def _refresh(self):
+        """Month and day totals from the file (pending counts are added on top)"""
+        day = self.today()
+        self.day = day
+        self.month_used = self.conn.execute("SELECT COALESCE(SUM(requests), 0) FROM usage WHERE day LIKE ?",
+                                            (day[:7] + "%",)).fetchone()[0]
+        self.day_used = self.conn.execute("SELECT COALESCE(SUM(requests), 0) FROM usage WHERE day = ?",
+                                          (day,)).fetchone()[0]
+
+    def count(self, endpoint: str):
+        """One live HERE transaction"""
+        key = (endpoint, self.today())
+        self.pending[key] = self.pending.get(key, 0) + 1
+        self.month_used += 1
+        self.day_used += 1
+        if sum(self.pending.values()) >= self.FLUSH_EVERY or key[1] != self.day:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?) ON CONFLICT (endpoint, day) DO UPDATE SET requests = requests + excluded.requests",
+                [(endpoint, day, n) for (endpoint, day), n in self.pending.items()],
+            )
+            self.pending.clear()
+        self._refresh()
+
+    def used_pct(self, extra: int = 0) -> float:
+        """Largest share (%) of the monthly or daily budget used, after `extra` more requests"""
+        shares = [0.0]
+        if self.monthly_quota > 0:
+            shares.append((self.month_used + extra) / self.monthly_quota * 100)
+        if self.daily_quota > 0:
+            shares.append((self.day_used + extra) / self.daily_quota * 100)
+        return max(shares)
+
+    def level(self, extra: int = 0) -> str:
+        used = self.used_pct(extra)
+        return "hard" if used >= self.hard_pct else "soft" if used >= self.soft_pct else "ok"
+
+    def permits(self, priority: str = "normal") -> bool:
+        """Whether a request of this priority may go to HERE now"""
+        level = self.level()
+        return level == "ok" or (level == "soft" and priority == "high")
+
+    def allow(self, priority: str = "normal") -> bool:
+        """permits(), counting refusals in the running Step 5's stats (logged once per run)"""
+        allowed = self.permits(priority)
+        if not allowed:
+            level = self.level()
+            stats = current_step5_stats()
+            stats.quota_refused += 1
+            if stats.quota_refused == 1:
+                logger.warning(f"HERE quota {level} budget reached ({self.used_pct():.1f}% used) - "
+                               f"{'only high-priority requests' if level == 'soft' else 'no requests'} go to HERE; "
+                               f"the rest are served from the route archive, the cassette or the geodesic estimate")
+        return allowed
+
+    def usage(self, month: Optional[str] = None) -> pd.DataFrame:
+        """Requests per endpoint and day for a month (YYYY-MM, default current)"""
+        self.flush()
+        month = month or self.today()[:7]
+        return pd.read_sql_query("SELECT endpoint, day, requests FROM usage WHERE day LIKE ? ORDER BY day, endpoint",
+                                 self.conn, params=(month + "%",))
+
+@functools.lru_cache(maxsize=1)
+def get_here_quota_ledger() -> HereQuotaLedger:
+    """The process's HERE quota ledger (budgets from HERE_MONTHLY_QUOTA / HERE_DAILY_QUOTA)"""
+    return HereQuotaLedger(HERE_QUOTA_FILE, HERE_MONTHLY_QUOTA, HERE_DAILY_QUOTA, HERE_QUOTA_SOFT_PCT, HERE_QUOTA_HARD_PCT)
+
+@functools.lru_cache(maxsize=1)
+def get_quota_fallback_cassette() -> Optional[HereCassette]:
+    """Cassette that answers requests the quota budget refuses: the active one, else HERE_CASSETTE_FILE if recorded"""
+    cassette = get_here_cassette()
+    if cassette is None and HERE_CASSETTE_FILE.exists():
+        cassette = HereCassette(HERE_CASSETTE_FILE, "replay")
+    return cassette
+
+def log_here_quota(ledger: HereQuotaLedger, planned_calls: int = 0):
+    """Usage recorded so far against the budgets, and the level `planned_calls` more requests would reach"""
+    budgets = [f"{used}/{quota} {period}" for used, quota, period in
+               ((ledger.month_used, ledger.monthly_quota, "this month"), (ledger.day_used, ledger.daily_quota, "today")) if quota > 0]
+    if not budgets:
+        return
+    logger.info(f"HERE quota: {', '.join(budgets)} ({ledger.used_pct():.1f}% used, soft {ledger.soft_pct:g}% / hard {ledger.hard_pct:g}%)")
+    level = ledger.level(planned_calls)
+    if planned_calls and level != "ok":
+        logger.warning(f"  • This run needs up to {planned_calls} HERE requests ({ledger.used_pct(planned_calls):.1f}% of budget): past the {level} "
+                       f"budget {'only geocodes and routes with ' + str(HERE_QUOTA_PRIORITY_LOADS) + '+ loads' if level == 'soft' else 'nothing'} "
+                       f"will be sent to HERE")
+
+class RequestHedger:
+    """
+    Tail-latency hedging for idempotent HERE GETs: a request still unanswered after the endpoint's
+    observed latency percentile gets a second identical request, and the first answer wins.
+    Hedges are capped at max_fraction of the run's requests so a slow HERE day cannot double the
+    traffic; the counters live in the run's Step5Stats.
+    """
+    MIN_SAMPLES = 50  # No hedging until the percentile means something
+
+    def __init__(self, percentile: float, max_fraction: float):
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+
+    def delay(self, endpoint: str) -> Optional[float]:
+        """Seconds to wait before hedging a request to this endpoint, or None when hedging is off"""
+        stats = get_here_latency_stats()
+        if self.percentile <= 0 or stats.count(endpoint) < self.MIN_SAMPLES:
+            return None
+        return stats.percentile(endpoint, self.percentile)
+
+    def take_hedge(self, stats: "Step5Stats") -> bool:
+        """Spend one hedge if the run's budget (max_fraction of its requests so far) allows it"""
+        if stats.hedges + 1 > self.max_fraction * stats.hedge_requests:
+            return False
+        stats.hedges += 1
+        return True
+
+# Shared like here_rate_limiter; each run's hedge counts are reported at the end of Step 5
+here_hedger = RequestHedger(HERE_HEDGE_PERCENTILE, HERE_HEDGE_MAX_FRACTION)
+
+async def _here_fetch(session: aiohttp.ClientSession, url: str, params: dict, timeout_s: float) -> Tuple[int, str]:
+    """One live HERE GET under the global rate budget; records its latency"""
+    import aiohttp
+    await here_rate_limiter.acquire()
+    get_here_quota_ledger().count(HERE_ENDPOINTS.get(url, url))
+    started = time.monotonic()
+    try:
+        async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout_s)) as resp:
+            status, body = resp.status, await resp.text()
+    except asyncio.CancelledError:
+        # Lost to a hedge: still a (lower-bound) sample, so the tail stays visible in the stats
+        get_here_latency_stats().observe(HERE_ENDPOINTS.get(url, url), time.monotonic() - started)
+        raise
+    get_here_latency_stats().observe(HERE_ENDPOINTS.get(url, url), time.monotonic() - started)
+    return status, body
+
+async def _here_fetch_hedged(session: aiohttp.ClientSession, url: str, params: dict, timeout_s: float) -> Tuple[int, str]:
+    """_here_fetch, plus a second identical request if the first is slower than the hedge delay"""
+    stats = current_step5_stats()
+    stats.hedge_requests += 1
+    delay = here_hedger.delay(HERE_ENDPOINTS.get(url, url))
+    if delay is None:
+        return await _here_fetch(session, url, params, timeout_s)
+
+    primary = asyncio.ensure_future(_here_fetch(session, url, params, timeout_s))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done or not here_hedger.take_hedge(stats):
+            return await primary
+
+        hedge = asyncio.ensure_future(_here_fetch(session, url, params, timeout_s))
+        pending.add(hedge)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    stats.hedge_wins += task is hedge
+                    return task.result()
+        return primary.result()  # Both failed: surface the original request's error
+    finally:
+        for task in pending:
+            task.cancel()
+
+class HereCircuitOpenError(Exception):
+    """Raised instead of sending a HERE request while the endpoint's circuit is open"""
+
+class HereQuotaExceededError(HereCircuitOpenError):
+    """Raised instead of sending a HERE request the quota budget refuses (handled like an open circuit)"""
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker. Opens on HERE_BREAKER_FAILURES consecutive failures or a
+    HERE_BREAKER_ERROR_RATE failure rate over the last WINDOW requests; while open, requests fail
+    fast (Step 5 falls back to the geodesic estimate). After the cooldown one probe is let through:
+    success closes the circuit, failure keeps it open for another cooldown.
+    """
+    WINDOW = 50
+    MIN_REQUESTS = 20  # Error rate is not judged on fewer requests than this
+
+    def __init__(self, name: str, max_consecutive: int = HERE_BREAKER_FAILURES,
+                 max_error_rate: float = HERE_BREAKER_ERROR_RATE, cooldown_s: float = HERE_BREAKER_COOLDOWN_S):
+        self.name = name
+        self.max_consecutive = max_consecutive
+        self.max_error_rate = max_error_rate
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.recent: List[bool] = []
+        self.consecutive_failures = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_s:
+            self.state = "half_open"
+            logger.info(f"HERE {self.name} circuit half-open: sending a probe request")
+            return True
+        stats = current_step5_stats()
+        stats.breaker_rejected[self.name] = stats.breaker_rejected.get(self.name, 0) + 1
+        return False
+
+    def abandon(self):
+        """A request was cancelled before answering; a cancelled probe lets the next request probe again"""
+        if self.state == "half_open":
+            self.state = "open"  # opened_at is past the cooldown, so allow() re-probes at once
+
+    def record(self, ok: bool):
+        if self.state == "half_open":
+            if ok:
+                self.state, self.recent, self.consecutive_failures = "closed", [], 0
+                logger.info(f"HERE {self.name} circuit closed: probe succeeded")
+            else:
+                self.state, self.opened_at = "open", time.monotonic()
+            return
+        if self.state == "open":
+            return  # Late answer to a request sent before the circuit opened
+
+        self.recent = (self.recent + [ok])[-self.WINDOW:]
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+        error_rate = self.recent.count(False) / len(self.recent)
+        if (self.consecutive_failures >= self.max_consecutive
+                or (len(self.recent) >= self.MIN_REQUESTS and error_rate >= self.max_error_rate)):
+            self.state, self.opened_at = "open", time.monotonic()
+            stats = current_step5_stats()
+            stats.breaker_trips[self.name] = stats.breaker_trips.get(self.name, 0) + 1
+            logger.warning(f"HERE {self.name} circuit OPEN ({self.consecutive_failures} consecutive failures, "
+                           f"{error_rate:.0%} of last {len(self.recent)} requests failed) - failing fast for {self.cooldown_s:g}s")
+
+# One breaker per HERE endpoint, shared process-wide like here_rate_limiter
+here_breakers = {endpoint: CircuitBreaker(endpoint) for endpoint in HERE_ENDPOINTS.values()}
+# Step 5 sets a fresh set per route; here_get adds the endpoints whose open circuit rejected a request
+here_breaker_rejections: contextvars.ContextVar = contextvars.ContextVar("here_breaker_rejections", default=None)
+# "high" for requests that still go to HERE past the soft quota budget (Step 5 sets it per route)
+here_request_priority: contextvars.ContextVar = contextvars.ContextVar("here_request_priority", default="normal")
+
+def _is_here_outage(status: int) -> bool:
+    """Responses that count against the circuit: server errors, throttling and key problems"""
+    return status >= 500 or status in (401, 403, 429)
+
+async def here_get(session: aiohttp.ClientSession, url: str, params: dict, timeout_s: float,
+                   priority: Optional[str] = None) -> Tuple[int, str]:
+    """
+    Every HERE request goes through here: quota budget, circuit breaker and global rate budget,
+    then the live call (hedged, see RequestHedger) - or the cassette in replay mode. Returns
+    (HTTP status, body text); network errors propagate, an open circuit raises HereCircuitOpenError
+    and a refused request with no recorded answer raises HereQuotaExceededError.
+    priority defaults to here_request_priority.
+    """
+    cassette = get_here_cassette()
+    if cassette is not None and cassette.mode == "replay":
+        return cassette.replay(url, params)
+
+    endpoint = HERE_ENDPOINTS.get(url, url)
+    if not get_here_quota_ledger().allow(priority or here_request_priority.get()):
+        fallback = get_quota_fallback_cassette()
+        recorded = fallback.lookup(url, params) if fallback is not None else None
+        if recorded is not None:
+            return recorded
+        rejections = here_breaker_rejections.get()
+        if rejections is not None:
+            rejections.add(f"{endpoint} quota")
+        raise HereQuotaExceededError(f"HERE {endpoint} quota budget reached")
+
+    breaker = here_breakers.get(endpoint)
+    if breaker is not None and not breaker.allow():
+        rejections = here_breaker_rejections.get()
+        if rejections is not None:
+            rejections.add(endpoint)
+        raise HereCircuitOpenError(f"HERE {endpoint} circuit open")
+
+    try:
+        status, body = await _here_fetch_hedged(session, url, params, timeout_s)
+    except asyncio.CancelledError:
+        # The caller gave up (stream stopped early, app rerun, outer timeout): no verdict on HERE
+        if breaker is not None:
+            breaker.abandon()
+        raise
+    except Exception:
+        if breaker is not None:
+            breaker.record(False)
+        raise
+    if breaker is not None:
+        breaker.record(not _is_here_outage(status))
+    if cassette is not None:
+        cassette.record(url, params, status, body)
+    return status, body
+
 async def geocode_location_async(session: aiohttp.ClientSession, location: str, api_key: str) -> tuple:
     """Convert location name to coordinates using HERE Geocoding API (async version)"""
     try:
@@ -415,16 +1195,15 @@ async def geocode_location_async(session: aiohttp.ClientSession, location: str,
         if location in geocode_location_async._cache:
             return geocode_location_async._cache[location]
         
-        url = "https://geocode.search.hereapi.com/v1/geocode"
         params = {"q": location, "apiKey": api_key}
         
-        await asyncio.sleep(0.01)  # Rate limiting
-        async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-            if resp.status != 200:
-                logger.warning(f"Geocoding API error {resp.status} for: {location}")
-                return None, None
-               
-            data = await resp.json()
+        # High priority: a geocode is cached for good and lets every route through it be estimated offline
+        status, body = await here_get(session, HERE_GEOCODE_URL, params, timeout_s=10, priority="high")
+        if status != 200:
+            logger.warning(f"Geocoding API error {status} for: {location}")
+            return None, None
+
+        data = json.loads(body)
         
         if data.get("items"):
             position = data["items"][0]["position"]
@@ -435,6 +1214,8 @@ async def geocode_location_async(session: aiohttp.ClientSession, location: str,
             logger.warning(f"No geocoding results for: {location}")
             return None, None
             
+    except HereCircuitOpenError:
+        return None, None  # Logged once when the circuit opened
     except Exception as e:
         logger.warning(f"Async geocoding error for {location}: {e}")
         return None, None
@@ -493,118 +1274,128 @@ async def geocode_location_async(session: aiohttp.ClientSession, location: str,
 #     # Convert to tuples for consistency
 #     return {loc: tuple(coords) for loc, coords in location_coords.items() if loc in unique_locations}
 
-# def step4_add_virtual_returns(pcs: pd.DataFrame) -> pd.DataFrame:
-#     """
-#     Phase 4: Add virtual return legs for incomplete trips (AZ/NV without CA return)
-#     Maintains chronological order - no route optimization
-#     """
-#     logger.info("Phase 4: Adding virtual return legs for incomplete trips...")
-    
-#     pcs = pcs.copy()
-#     virtual_legs = []
-#     incomplete_trips = 0
-    
-#     # Group by reference base number to identify incomplete trips
-#     pcs['Ref_Base'] = pcs['Ref'].str.split('.').str[0]
-    
-#     for ref_base, group in pcs.groupby('Ref_Base'):
-#         group = group.sort_values('PU')  # Maintain chronological order
-        
-#         # Get the last load in this reference group
-#         last_load = group.iloc[-1]
-        
-#         # Check if trip ends in AZ/NV without returning to CA
-#         if (last_load['Cons St'] in ['AZ', 'NV'] and 
-#             not any(group['Cons St'] == 'CA')):  # No CA destination in this group
-            
-#             # Check if there's a future CA delivery by same truck/trailer
-#             truck = last_load['Truck'] 
-#             trailer = last_load['Trailer']
-            
-#             # Look for future loads by same truck/trailer returning to CA
-#             future_loads = pcs[(pcs['Truck'] == truck) & 
-#                               (pcs['Trailer'] == trailer) &
-#                               (pcs['PU'] > last_load['DEL']) &
-#                               (pcs['Cons St'] == 'CA')]
-            
-#             # If no future CA return within reasonable time, add virtual return
-#             if len(future_loads) == 0 or (future_loads['PU'].min() - last_load['DEL']).days > 7:
-                
-#                 # Create virtual return leg
-#                 next_decimal = len(group) + 1
-#                 virtual_ref = f"{ref_base}.{next_decimal}"
-                
-#                 virtual_leg = {
-#                     'Load': f"VIRTUAL_{last_load['Load']}",
-#                     'Trip': last_load['Trip'],
-#                     'Truck': last_load['Truck'],
-#                     'Trailer': last_load['Trailer'], 
-#                     'Ship City': last_load['Cons City'],
-#                     'Ship St': last_load['Cons St'],
-#                     'Cons City': 'SAN BERNARDINO',  # Default CA return location
-#                     'Cons St': 'CA',
-#                     'PU': last_load['DEL'],  # Start immediately after delivery
-#                     'DEL': last_load['DEL'] + pd.Timedelta(days=1),  # 1 day return trip
-#                     'Company': last_load['Company'],
-#                     'Ref': virtual_ref,
-#                     'Ref_Base': ref_base
-#                 }
-                
-#                 virtual_legs.append(virtual_leg)
-#                 incomplete_trips += 1
-                
-#                 logger.debug(f"Added virtual return: {last_load['Cons City']}, {last_load['Cons St']} → SAN BERNARDINO, CA (Ref: {virtual_ref})")
-    
-#     # Add virtual legs to main dataframe
-#     if virtual_legs:
-#         virtual_df = pd.DataFrame(virtual_legs)
-#         result = pd.concat([pcs, virtual_df], ignore_index=True)
-        
-#         # Sort by truck, trailer, and pickup date to maintain chronological order
-#         result = result.sort_values(['Truck', 'Trailer', 'PU']).reset_index(drop=True)
-#     else:
-#         result = pcs
-    
-#     # Clean up temporary column
-#     result = result.drop(columns=['Ref_Base'])
-    
-#     logger.info(f"Phase 4 completed:")
-#     logger.info(f"  • Virtual return legs added: {len(virtual_legs)}")
-#     logger.info(f"  • Incomplete trips fixed: {incomplete_trips}")
-#     logger.info(f"  • Total loads: {len(result)} (original: {len(pcs)})")
-#     logger.info(f"  • Maintained chronological order (no optimization)")
-#     logger.info(f"--------------------------------")
-    
-#     # Save debug CSV output
-#     debug_file = DEBUG_DIR / "phase4_virtual_returns.csv"
-#     result.to_csv(debug_file, index=False)
-#     logger.info(f"Phase 4 debug file saved: {debug_file}")
-    
-#     return result
+def step4_add_virtual_returns(pcs: pd.DataFrame) -> pd.DataFrame:
+    """
+    Phase 4: Add virtual return legs for incomplete trips (AZ/NV without CA return, feedback.md)
+    A Ref group whose last load ends in AZ/NV with no CA delivery in the group gets an empty
+    return leg to VIRTUAL_RETURN_CITY, CA unless the same truck+trailer picks up a CA delivery
+    within VIRTUAL_RETURN_WINDOW_DAYS. The next CA delivery comes from one merge_asof per
+    (Truck, Trailer); virtual legs are built in one frame and slotted in after their Ref group
+    (chronological order kept, no re-sort).
+    """
+    logger.info("Phase 4: Adding virtual return legs for incomplete trips...")
+
+    n_loads = len(pcs)
+    frame = pcs.reset_index(drop=True)
+    ref_base = frame["Ref"].astype(str).str.partition(".")[0]
+    frame = frame.assign(_ref_base=ref_base, _pos=np.arange(n_loads))
+
+    # Last load of each Ref group (by PU), whether the group delivers to CA, group size and end position
+    groups = frame.groupby("_ref_base", sort=False)
+    last = frame.sort_values(["_ref_base", "PU"], kind="stable").drop_duplicates("_ref_base", keep="last")
+    last = last.set_index("_ref_base")
+    last["_has_ca"] = frame["Cons St"].astype(str).eq("CA").groupby(frame["_ref_base"], sort=False).any()
+    last["_size"] = groups.size()
+    last["_end_pos"] = groups["_pos"].max()
+    candidates = last[last["Cons St"].astype(str).isin(["AZ", "NV"]) & ~last["_has_ca"]].reset_index()
+
+    # Next CA delivery by the same truck+trailer picked up strictly after this delivery
+    candidates["_next_ca_pu"] = pd.Series(pd.NaT, index=candidates.index, dtype=frame["PU"].dtype)
+    ca_deliveries = frame.loc[frame["Cons St"].astype(str).eq("CA") & frame["PU"].notna(), ["Truck", "Trailer", "PU"]]
+    dated = candidates[candidates["DEL"].notna()]
+    if len(dated) and len(ca_deliveries):
+        keys = ["Truck", "Trailer"]
+        left = dated[keys + ["DEL"]].astype({key: str for key in keys}).reset_index().sort_values("DEL", kind="stable")
+        right = (ca_deliveries.astype({key: str for key in keys})
+                 .rename(columns={"PU": "_next_ca_pu"}).sort_values("_next_ca_pu", kind="stable"))
+        matched = pd.merge_asof(left, right, left_on="DEL", right_on="_next_ca_pu", by=keys,
+                                direction="forward", allow_exact_matches=False)
+        candidates.loc[matched["index"].to_numpy(), "_next_ca_pu"] = matched["_next_ca_pu"].to_numpy()
+    gap_days = (candidates["_next_ca_pu"] - candidates["DEL"]).dt.days
+    returns = candidates[candidates["_next_ca_pu"].isna() | (gap_days > VIRTUAL_RETURN_WINDOW_DAYS)]
+
+    # All virtual legs in one frame (columns not listed stay empty, e.g. Inv No)
+    virtual = pd.DataFrame({
+        "Load": "VIRTUAL_" + returns["Load"].astype(str),
+        "Trip": returns["Trip"],
+        "Truck": returns["Truck"],
+        "Trailer": returns["Trailer"],
+        "Ship City": returns["Cons City"],
+        "Ship St": returns["Cons St"],
+        "Cons City": VIRTUAL_RETURN_CITY,
+        "Cons St": "CA",
+        "PU": returns["DEL"],
+        "DEL": returns["DEL"] + pd.Timedelta(days=1),
+        "Company": returns["Company"],
+        "Ref": returns["_ref_base"] + "." + (returns["_size"] + 1).astype(str),
+    }).reindex(columns=pcs.columns)
+
+    # Each leg goes right after the last row of its Ref group
+    order = np.insert(np.arange(n_loads), returns["_end_pos"].to_numpy() + 1, n_loads + np.arange(len(virtual)))
+    result = pd.concat([frame[pcs.columns], virtual], ignore_index=True).take(order).reset_index(drop=True)
+    for column in pcs.columns:
+        if isinstance(pcs[column].dtype, pd.CategoricalDtype) and not isinstance(result[column].dtype, pd.CategoricalDtype):
+            result[column] = result[column].astype("category")  # Lean frame: new values (e.g. the return city) widen the categories
+
+    logger.info(f"Phase 4 completed:")
+    logger.info(f"  • Incomplete AZ/NV trips: {len(candidates)} ({len(candidates) - len(returns)} return to CA within {VIRTUAL_RETURN_WINDOW_DAYS} days)")
+    logger.info(f"  • Virtual return legs added: {len(virtual)}")
+    logger.info(f"  • Total loads: {len(result)} (original: {n_loads})")
+    logger.info(f"  • Maintained chronological order (no optimization)")
+    logger.info(f"--------------------------------")
+
+    # Save debug CSV output
+    debug_file = debug_path("phase4_virtual_returns.csv")
+    result.to_csv(debug_file, index=False)
+    logger.info(f"Phase 4 debug file saved: {debug_file}")
+
+    return result
 
 # # ──────────────────────────────────────────────────────────────────────────────
 # # Phase 5: Mileage Calculation (Async/Concurrent Version)
 # # ──────────────────────────────────────────────────────────────────────────────
 
-def load_state_boundaries() -> gpd.GeoDataFrame:
-    """Load and prepare state boundary data"""
+def load_state_boundaries(level: Optional[str] = None) -> gpd.GeoDataFrame:
+    """
+    Load and prepare state boundary data.
+    level: "full" (STATE_SHP) or a simplified tolerance in meters built by `prototype.py boundaries`
+    (default STATE_BOUNDARY_LEVEL). The level is kept in states.attrs["boundary_level"].
+    """
+    import geopandas as gpd
+    level = str(level or STATE_BOUNDARY_LEVEL)
     logger.info("Loading state boundary data...")
+
+    if level != "full":
+        boundary_file = simplified_boundary_file(level)
+        if not boundary_file.exists():
+            raise FileNotFoundError(f"Simplified boundaries not built: {boundary_file} (run `prototype.py boundaries {level}`)")
+        states_projected = gpd.read_parquet(boundary_file)
+        states_projected.attrs["boundary_level"] = level
+        logger.info(f"Loaded {len(states_projected)} state boundaries simplified at {level} m")
+        return states_projected
     
     if not STATE_SHP.exists():
         raise FileNotFoundError(f"State shapefile not found: {STATE_SHP}")
     
     states = gpd.read_file(STATE_SHP)[["STUSPS", "geometry"]]
     states_projected = states.to_crs(epsg=5070)  # NAD83/USA Contiguous
+    states_projected.attrs["boundary_level"] = "full"
     
     logger.info(f"Loaded {len(states_projected)} state boundaries")
     return states_projected
 
 async def calculate_state_miles_async(session: aiohttp.ClientSession, origin: str, destination: str, 
-                                    states_gdf: gpd.GeoDataFrame, api_key: str, location_coords: dict = None) -> Dict[str, float]:
+                                    states_gdf: gpd.GeoDataFrame, api_key: str, location_coords: dict = None,
+                                    backend: Optional["RoutingBackend"] = None) -> Dict[str, float]:
     """
-    Calculate miles driven in each state for a route using HERE API
+    Calculate miles driven in each state for a route (HERE API by default, see RoutingBackend)
     Following plan.md Step 5.1 with enhanced error handling
     """
+    if backend is None:
+        backend = HereRoutingBackend(api_key)
+    if not backend.needs_coords:
+        return await backend.state_miles(session, None, None, states_gdf, origin, destination)
+
     try:
         # Use cached coordinates if available, otherwise geocode live
         origin_coords = None
@@ -614,6 +1405,10 @@ async def calculate_state_miles_async(session: aiohttp.ClientSession, origin: st
             origin_coords = location_coords.get(origin)
             dest_coords = location_coords.get(destination)
 
+        if (not origin_coords or not dest_coords) and not api_key:
+            logger.warning(f"No HERE API key to geocode uncached location: {destination if origin_coords else origin}")
+            return {}
+
         # If either coordinate is missing, geocode live using HERE Geocoding API
         if not origin_coords:
             try:
@@ -643,181 +1438,605 @@ async def calculate_state_miles_async(session: aiohttp.ClientSession, origin: st
                 logger.warning(f"Geocoding error for destination {destination}: {e}")
                 return {}
         
-        # Use coordinates for routing
-        if origin_coords and dest_coords:
-            try:
-                origin_param = f"{origin_coords[0]},{origin_coords[1]}"
-                dest_param = f"{dest_coords[0]},{dest_coords[1]}"
-            except (IndexError, TypeError) as e:
-                logger.warning(f"Invalid coordinate format: origin={origin_coords}, dest={dest_coords}, error={e}")
-                return {}
-        else:
+        if not origin_coords or not dest_coords:
             logger.warning(f"Missing coordinates after geocoding: {origin} → {destination} | origin_coords={origin_coords}, dest_coords={dest_coords}")
             return {}
+
+        return await backend.state_miles(session, origin_coords, dest_coords, states_gdf, origin, destination)
         
-        url = "https://router.hereapi.com/v8/routes"
-        params = {
-            "transportMode": "truck",
-            "routingMode": "fast",
-            "origin": origin_param,
-            "destination": dest_param,
-            "return": "summary,polyline",
-            "apiKey": api_key
-        }
-        
-        try:
-            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=15)) as resp:
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    logger.warning(f"HERE API HTTP {resp.status}: {error_text[:200]}...")
-                    return {}
-                    
-                data = await resp.json()                
-        except asyncio.TimeoutError as e:
-            logger.warning(f"HERE API timeout after 15s: {origin} → {destination}")
-            return {}
-        except Exception as e:
-            logger.warning(f"HERE API connection error: {e} | {origin} → {destination}")
-            return {}
-        
-        # Check if route was found and extract state spans
-        if not data.get("routes") or not data["routes"]:
-            logger.warning(f"HERE API no routes found. Full response: {data}")
-            return {}
-        
-        try:
-            route = data["routes"][0]
-            section = route["sections"][0]
-            logger.info(f"🗺️ Route structure: spans={bool(section.get('spans'))}, polyline={bool(section.get('polyline'))}")
-            
-            # Use HERE API's built-in state spans if available (more accurate than GIS overlay)
-            state_miles = {}
-            
-            # Check if spans are available (preferred method)
-            if "spans" in section:
-                for span in section["spans"]:
-                    if span.get("stateCode"):
-                        state_abbr = span["stateCode"]
-                        length_meters = span.get("length", 0)
-                        miles = length_meters / 1609.34  # Convert meters to miles
-                        
-                        if miles >= 0.1:  # Only include significant distances
-                            if state_abbr in state_miles:
-                                state_miles[state_abbr] += miles
-                            else:
-                                state_miles[state_abbr] = miles
-                                
-                # Round all values and return
-                state_miles = {state: round(miles, 1) for state, miles in state_miles.items()}
-                await asyncio.sleep(0.01)  # Rate limiting
-                return state_miles
-            
-            # Fallback: Process polyline with GIS overlay if spans not available
-            elif "polyline" in section:
-                try:
-                    import flexpolyline  # HERE's flexible polyline decoder
-                    from shapely.geometry import LineString
-                    import geopandas as gpd
-                    
-                    # Decode polyline to coordinates
-                    encoded_polyline = section["polyline"]
-                    
-                    # Validate polyline data before processing
-                    if not encoded_polyline or len(encoded_polyline) < 10:
-                        logger.warning(f"Polyline too short or empty: {len(encoded_polyline)} chars")
-                        return {}
-            
-                    try:
-                        # HERE uses flexible polyline encoding, not Google's standard polyline
-                        decoded_coords = flexpolyline.decode(encoded_polyline)
-                        logger.info(f"🗺️ HERE flexpolyline decoded: {len(decoded_coords)} coordinate points")
-                    except (ValueError, IndexError, TypeError, Exception) as decode_error:
-                        logger.error(f"HERE FLEXPOLYLINE DECODE FAILED: {decode_error} | Polyline length: {len(encoded_polyline)}")
-                        # Ultimate fallback: Use simple great circle distance
-                        logger.warning(f"Flexpolyline decode failed. Using great circle fallback.")
-                        return {"UNKNOWN": 0.0}  # Placeholder for great circle calculation
+    except Exception as e:
+        logger.error(f"UNEXPECTED ERROR calculating route from {origin} to {destination}: {type(e).__name__}: {e}")
+        logger.error(f"Full traceback: {traceback.format_exc()}")
+        return {}
+
+# HERE flexible polyline alphabet (https://github.com/heremaps/flexible-polyline)
+_FLEXPOLYLINE_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+_FLEXPOLYLINE_LOOKUP = np.full(256, -1, dtype=np.int64)
+_FLEXPOLYLINE_LOOKUP[np.frombuffer(_FLEXPOLYLINE_ALPHABET.encode("ascii"), dtype=np.uint8)] = np.arange(64)
+
+def decode_flexpolyline_np(encoded_polyline: str) -> np.ndarray:
+    """
+    Vectorized HERE flexible polyline decoder.
+    Returns a C-contiguous float64 array of shape (n, 2) in (lng, lat) order, ready for
+    shapely.linestrings / pyproj without building Python tuples. Third dimension is dropped.
+    """
+    chars = _FLEXPOLYLINE_LOOKUP[np.frombuffer(encoded_polyline.encode("ascii"), dtype=np.uint8)]
+    if chars.size == 0 or (chars < 0).any():
+        raise ValueError("Invalid flexible polyline encoding")
+
+    # Varints: 5 payload bits per char, bit 0x20 set on every char except the last of a value
+    is_last = (chars & 0x20) == 0
+    if not is_last[-1]:
+        raise ValueError("Truncated flexible polyline")
+    starts = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+    value_index = np.cumsum(np.concatenate(([0], is_last[:-1].astype(np.int64))))
+    shift = 5 * (np.arange(chars.size) - starts[value_index])
+    values = np.add.reduceat((chars & 0x1F) << shift, starts)
+
+    if values.size < 2 or values[0] != 1:
+        raise ValueError(f"Unsupported flexible polyline version: {values[0] if values.size else None}")
+    header = int(values[1])
+    precision = header & 15
+    dims = 3 if (header >> 4) & 7 else 2
+
+    deltas = values[2:]
+    if deltas.size == 0 or deltas.size % dims:
+        raise ValueError("Flexible polyline has an incomplete coordinate")
+    # Zigzag decode, then delta decode per dimension
+    deltas = (deltas >> 1) ^ -(deltas & 1)
+    latlng = np.cumsum(deltas.reshape(-1, dims)[:, :2], axis=0)
+
+    coords = np.empty((latlng.shape[0], 2), dtype=np.float64)
+    coords[:, 0] = latlng[:, 1]
+    coords[:, 1] = latlng[:, 0]
+    coords /= 10 ** precision
+    return coords
+
+@functools.lru_cache(maxsize=None)
+def _wgs84_transformer(target_crs: str):
+    """Cached lng/lat → target CRS transformer (pyproj setup is costly per call)"""
+    from pyproj import Transformer
+
+    return Transformer.from_crs("EPSG:4326", target_crs, always_xy=True)
+
+def project_lnglat(coords: np.ndarray, target_crs) -> np.ndarray:
+    """Project an (n, 2) lng/lat array into target_crs, returning an (n, 2) array"""
+    x, y = _wgs84_transformer(target_crs.to_string()).transform(coords[:, 0], coords[:, 1])
+    return np.column_stack((x, y))
+
+def state_miles_from_polyline(encoded_polyline: str, states_gdf: gpd.GeoDataFrame) -> Dict[str, float]:
+    """
+    GIS overlay: decode a HERE flexible polyline and intersect it with state boundaries.
+    Used when the HERE response carries no state spans.
+    """
+    # Validate polyline data before processing
+    if not encoded_polyline or len(encoded_polyline) < 10:
+        logger.warning(f"Polyline too short or empty: {len(encoded_polyline)} chars")
+        return {}
+
+    try:
+        # HERE uses flexible polyline encoding, not Google's standard polyline
+        line_coords = decode_flexpolyline_np(encoded_polyline)  # (n, 2) lng, lat
+        logger.info(f"🗺️ HERE flexpolyline decoded: {len(line_coords)} coordinate points")
+    except (ValueError, IndexError, TypeError, Exception) as decode_error:
+        logger.error(f"HERE FLEXPOLYLINE DECODE FAILED: {decode_error} | Polyline length: {len(encoded_polyline)}")
+        # Empty result lets Step 5 fall back to the offline geodesic estimate
+        logger.warning(f"Flexpolyline decode failed. Using geodesic fallback.")
+        return {}
+
+    return state_miles_from_lnglat(line_coords, states_gdf)
+
+def state_miles_from_lnglat(line_coords: np.ndarray, states_gdf: gpd.GeoDataFrame) -> Dict[str, float]:
+    """GIS overlay of an (n, 2) lng/lat route (decoded polyline or archived geometry) with state boundaries"""
+    # Validate decoded coordinates
+    if len(line_coords) < 2:
+        logger.warning(f"Insufficient decoded coordinates: {len(line_coords)}")
+        return {}
+    
+    logger.debug(f"📍 First 3 converted coords (lng, lat): {line_coords[:3].tolist()}")
+    
+    # Validate coordinates before creating LineString (vectorized bounds check)
+    invalid = (np.abs(line_coords[:, 0]) > 180) | (np.abs(line_coords[:, 1]) > 90)
+    if invalid.any():
+        logger.error(f"INVALID COORDINATES found: {line_coords[invalid][:5].tolist()}... (showing first 5)")
+        return {}
+    
+    # Reproject to match state boundaries CRS straight from the coordinate buffer
+    route_projected = project_lnglat(line_coords, states_gdf.crs)
+    logger.info(f"🗺️ Route reprojected to CRS: {states_gdf.crs} | {len(route_projected)} vertices")
+    if ROUTE_SIMPLIFY_TOLERANCE_M > 0:
+        route_projected = simplify_route(route_projected, states_gdf, ROUTE_SIMPLIFY_TOLERANCE_M)
+    
+    # Per-state lengths (raster lookup away from borders, exact intersection near them)
+    try:
+        state_meters = state_meters_along(route_projected, states_gdf)
+    except Exception as state_error:
+        logger.warning(f"Error intersecting route with states: {state_error}")
+        return {}
+    
+    state_miles = state_meters_to_miles(state_meters)
+    logger.info(f"🎯 State miles calculated: {state_miles} ({len(state_meters)} states crossed)")
+    return state_miles
+
+def state_meters_to_miles(state_meters: Dict[str, float]) -> Dict[str, float]:
+    """Convert to miles, keep significant distances (>= 0.1 mi) and round to 0.1"""
+    return {state: round(meters / 1609.34, 1) for state, meters in state_meters.items() if meters / 1609.34 >= 0.1}
+
+# ──────────────────────────────────────────────────────────────────────────────
+# State Raster: memory-mapped point-to-state grid (EPSG:5070)
+# ──────────────────────────────────────────────────────────────────────────────
+
+RASTER_OUTSIDE = 0  # Cell outside every state (ocean, Canada/Mexico, or outside the grid)
+RASTER_BORDER = 255  # Cell within 2 cells of a state boundary or coastline: exact polygon test needed
+RASTER_FORMAT_VERSION = 1
+RASTER_BORDER_STEP_M = 20  # Sub-piece length for exact point-in-polygon tests in border cells
+CONUS_BOUNDS_5070 = (-2400000.0, 200000.0, 2300000.0, 3200000.0)  # xmin, ymin, xmax, ymax (contiguous US)
+
+class StateRaster:
+    """
+    Read-only state grid: uint8 cell = 1 + state index, RASTER_BORDER or RASTER_OUTSIDE.
+    The grid is an np.load(mmap_mode="r") array, so worker processes share the OS page cache
+    instead of each holding a copy. Build once with `python prototype.py build-raster`.
+    """
+
+    def __init__(self, grid: np.ndarray, meta: dict):
+        self.grid = grid
+        self.resolution = float(meta["resolution_m"])
+        self.xmin, self.ymax = float(meta["xmin"]), float(meta["ymax"])
+        self.states: List[str] = meta["states"]  # code - 1 → STUSPS
+        self.boundary_level = str(meta.get("boundary_level", "full"))  # Boundary set the grid was built from
+
+    @classmethod
+    def load(cls, raster_dir: Path = STATE_RASTER_DIR) -> Optional["StateRaster"]:
+        meta_file = Path(raster_dir) / "meta.json"
+        if not meta_file.exists():
+            return None
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta.get("version") != RASTER_FORMAT_VERSION:
+            logger.warning(f"State raster {raster_dir} has an old format - rebuild with `prototype.py build-raster`")
+            return None
+        return cls(np.load(Path(raster_dir) / "states.npy", mmap_mode="r"), meta)
+
+    def lookup(self, xy: np.ndarray) -> np.ndarray:
+        """Cell value for each projected (x, y) point, in bulk"""
+        rows = np.floor((self.ymax - xy[:, 1]) / self.resolution).astype(np.int64)
+        cols = np.floor((xy[:, 0] - self.xmin) / self.resolution).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.grid.shape[0]) & (cols >= 0) & (cols < self.grid.shape[1])
+        values = np.full(len(xy), RASTER_OUTSIDE, dtype=np.uint8)
+        values[inside] = self.grid[rows[inside], cols[inside]]
+        return values
+
+def build_state_raster(states_gdf: gpd.GeoDataFrame, resolution_m: float = STATE_RASTER_RESOLUTION_M,
+                       out_dir: Path = STATE_RASTER_DIR, bounds: tuple = CONUS_BOUNDS_5070) -> Path:
+    """
+    Rasterize state polygons (EPSG:5070) over `bounds` at `resolution_m`.
+    Cell centers are classified per state with vectorized point-in-polygon tests; cells the
+    densified boundaries pass through, plus a 2-cell margin, become RASTER_BORDER so that any
+    segment up to one cell long starting in a non-border cell cannot leave its state.
+    """
+    import shapely
+
+    if len(states_gdf) >= RASTER_BORDER:
+        raise ValueError(f"Too many states for a uint8 raster: {len(states_gdf)}")
+    xmin, ymin, xmax, ymax = bounds
+    n_rows = int(math.ceil((ymax - ymin) / resolution_m))
+    n_cols = int(math.ceil((xmax - xmin) / resolution_m))
+    logger.info(f"Building {n_rows}x{n_cols} state raster at {resolution_m:g} m...")
+    grid = np.zeros((n_rows, n_cols), dtype=np.uint8)
+
+    for code, geometry in enumerate(states_gdf.geometry, start=1):
+        gxmin, gymin, gxmax, gymax = geometry.bounds
+        col0, col1 = max(int((gxmin - xmin) // resolution_m), 0), min(int((gxmax - xmin) // resolution_m) + 1, n_cols)
+        row0, row1 = max(int((ymax - gymax) // resolution_m), 0), min(int((ymax - gymin) // resolution_m) + 1, n_rows)
+        if col0 >= col1 or row0 >= row1:
+            continue  # Outside the grid (Alaska, Hawaii, territories)
+        shapely.prepare(geometry)
+        xs = xmin + (np.arange(col0, col1) + 0.5) * resolution_m
+        ys = ymax - (np.arange(row0, row1) + 0.5) * resolution_m
+        inside = shapely.contains_xy(geometry, *np.meshgrid(xs, ys))
+        grid[row0:row1, col0:col1][inside] = code
+
+    # Border cells: densified boundary vertices, dilated by 2 cells
+    boundary_xy = shapely.get_coordinates(shapely.segmentize(states_gdf.boundary.to_numpy(), resolution_m / 2))
+    rows = np.floor((ymax - boundary_xy[:, 1]) / resolution_m).astype(np.int64)
+    cols = np.floor((boundary_xy[:, 0] - xmin) / resolution_m).astype(np.int64)
+    border = np.zeros_like(grid, dtype=bool)
+    for d_row in range(-2, 3):
+        for d_col in range(-2, 3):
+            r, c = rows + d_row, cols + d_col
+            keep = (r >= 0) & (r < n_rows) & (c >= 0) & (c < n_cols)
+            border[r[keep], c[keep]] = True
+    grid[border] = RASTER_BORDER
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    np.save(out_dir / "states.npy", grid)
+    meta = {
+        "version": RASTER_FORMAT_VERSION, "crs": "EPSG:5070", "resolution_m": resolution_m,
+        "xmin": xmin, "ymax": ymax, "shape": [n_rows, n_cols],
+        "states": states_gdf["STUSPS"].tolist(), "boundary_level": states_gdf.attrs.get("boundary_level", "full"),
+    }
+    with open(out_dir / "meta.json", 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"State raster saved to {out_dir} ({grid.nbytes / 1e6:.0f} MB, {border.mean() * 100:.1f}% border cells)")
+    return out_dir
+
+@functools.lru_cache(maxsize=1)
+def get_state_raster() -> Optional[StateRaster]:
+    """The configured state raster, or None when it has not been built (exact polygon tests only)"""
+    raster = StateRaster.load(STATE_RASTER_DIR)
+    if raster is not None:
+        logger.info(f"Using state raster {STATE_RASTER_DIR} ({raster.resolution:g} m cells) for point-to-state lookup")
+    return raster
+
+def _locate_points(points: np.ndarray, states_gdf: gpd.GeoDataFrame) -> np.ndarray:
+    """Exact point-in-polygon: position in states_gdf of the state containing each point (-1 if none)"""
+    import shapely
+
+    located = np.full(len(points), -1, dtype=np.int64)
+    if not len(points):
+        return located
+    for i in states_gdf.sindex.query(shapely.box(*points.min(axis=0), *points.max(axis=0))):
+        geometry = states_gdf.geometry.iloc[i]
+        shapely.prepare(geometry)  # Kept on the geometry, so later routes reuse it
+        pending = np.flatnonzero(located < 0)
+        if not len(pending):
+            break
+        located[pending[shapely.contains_xy(geometry, points[pending, 0], points[pending, 1])]] = i
+    return located
+
+def state_meters_along(projected_coords: np.ndarray, states_gdf: gpd.GeoDataFrame, use_raster: bool = True) -> Dict[str, float]:
+    """
+    Length (meters) of a projected polyline inside each state.
+    With a state raster, the line is cut into pieces no longer than one cell; pieces whose ends
+    both sit in the same non-border cell value are attributed by array lookup. Only the rest
+    (near borders, coasts or outside the grid) get exact point-in-polygon tests, and only pieces
+    that change state are cut into RASTER_BORDER_STEP_M sub-pieces (error: about one sub-piece
+    per border crossing, below the 0.1 mile output rounding). Without a raster the whole line
+    is intersected with the state polygons, as it is with use_raster=False.
+    """
+    import shapely
+
+    state_meters: Dict[str, float] = {}
+    raster = get_state_raster() if use_raster else None
+    if raster is not None and states_gdf.crs is not None and states_gdf.crs.to_epsg() == 5070 \
+            and raster.states == states_gdf["STUSPS"].tolist() \
+            and raster.boundary_level == states_gdf.attrs.get("boundary_level", "full"):
+        starts, ends = projected_coords[:-1], projected_coords[1:]
+        lengths = np.hypot(*(ends - starts).T)
+        n_pieces = np.maximum(np.ceil(lengths / raster.resolution), 1).astype(np.int64)
+        segment = np.repeat(np.arange(len(lengths)), n_pieces)
+        piece = np.arange(len(segment)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+        delta = (ends - starts)[segment]
+        piece_starts = starts[segment] + delta * (piece / n_pieces[segment])[:, None]
+        piece_ends = starts[segment] + delta * ((piece + 1) / n_pieces[segment])[:, None]
+
+        start_values, end_values = raster.lookup(piece_starts), raster.lookup(piece_ends)
+        resolved = (start_values == end_values) & (start_values != RASTER_OUTSIDE) & (start_values != RASTER_BORDER)
+        meters = np.bincount(start_values[resolved], weights=(lengths / n_pieces)[segment][resolved], minlength=256)
+        for code in np.flatnonzero(meters[1:RASTER_BORDER]) + 1:
+            state_meters[raster.states[code - 1]] = float(meters[code])
+
+        if resolved.all():
+            return state_meters
+
+        # Border pieces: exact point-in-polygon tests on both ends; pieces that change state are
+        # cut into RASTER_BORDER_STEP_M sub-pieces and located by their midpoints
+        border_starts, border_ends = piece_starts[~resolved], piece_ends[~resolved]
+        border_lengths = (lengths / n_pieces)[segment][~resolved]
+        end_states = _locate_points(np.concatenate([border_starts, border_ends]), states_gdf)
+        start_states, end_states = end_states[:len(border_starts)], end_states[len(border_starts):]
+        whole = (start_states == end_states) & (start_states >= 0)
+        state_idx, weights = [start_states[whole]], [border_lengths[whole]]
+
+        crossing = start_states != end_states
+        if crossing.any():
+            n_sub = np.maximum(np.ceil(border_lengths[crossing] / RASTER_BORDER_STEP_M), 1).astype(np.int64)
+            parent = np.repeat(np.arange(len(n_sub)), n_sub)
+            offset = (np.arange(len(parent)) - np.repeat(np.cumsum(n_sub) - n_sub, n_sub) + 0.5) / n_sub[parent]
+            delta = border_ends[crossing] - border_starts[crossing]
+            sub_states = _locate_points(border_starts[crossing][parent] + delta[parent] * offset[:, None], states_gdf)
+            inside = sub_states >= 0
+            state_idx.append(sub_states[inside])
+            weights.append((border_lengths[crossing] / n_sub)[parent][inside])
+
+        border_meters = np.bincount(np.concatenate(state_idx), weights=np.concatenate(weights), minlength=len(states_gdf))
+        for i in np.flatnonzero(border_meters):
+            state_abbr = states_gdf["STUSPS"].iloc[i]
+            state_meters[state_abbr] = state_meters.get(state_abbr, 0.0) + float(border_meters[i])
+        return state_meters
+
+    route_projected = shapely.linestrings(projected_coords)
+    for i in states_gdf.sindex.query(route_projected, predicate="intersects"):
+        length = route_projected.intersection(states_gdf.geometry.iloc[i]).length
+        if length > 0:
+            state_abbr = states_gdf["STUSPS"].iloc[i]
+            state_meters[state_abbr] = state_meters.get(state_abbr, 0.0) + length
+    return state_meters
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Simplified Boundaries: topology-preserving state polygons at coarser tolerances
+# ──────────────────────────────────────────────────────────────────────────────
+
+def simplified_boundary_file(level: str) -> Path:
+    """GeoParquet file (EPSG:5070) of the boundary set simplified at `level` meters"""
+    return BOUNDARY_DIR / f"states_{level}m.parquet"
+
+def available_boundary_levels() -> List[str]:
+    """"full" plus every simplified level built under BOUNDARY_DIR, finest first"""
+    built = [path.stem.removeprefix("states_").removesuffix("m") for path in BOUNDARY_DIR.glob("states_*m.parquet")]
+    return ["full"] + sorted(built, key=float)
+
+def simplify_state_boundaries(states_gdf: gpd.GeoDataFrame, tolerance_m: float) -> gpd.GeoDataFrame:
+    """
+    Coverage simplification of the whole state set (GEOS, Visvalingam-Whyatt): each border
+    shared by two states is simplified once, so both keep the identical line - no gaps or
+    overlaps at crossings. tolerance_m is roughly the square root of the largest triangle
+    area removed. The census files are edge-matched, which the coverage algorithm requires.
+    """
+    import shapely
+
+    simplified = states_gdf.copy()
+    simplified.geometry = shapely.coverage_simplify(states_gdf.geometry.to_numpy(), tolerance_m)
+    simplified.attrs["boundary_level"] = f"{tolerance_m:g}"
+    return simplified
+
+def boundary_accuracy_report(full_gdf: gpd.GeoDataFrame, levels: Dict[str, gpd.GeoDataFrame],
+                             routes: List[np.ndarray]) -> pd.DataFrame:
+    """
+    Mileage error of each simplified level against the full-resolution polygons on real routes
+    (lng/lat arrays). Every route is attributed by exact intersection (no raster) with each set.
+    Error per route is the sum over states of |miles - full miles|; "Routes changed" counts
+    routes whose rounded output (0.1 mi) differs from the full-resolution result.
+    """
+    import shapely
+
+    projected = [project_lnglat(coords, full_gdf.crs) for coords in routes]
+    results = {}
+    for level, states in {"full": full_gdf, **levels}.items():
+        states.sindex  # Built up front so it is not timed against the first route
+        start_time = time.perf_counter()
+        meters = [state_meters_along(coords, states, use_raster=False) for coords in projected]
+        results[level] = (meters, time.perf_counter() - start_time)
+
+    full_meters, full_seconds = results["full"]
+    full_miles = sum(sum(route.values()) for route in full_meters) / 1609.34
+    rows = []
+    for level, (meters, seconds) in results.items():
+        errors = np.array([
+            sum(abs(route.get(state, 0.0) - reference.get(state, 0.0)) for state in route.keys() | reference.keys())
+            for route, reference in zip(meters, full_meters)
+        ]) / 1609.34
+        changed = sum(state_meters_to_miles(route) != state_meters_to_miles(reference)
+                      for route, reference in zip(meters, full_meters))
+        rows.append({
+            "Level": level,
+            "Vertices": int(shapely.get_num_coordinates(levels.get(level, full_gdf).geometry.to_numpy()).sum()),
+            "Routes": len(routes),
+            "Attribution s": round(seconds, 3),
+            "Speedup": round(full_seconds / seconds, 1) if seconds else None,
+            "Mean error mi": round(float(errors.mean()), 4) if len(errors) else 0.0,
+            "Max error mi": round(float(errors.max()), 4) if len(errors) else 0.0,
+            "Error % of miles": round(float(errors.sum()) / full_miles * 100, 5) if full_miles else 0.0,
+            "Routes changed": int(changed),
+        })
+    return pd.DataFrame(rows)
+
+def build_boundary_levels(tolerances: Optional[List[float]] = None, n_routes: int = BOUNDARY_REPORT_ROUTES) -> pd.DataFrame:
+    """
+    CLI `boundaries`: build the simplified boundary sets (default BOUNDARY_TOLERANCES_M) under
+    BOUNDARY_DIR and write the accuracy report on up to n_routes archived routes. Select a level
+    with STATE_BOUNDARY_LEVEL=<meters>; rebuild the state raster afterwards if one is used.
+    """
+    full = load_state_boundaries("full")
+    BOUNDARY_DIR.mkdir(parents=True, exist_ok=True)
+    levels = {}
+    for tolerance in tolerances or BOUNDARY_TOLERANCES_M:
+        start_time = time.time()
+        simplified = simplify_state_boundaries(full, float(tolerance))
+        level = simplified.attrs["boundary_level"]
+        boundary_file = simplified_boundary_file(level)
+        tmp_path = boundary_file.with_suffix(f".{os.getpid()}.tmp")
+        simplified.to_parquet(tmp_path)
+        os.replace(tmp_path, boundary_file)
+        levels[level] = simplified
+        logger.info(f"Boundaries simplified at {level} m in {time.time() - start_time:.1f}s: {boundary_file}")
+
+    archive = RouteArchive(ROUTE_ARCHIVE_FILE)
+    routes = archive.sample(n_routes)
+    if not routes:
+        logger.warning("Route archive is empty - accuracy report skipped (run Step 5 with ROUTE_ARCHIVE=1 first)")
+        return pd.DataFrame()
+
+    report = boundary_accuracy_report(full, levels, routes)
+    report_file = BOUNDARY_DIR / "accuracy_report.csv"
+    report.to_csv(report_file, index=False)
+    logger.info(f"Boundary accuracy on {len(routes)} archived routes (vs full resolution):")
+    for row in report.to_dict("records"):
+        logger.info(f"  • {row['Level']}: {row['Vertices']:,} vertices, {row['Attribution s']:.2f}s ({row['Speedup']}x) - "
+                    f"mean {row['Mean error mi']:.3f} mi, max {row['Max error mi']:.3f} mi per route, "
+                    f"{row['Error % of miles']:.4f}% of miles, {row['Routes changed']} routes changed")
+    logger.info(f"Accuracy report saved: {report_file}")
+    return report
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Route Simplification: fewer vertices to attribute, original vertices near borders
+# ──────────────────────────────────────────────────────────────────────────────
+
+_border_index_cache: Dict[int, tuple] = {}
+
+def _border_index(states_gdf: gpd.GeoDataFrame):
+    """STRtree over the bounding boxes of every boundary segment (borders and coastlines), built once per set"""
+    import shapely
+
+    cached = _border_index_cache.get(id(states_gdf))
+    if cached is None or cached[0] is not states_gdf:
+        coords, ring = shapely.get_coordinates(shapely.get_parts(states_gdf.boundary.to_numpy()), return_index=True)
+        same_ring = ring[1:] == ring[:-1]
+        starts, ends = coords[:-1][same_ring], coords[1:][same_ring]
+        boxes = shapely.box(*np.minimum(starts, ends).T, *np.maximum(starts, ends).T)
+        cached = _border_index_cache[id(states_gdf)] = (states_gdf, shapely.STRtree(boxes))
+    return cached[1]
+
+def simplify_route(projected_coords: np.ndarray, states_gdf: gpd.GeoDataFrame, tolerance_m: float) -> np.ndarray:
+    """
+    Douglas-Peucker simplification of a projected route before state attribution.
+    Vertices within 2x the tolerance of a state boundary or coastline are fixed anchors; only the
+    runs between anchors are simplified (all in one vectorized GEOS call). A simplified run
+    stays within the tolerance of the original, so it cannot reach a border, and every crossing
+    is attributed on the original vertices. The tolerance is capped at ROUTE_SIMPLIFY_MAX_TOLERANCE_M.
+    Vertex counts and route lengths before/after are added to simplify_route's counters.
+    """
+    import shapely
+
+    tolerance_m = min(tolerance_m, ROUTE_SIMPLIFY_MAX_TOLERANCE_M)
+    n = len(projected_coords)
+    if n < 3 or tolerance_m <= 0:
+        return projected_coords
+
+    # Anchors: both ends plus every vertex of a ROUTE_SIMPLIFY_CHUNK-vertex stretch whose bounding
+    # box comes within 2x the tolerance of a boundary segment's box (a cheap superset of the
+    # vertices near a border - no per-vertex distance tests)
+    chunk_starts = np.arange(0, n, ROUTE_SIMPLIFY_CHUNK)
+    lower = np.minimum.reduceat(projected_coords, chunk_starts) - 2 * tolerance_m
+    upper = np.maximum.reduceat(projected_coords, chunk_starts) + 2 * tolerance_m
+    near_chunks = np.unique(_border_index(states_gdf).query(shapely.box(*lower.T, *upper.T))[0])
+    anchor = np.isin(np.arange(n) // ROUTE_SIMPLIFY_CHUNK, near_chunks)
+    anchor[[0, -1]] = True
+    breaks = np.flatnonzero(anchor)
+
+    # Free runs: anchor to next anchor with vertices in between, all simplified in one GEOS call.
+    # Only their interior survivors are merged back between the anchors
+    free = np.flatnonzero(np.diff(breaks) > 1)
+    run_lengths = breaks[free + 1] - breaks[free] + 1
+    run_ids = np.repeat(np.arange(len(free)), run_lengths)
+    vertex_idx = np.repeat(breaks[free], run_lengths) + (np.arange(run_lengths.sum()) - np.repeat(np.cumsum(run_lengths) - run_lengths, run_lengths))
+    runs = shapely.simplify(shapely.linestrings(projected_coords[vertex_idx], indices=run_ids), tolerance_m, preserve_topology=False)
+    coords, owner = shapely.get_coordinates(runs, return_index=True)
+    same_run = owner[1:] == owner[:-1]
+    interior = np.zeros(len(owner), dtype=bool)
+    interior[1:-1] = same_run[:-1] & same_run[1:]
+    order = np.argsort(np.concatenate((np.arange(len(breaks)), free[owner[interior]] + 0.5)), kind="stable")
+    simplified = np.concatenate((projected_coords[breaks], coords[interior]))[order]
+    stats = current_step5_stats()
+    stats.simplified_routes += 1
+    stats.vertices_in += n
+    stats.vertices_out += len(simplified)
+    stats.length_in_m += float(np.hypot(*np.diff(projected_coords, axis=0).T).sum())
+    stats.length_out_m += float(np.hypot(*np.diff(simplified, axis=0).T).sum())
+    return simplified
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Routing Backends: geocoded origin/destination in, miles per state out
+# ──────────────────────────────────────────────────────────────────────────────
+
+class RoutingBackend:
+    """
+    Interface behind Step 5 routing. Implementations turn a geocoded (lat, lng) pair into
+    {state_abbr: miles} and return {} when no route is found (caller writes GEOCODE_ERR).
+    """
+    name = "base"
+    needs_coords = True  # False: routes by location name only (no geocoding before state_miles)
+
+    async def state_miles(self, session: aiohttp.ClientSession, origin_coords: tuple, dest_coords: tuple,
+                          states_gdf: gpd.GeoDataFrame, origin: str, destination: str) -> Dict[str, float]:
+        raise NotImplementedError
+
+class HereRoutingBackend(RoutingBackend):
+    """HERE Routing API v8 (truck, fast); uses state spans when returned, GIS polyline overlay otherwise"""
+    name = "here"
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    async def state_miles(self, session: aiohttp.ClientSession, origin_coords: tuple, dest_coords: tuple,
+                          states_gdf: gpd.GeoDataFrame, origin: str, destination: str) -> Dict[str, float]:
+        try:
+            origin_param = f"{origin_coords[0]},{origin_coords[1]}"
+            dest_param = f"{dest_coords[0]},{dest_coords[1]}"
+        except (IndexError, TypeError) as e:
+            logger.warning(f"Invalid coordinate format: origin={origin_coords}, dest={dest_coords}, error={e}")
+            return {}
+
+        # Past the quota budget an archived route answers without a request (same HERE geometry)
+        archive = get_route_archive()
+        if archive is not None and not get_here_quota_ledger().permits(here_request_priority.get()):
+            line_coords = archive.get(origin, destination)
+            if line_coords is not None:
+                return state_miles_from_lnglat(line_coords, states_gdf)
+        
+        params = {
+            **HERE_ROUTE_PARAMS,
+            "origin": origin_param,
+            "destination": dest_param,
+            "apiKey": self.api_key
+        }
+        
+        try:
+            status, body = await here_get(session, HERE_ROUTES_URL, params, timeout_s=15)
+            if status != 200:
+                logger.warning(f"HERE API HTTP {status}: {body[:200]}...")
+                return {}
+
+            data = json.loads(body)
+        except HereCircuitOpenError:
+            return {}  # Logged once when the circuit opened; Step 5 uses the geodesic fallback
+        except asyncio.TimeoutError as e:
+            logger.warning(f"HERE API timeout after 15s: {origin} → {destination}")
+            return {}
+        except Exception as e:
+            logger.warning(f"HERE API connection error: {e} | {origin} → {destination}")
+            return {}
+        
+        # Check if route was found and extract state spans
+        if not data.get("routes") or not data["routes"]:
+            logger.warning(f"HERE API no routes found. Full response: {data}")
+            return {}
+        
+        try:
+            route = data["routes"][0]
+            section = route["sections"][0]
+            archive_route(origin, destination, section.get("polyline"))
+            logger.info(f"🗺️ Route structure: spans={bool(section.get('spans'))}, polyline={bool(section.get('polyline'))}")
             
-                    # Validate decoded coordinates
-                    if not decoded_coords or len(decoded_coords) < 2:
-                        logger.warning(f"Insufficient decoded coordinates: {len(decoded_coords) if decoded_coords else 0}")
-                        return {}
-                    
-                    # Debug: Check first few coordinates
-                    logger.info(f"📍 First 3 HERE coords: {decoded_coords[:3]}")
-                    
-                    # HERE flexpolyline returns [lat, lng, elevation] tuples (elevation optional)
-                    # Convert to [(lng, lat)] for shapely (note: reversed order)
-                    line_coords = [(coord[1], coord[0]) for coord in decoded_coords]  # lng, lat
-                    
-                    # Debug: Check coordinate conversion
-                    logger.info(f"📍 First 3 converted coords: {line_coords[:3]}")
-                    
-                    # Validate coordinates before creating LineString
-                    invalid_coords = [(lng, lat) for lng, lat in line_coords if not (-180 <= lng <= 180 and -90 <= lat <= 90)]
-                    if invalid_coords:
-                        logger.error(f"INVALID COORDINATES found: {invalid_coords[:5]}... (showing first 5)")
-                        return {}
-                    
-                    route_line = LineString(line_coords)
-                    logger.info(f"🌍 LineString created with {len(line_coords)} points | Bounds: {route_line.bounds}")
-                    
-                    # Convert to GeoDataFrame with WGS84 CRS
-                    route_gdf = gpd.GeoDataFrame([1], geometry=[route_line], crs="EPSG:4326")
-                    logger.info(f"🗺️ GeoDataFrame created with CRS: EPSG:4326 | GDF bounds: {route_gdf.bounds}")
-                    
-                    # Reproject to match state boundaries CRS
-                    route_projected = route_gdf.to_crs(states_gdf.crs)
-                    logger.info(f"🗺️ Route reprojected to CRS: {states_gdf.crs} | Projected bounds: {route_projected.bounds}")
-                    
-                    # Find intersections with state boundaries
-                    logger.info(f"🗺️ Starting state intersection calculation with {len(states_gdf)} states")
-                    logger.info(f"🗺️ Route bounds: {route_projected.iloc[0].geometry.bounds}")
-                    logger.info(f"🗺️ States CRS: {states_gdf.crs}, Route CRS: {route_projected.crs}")
-                    
-                    intersection_count = 0
-                    for idx, state_row in states_gdf.iterrows():
-                        try:
-                            intersection = route_projected.iloc[0].geometry.intersection(state_row.geometry)
-                            
-                            if not intersection.is_empty:
-                                intersection_count += 1
-                                logger.info(f"✅ Intersection found with {state_row['STUSPS']}")
-                                # Calculate length of intersection in miles
-                                if hasattr(intersection, 'length'):
-                                    length_meters = intersection.length
-                                else:
-                                    # Handle multipart geometries
-                                    length_meters = sum(geom.length for geom in intersection.geoms if hasattr(geom, 'length'))
-                                
-                                miles = length_meters / 1609.34  # Convert to miles
+            # Use HERE API's built-in state spans if available (more accurate than GIS overlay)
+            state_miles = {}
+            
+            # Check if spans are available (preferred method)
+            if "spans" in section:
+                for span in section["spans"]:
+                    if span.get("stateCode"):
+                        state_abbr = span["stateCode"]
+                        length_meters = span.get("length", 0)
+                        miles = length_meters / 1609.34  # Convert meters to miles
+                        
+                        if miles >= 0.1:  # Only include significant distances
+                            if state_abbr in state_miles:
+                                state_miles[state_abbr] += miles
+                            else:
+                                state_miles[state_abbr] = miles
                                 
-                                if miles >= 0.1:  # Only include significant distances
-                                    state_abbr = state_row['STUSPS']  # State abbreviation
-                                    if state_abbr in state_miles:
-                                        state_miles[state_abbr] += miles
-                                    else:
-                                        state_miles[state_abbr] = miles
-                        except Exception as state_error:
-                            logger.warning(f"Error processing state {state_row.get('STUSPS', 'UNKNOWN')}: {state_error}")
-                    
-                    # Round all values
-                    state_miles = {state: round(miles, 1) for state, miles in state_miles.items()}
-                    logger.info(f"🎯 State miles calculated: {state_miles} (found {intersection_count} intersections)")
+                # Round all values and return
+                state_miles = {state: round(miles, 1) for state, miles in state_miles.items()}
+                await asyncio.sleep(0.01)  # Rate limiting
+                return state_miles
+            
+            # Fallback: Process polyline with GIS overlay if spans not available
+            elif "polyline" in section:
+                try:
+                    state_miles = state_miles_from_polyline(section["polyline"], states_gdf)
                     await asyncio.sleep(0.01)  # Rate limiting
                     return state_miles
                     
-                except ImportError:
-                    logger.debug("polyline library not available for GIS fallback")
-                    return {}
                 except Exception as gis_error:
-                    # Reduce warning spam - only log first few errors
-                    if not hasattr(calculate_state_miles_async, '_polyline_error_count'):
-                        calculate_state_miles_async._polyline_error_count = 0
-                    calculate_state_miles_async._polyline_error_count += 1
+                    # Reduce warning spam - only log the run's first few errors
+                    stats = current_step5_stats()
+                    stats.polyline_errors += 1
                     
-                    if calculate_state_miles_async._polyline_error_count <= 5:
-                        logger.warning(f"GIS polyline processing failed (#{calculate_state_miles_async._polyline_error_count}): {gis_error}")
-                    elif calculate_state_miles_async._polyline_error_count == 6:
+                    if stats.polyline_errors <= 5:
+                        logger.warning(f"GIS polyline processing failed (#{stats.polyline_errors}): {gis_error}")
+                    elif stats.polyline_errors == 6:
                         logger.info("Suppressing further polyline processing warnings...")
                     return {}
             
@@ -825,251 +2044,766 @@ async def calculate_state_miles_async(session: aiohttp.ClientSession, origin: st
             return {}
             
         except (KeyError, IndexError, ValueError) as e:
-            # Track errors with limited logging
-            if not hasattr(calculate_state_miles_async, '_error_count'):
-                calculate_state_miles_async._error_count = 0
-            calculate_state_miles_async._error_count += 1
+            # Track errors (per Step 5 run) with limited logging
+            stats = current_step5_stats()
+            stats.api_errors += 1
             
-            if calculate_state_miles_async._error_count <= 3 or calculate_state_miles_async._error_count % 100 == 0:
-                logger.warning(f"API error #{calculate_state_miles_async._error_count}: {origin} → {destination}")
+            if stats.api_errors <= 3 or stats.api_errors % 100 == 0:
+                logger.warning(f"API error #{stats.api_errors}: {origin} → {destination}")
             return {}
-        
+
+class LocalGraphRoutingBackend(RoutingBackend):
+    """
+    Offline router over a preprocessed road graph (contraction hierarchies, see road_router.py).
+    No network or HERE quota needed once locations are geocoded.
+    """
+    name = "local"
+
+    def __init__(self, graph_dir: Path = ROAD_GRAPH_DIR):
+        from road_router import RoadGraph
+
+        self.graph = RoadGraph.load(graph_dir)
+        logger.info(f"Local road graph loaded from {graph_dir}: {self.graph.num_nodes} nodes, {self.graph.num_edges} edges")
+
+    async def state_miles(self, session: aiohttp.ClientSession, origin_coords: tuple, dest_coords: tuple,
+                          states_gdf: gpd.GeoDataFrame, origin: str, destination: str) -> Dict[str, float]:
+        state_meters = self.graph.route_state_meters(origin_coords, dest_coords)
+        if not state_meters:
+            logger.warning(f"Local router found no route: {origin} → {destination}")
+            return {}
+
+        state_miles = {}
+        for state_abbr, length_meters in state_meters.items():
+            miles = length_meters / 1609.34  # Convert meters to miles
+            if miles >= 0.1:  # Only include significant distances
+                state_miles[state_abbr] = round(miles, 1)
+        return state_miles
+
+class ArchiveRoutingBackend(RoutingBackend):
+    """
+    Re-attribution from the route archive: archived HERE geometry overlaid on the current state
+    boundaries with the current rounding/threshold. No network; routes never archived return {}.
+    """
+    name = "archive"
+    needs_coords = False
+
+    def __init__(self, archive: Optional["RouteArchive"] = None):
+        self.archive = archive or RouteArchive()
+        logger.info(f"Route archive {self.archive.path}: {len(self.archive)} routes")
+
+    async def state_miles(self, session: aiohttp.ClientSession, origin_coords: tuple, dest_coords: tuple,
+                          states_gdf: gpd.GeoDataFrame, origin: str, destination: str) -> Dict[str, float]:
+        line_coords = self.archive.get(origin, destination)
+        if line_coords is None:
+            logger.warning(f"Route not in archive: {origin} → {destination}")
+            return {}
+        return state_miles_from_lnglat(line_coords, states_gdf)
+
+def make_routing_backend(name: str, api_key: Optional[str] = None) -> RoutingBackend:
+    """Create the Step 5 routing backend by name ('here', 'local' or 'archive')"""
+    if name == "here":
+        if not api_key:
+            raise RuntimeError("HERE routing backend requires a HERE API key")
+        return HereRoutingBackend(api_key)
+    if name == "local":
+        return LocalGraphRoutingBackend()
+    if name == "archive":
+        return ArchiveRoutingBackend()
+    raise ValueError(f"Unknown routing backend: {name!r} (expected 'here', 'local' or 'archive')")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Route Archive: compressed HERE route geometry for re-attribution without API calls
+# ──────────────────────────────────────────────────────────────────────────────
+
+class RouteArchive:
+    """
+    Decoded HERE route geometry in one SQLite file, keyed by route fingerprint (origin/destination
+    alias keys + HERE_ROUTE_PARAMS). Vertices are stored as 1e-5 degree integers (~1 m),
+    delta-encoded along the line and zlib-compressed: a few bytes per vertex.
+    """
+    SCALE = 1e5
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path or ROUTE_ARCHIVE_FILE)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS routes (
+                fingerprint TEXT PRIMARY KEY, origin TEXT, destination TEXT,
+                n_points INTEGER, geometry BLOB, recorded TEXT
+            )
+        """)
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    @staticmethod
+    def fingerprint(origin: str, destination: str) -> str:
+        key = json.dumps([location_alias_key(origin), location_alias_key(destination), HERE_ROUTE_PARAMS], sort_keys=True)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def encode(cls, line_coords: np.ndarray) -> bytes:
+        fixed = np.round(np.asarray(line_coords, dtype=np.float64) * cls.SCALE).astype(np.int32)
+        deltas = np.diff(fixed, axis=0, prepend=np.zeros((1, 2), dtype=np.int32))
+        return zlib.compress(deltas.astype("<i4").tobytes(), 6)
+
+    @classmethod
+    def decode(cls, blob: bytes, n_points: int) -> np.ndarray:
+        deltas = np.frombuffer(zlib.decompress(blob), dtype="<i4").reshape(n_points, 2)
+        return np.cumsum(deltas, axis=0, dtype=np.int64) / cls.SCALE
+
+    def put(self, origin: str, destination: str, line_coords: np.ndarray):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?)",
+            (self.fingerprint(origin, destination), origin, destination, len(line_coords),
+             self.encode(line_coords), datetime.now().isoformat(timespec="seconds")),
+        )
+
+    def __contains__(self, route: Tuple[str, str]) -> bool:
+        return self.conn.execute("SELECT 1 FROM routes WHERE fingerprint = ?",
+                                 (self.fingerprint(*route),)).fetchone() is not None
+
+    def sample(self, limit: int) -> List[np.ndarray]:
+        """Up to `limit` archived routes (lng/lat arrays), a fixed pseudo-random pick by fingerprint"""
+        rows = self.conn.execute("SELECT n_points, geometry FROM routes ORDER BY fingerprint LIMIT ?", (limit,)).fetchall()
+        return [self.decode(blob, n_points) for n_points, blob in rows]
+
+    def get(self, origin: str, destination: str) -> Optional[np.ndarray]:
+        """(n, 2) lng/lat route geometry, or None if the route was never archived"""
+        row = self.conn.execute("SELECT n_points, geometry FROM routes WHERE fingerprint = ?",
+                                (self.fingerprint(origin, destination),)).fetchone()
+        return None if row is None else self.decode(row[1], row[0])
+
+@functools.lru_cache(maxsize=1)
+def get_route_archive() -> Optional[RouteArchive]:
+    """The process's route archive (None when ROUTE_ARCHIVE is off)"""
+    return RouteArchive(ROUTE_ARCHIVE_FILE) if ROUTE_ARCHIVE else None
+
+def archive_route(origin: str, destination: str, encoded_polyline: Optional[str]):
+    """Store a HERE route's geometry; archiving problems never fail the route itself"""
+    if not encoded_polyline:
+        return
+    try:
+        archive = get_route_archive()
+        if archive is not None:
+            archive.put(origin, destination, decode_flexpolyline_np(encoded_polyline))
     except Exception as e:
-        logger.error(f"UNEXPECTED ERROR calculating route from {origin} to {destination}: {type(e).__name__}: {e}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.debug(f"Route archive write failed ({origin} → {destination}): {e}")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Offline Geodesic Fallback: estimate state miles when routing fails
+# ──────────────────────────────────────────────────────────────────────────────
+
+def geodesic_miles(origin_coords: tuple, dest_coords: tuple) -> float:
+    """WGS84 geodesic distance in miles between two (lat, lng) points"""
+    from pyproj import Geod
+
+    _, _, meters = Geod(ellps="WGS84").inv(float(origin_coords[1]), float(origin_coords[0]),
+                                           float(dest_coords[1]), float(dest_coords[0]))
+    return meters / 1609.34
+
+def estimate_state_miles_geodesic(origin_coords: tuple, dest_coords: tuple, states_gdf: gpd.GeoDataFrame,
+                                  circuity_factor: float) -> Dict[str, float]:
+    """
+    Densify the geodesic between the geocoded endpoints, split it by state boundaries
+    (spatial index lookup) and scale by the road-circuity factor.
+    Geodesic length is apportioned by each state's share of the projected line.
+    """
+    from pyproj import Geod
+
+    lat1, lng1 = float(origin_coords[0]), float(origin_coords[1])
+    lat2, lng2 = float(dest_coords[0]), float(dest_coords[1])
+    geod = Geod(ellps="WGS84")
+    _, _, total_meters = geod.inv(lng1, lat1, lng2, lat2)
+    if total_meters < 1:
         return {}
 
-# def calculate_great_circle_state_miles(origin_coords: tuple, dest_coords: tuple, states_gdf: gpd.GeoDataFrame) -> Dict[str, float]:
-#     """
-#     Calculate approximate state miles using great circle distance
-#     Used as fallback when HERE API fails
-#     """
-#     try:
-#         from shapely.geometry import Point, LineString
-#         import geopandas as gpd
-        
-#         origin_lat, origin_lng = origin_coords
-#         dest_lat, dest_lng = dest_coords
-        
-#         # Create straight line between origin and destination (WGS84 coordinates)
-#         line = LineString([(origin_lng, origin_lat), (dest_lng, dest_lat)])
-        
-#         # Convert to GeoSeries with proper CRS (WGS84)
-#         line_gdf = gpd.GeoSeries([line], crs="EPSG:4326")
-        
-#         # Reproject to match state boundaries CRS (NAD83/USA Contiguous - EPSG:5070)
-#         line_projected = line_gdf.to_crs(states_gdf.crs)[0]
-        
-#         # Calculate total distance
-#         def haversine_distance(lat1, lon1, lat2, lon2):
-#             R = 3959  # Earth's radius in miles
-#             lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-#             dlat = lat2 - lat1
-#             dlon = lon2 - lon1
-#             a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-#             c = 2 * math.asin(math.sqrt(a))
-#             return R * c
-        
-#         total_distance = haversine_distance(origin_lat, origin_lng, dest_lat, dest_lng)
-        
-#         if total_distance < 1:
-#             return {}
-        
-#         # Find state intersections using properly projected line
-#         state_miles = {}
-#         for _, state_row in states_gdf.iterrows():
-#             state_abbr = state_row.get('STUSPS', 'UNKNOWN')
-#             try:
-#                 if line_projected.intersects(state_row.geometry):
-#                     intersection = line_projected.intersection(state_row.geometry)
-#                     if hasattr(intersection, 'length') and intersection.length > 0:
-#                         # Convert projected length back to miles
-#                         miles_estimate = intersection.length / 1609.34  # meters to miles
-#                         if miles_estimate >= 1:
-#                             state_miles[state_abbr] = round(min(miles_estimate, total_distance), 2)
-#             except Exception:
-#                 continue
-        
-#         # Fallback for long routes with no intersections found
-#         if not state_miles and total_distance > 50:
-#             # Create points with proper CRS
-#             origin_point = Point(origin_lng, origin_lat)
-#             dest_point = Point(dest_lng, dest_lat)
-            
-#             # Convert to GeoSeries with WGS84 CRS
-#             origin_gdf = gpd.GeoSeries([origin_point], crs="EPSG:4326")
-#             dest_gdf = gpd.GeoSeries([dest_point], crs="EPSG:4326")
-            
-#             # Reproject to match state boundaries
-#             origin_projected = origin_gdf.to_crs(states_gdf.crs)[0]
-#             dest_projected = dest_gdf.to_crs(states_gdf.crs)[0]
-            
-#             origin_state = dest_state = None
-#             for _, state_row in states_gdf.iterrows():
-#                 state_abbr = state_row.get('STUSPS', 'UNKNOWN')
-#                 try:
-#                     if origin_projected.within(state_row.geometry):
-#                         origin_state = state_abbr
-#                     if dest_projected.within(state_row.geometry):
-#                         dest_state = state_abbr
-#                 except:
-#                     continue
-            
-#             if origin_state and dest_state and origin_state != dest_state:
-#                 state_miles[origin_state] = round(total_distance * 0.4, 2)
-#                 state_miles[dest_state] = round(total_distance * 0.4, 2)
-        
-#         return state_miles
-        
-#     except Exception:
-#         return {}
+    n_inner = int(total_meters // (GEODESIC_STEP_KM * 1000))
+    inner_points = geod.npts(lng1, lat1, lng2, lat2, n_inner) if n_inner else []
+    coords = np.array([(lng1, lat1), *inner_points, (lng2, lat2)], dtype=np.float64)
+    state_lengths = state_meters_along(project_lnglat(coords, states_gdf.crs), states_gdf)
+
+    projected_total = sum(state_lengths.values())
+    if projected_total <= 0:
+        return {}
+
+    state_miles = {}
+    for state_abbr, length in state_lengths.items():
+        miles = total_meters * (length / projected_total) * circuity_factor / 1609.34
+        if miles >= 0.1:  # Only include significant distances
+            state_miles[state_abbr] = round(miles, 1)
+    return state_miles
+
+class CircuityModel:
+    """
+    Road/geodesic distance ratio used by the geodesic fallback.
+    Learned as the median over recent successful routes unless CIRCUITY_FACTOR pins it.
+    Samples are appended to one SQLite table (CIRCUITY_STATS_FILE), so sharded workers and
+    concurrent runs add to the shared history instead of overwriting each other's.
+    """
+    MAX_SAMPLES = 5000
+    MIN_SAMPLES = 20
+    MIN_GEODESIC_MILES = 25  # Short hops are dominated by local street layout
+
+    def __init__(self, ratios: Optional[List[float]] = None, fixed_factor: Optional[float] = None,
+                 path: Optional[Path] = None):
+        self.ratios = list(ratios or [])[-self.MAX_SAMPLES:]
+        self.fixed_factor = fixed_factor
+        self.path = Path(path or CIRCUITY_STATS_FILE)
+        self.pending: List[float] = []  # Observed since load, not yet in the file
+
+    @staticmethod
+    def _connect(path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS ratios (id INTEGER PRIMARY KEY AUTOINCREMENT, ratio REAL)")
+        return conn
+
+    @classmethod
+    def load(cls, path: Optional[Path] = None) -> "CircuityModel":
+        fixed = float(CIRCUITY_FACTOR) if CIRCUITY_FACTOR else None
+        path = Path(path or CIRCUITY_STATS_FILE)
+        ratios = []
+        try:
+            conn = cls._connect(path)
+            try:
+                if LEGACY_CIRCUITY_STATS_FILE.exists() and not conn.execute("SELECT 1 FROM ratios LIMIT 1").fetchone():
+                    with open(LEGACY_CIRCUITY_STATS_FILE, 'r') as f:
+                        legacy = json.load(f).get("ratios", [])
+                    conn.executemany("INSERT INTO ratios (ratio) VALUES (?)", [(float(r),) for r in legacy])
+                    logger.info(f"Imported {len(legacy)} circuity samples from {LEGACY_CIRCUITY_STATS_FILE}")
+                ratios = [r for (r,) in conn.execute("SELECT ratio FROM ratios ORDER BY id DESC LIMIT ?", (cls.MAX_SAMPLES,))][::-1]
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"Error loading circuity stats: {e}")
+        return cls(ratios, fixed, path)
+
+    def save(self):
+        """Append this run's samples and trim the table to the newest MAX_SAMPLES"""
+        if not self.pending:
+            return
+        try:
+            conn = self._connect(self.path)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT INTO ratios (ratio) VALUES (?)", [(round(r, 4),) for r in self.pending])
+                conn.execute("DELETE FROM ratios WHERE id <= (SELECT MAX(id) FROM ratios) - ?", (self.MAX_SAMPLES,))
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+            self.pending.clear()
+        except Exception as e:
+            logger.warning(f"Error saving circuity stats: {e}")
+
+    def observe(self, route_miles: float, direct_miles: float):
+        if direct_miles < self.MIN_GEODESIC_MILES or route_miles <= 0:
+            return
+        ratio = min(max(route_miles / direct_miles, 1.0), 3.0)
+        self.ratios.append(ratio)
+        self.pending.append(ratio)
+        if len(self.ratios) > 2 * self.MAX_SAMPLES:
+            self.ratios = self.ratios[-self.MAX_SAMPLES:]
+
+    @property
+    def factor(self) -> float:
+        if self.fixed_factor:
+            return self.fixed_factor
+        if len(self.ratios) < self.MIN_SAMPLES:
+            return DEFAULT_CIRCUITY_FACTOR
+        return float(np.median(self.ratios[-self.MAX_SAMPLES:]))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Step 5 Output: columnar state-miles builder
+# ──────────────────────────────────────────────────────────────────────────────
+
+# Row status in Step 5 output (Miles is numeric; NaN on error rows)
+STATUS_OK = "OK"
+STATUS_ESTIMATED = "ESTIMATED"  # Offline geodesic fallback
+STATUS_GEOCODE_ERR = "GEOCODE_ERR"  # Route failed; handle manually per feedback.md
+# Pre-flight rejections (see preflight_statuses): never geocoded or routed
+STATUS_INVALID_CITY = "INVALID_CITY"  # Empty or placeholder city
+STATUS_INVALID_STATE = "INVALID_STATE"  # State code not in STATE_MAPPING
+STATUS_SAME_LOCATION = "SAME_LOCATION"  # Origin equals destination after chaining
+STATUS_OUT_OF_BOUNDS = "OUT_OF_BOUNDS"  # Cached coordinates outside the contiguous US
+RESULT_STATUSES = [STATUS_OK, STATUS_ESTIMATED, STATUS_GEOCODE_ERR,
+                   STATUS_INVALID_CITY, STATUS_INVALID_STATE, STATUS_SAME_LOCATION, STATUS_OUT_OF_BOUNDS]
+RETRYABLE_STATUSES = [STATUS_ESTIMATED, STATUS_GEOCODE_ERR]  # Degraded by HERE failures/outages; a rerun may route them
+ERROR_STATUSES = [STATUS_GEOCODE_ERR, STATUS_INVALID_CITY, STATUS_INVALID_STATE, STATUS_SAME_LOCATION, STATUS_OUT_OF_BOUNDS]  # ERROR rows, no miles
+
+# Load table column → Step 5 output column (joined once per output row)
+STATE_MILES_LOAD_COLUMNS = {
+    "Company": "Company", "Ref": "Ref No", "Load": "Load", "Trip": "Trip",
+    "Truck": "Truck", "Trailer": "Trailer", "PU": "PU Date F", "DEL": "Del Date F",
+}
+
+class StateMilesBuilder:
+    """
+    Columnar Step 5 output: load indices, state codes, miles and status kept in typed arrays
+    and joined back to the load table once in to_frame() (instead of one dict per state row).
+    """
+
+    def __init__(self):
+        self.state_codes: Dict[str, int] = {}  # state abbreviation (or "ERROR") → categorical code
+        self._load_idx: List[np.ndarray] = []
+        self._state: List[np.ndarray] = []
+        self._miles: List[np.ndarray] = []
+        self._status: List[np.ndarray] = []
+
+    def _state_code(self, state: str) -> int:
+        return self.state_codes.setdefault(state, len(self.state_codes))
+
+    def add(self, load_indices: np.ndarray, state_miles: Dict[str, float], status: str):
+        """Record one route result for every load sharing it; empty state_miles → one ERROR row per load"""
+        load_indices = np.asarray(load_indices, dtype=np.int64)
+        if state_miles:
+            codes = np.fromiter((self._state_code(state) for state in state_miles), dtype=np.int16, count=len(state_miles))
+            miles = np.fromiter(state_miles.values(), dtype=np.float64, count=len(state_miles))
+        else:
+            codes = np.array([self._state_code("ERROR")], dtype=np.int16)
+            miles = np.array([np.nan])
+        n_loads, n_states = len(load_indices), len(codes)
+        self._load_idx.append(np.repeat(load_indices, n_states))
+        self._state.append(np.tile(codes, n_loads))
+        self._miles.append(np.tile(miles, n_loads))
+        self._status.append(np.full(n_loads * n_states, RESULT_STATUSES.index(status), dtype=np.int8))
+
+    def row_loads(self) -> np.ndarray:
+        """Load position (in `loads`) of each to_frame() row, in row order"""
+        return np.sort(np.concatenate(self._load_idx), kind="stable") if self._load_idx else np.empty(0, dtype=np.int64)
+
+    def to_frame(self, loads: pd.DataFrame, keep_index: bool = False) -> pd.DataFrame:
+        """
+        Join the collected columns to `loads` (positional indices), ordered by load.
+        keep_index=True labels each row with its load's index in `loads` (sharded merge).
+        """
+        def concat(chunks: List[np.ndarray], dtype) -> np.ndarray:
+            return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+        load_idx = concat(self._load_idx, np.int64)
+        order = np.argsort(load_idx, kind="stable")  # Keep state order within each load
+        frame = (loads[list(STATE_MILES_LOAD_COLUMNS)].iloc[load_idx[order]]
+                 .rename(columns=STATE_MILES_LOAD_COLUMNS).reset_index(drop=True))
+        frame["State"] = pd.Categorical.from_codes(concat(self._state, np.int16)[order], categories=list(self.state_codes))
+        frame["Miles"] = concat(self._miles, np.float64)[order]
+        frame["Status"] = pd.Categorical.from_codes(concat(self._status, np.int8)[order], categories=RESULT_STATUSES)
+        if keep_index:
+            frame.index = loads.index[load_idx[order]]
+        return frame
+
+class Step5Stats:
+    """
+    Counters of one step5_stream run. Route tasks reach it through step5_run_stats, so concurrent
+    runs (batch workbooks, app sessions) each report their own fallbacks, API errors, quota
+    refusals and route simplification.
+    """
+
+    def __init__(self):
+        self.fallbacks = 0  # Geodesic fallback attempts
+        self.api_errors = 0  # Unparseable HERE route responses
+        self.quota_refused = 0  # Requests kept off HERE by the quota budget
+        self.simplified_routes = 0
+        self.vertices_in = 0
+        self.vertices_out = 0
+        self.length_in_m = 0.0
+        self.length_out_m = 0.0
+        self.breaker_trips: Dict[str, int] = {}  # HERE endpoint → circuit openings caused by this run's requests
+        self.breaker_rejected: Dict[str, int] = {}  # HERE endpoint → this run's requests failed fast by an open circuit
+        self.hedge_requests = 0  # HERE GETs sent through the hedger; the hedge budget is a fraction of these
+        self.hedges = 0
+        self.hedge_wins = 0  # Hedges that answered before the original request
+        self.polyline_errors = 0  # HERE routes whose polyline could not be split by state
+
+step5_run_stats: contextvars.ContextVar = contextvars.ContextVar("step5_run_stats", default=None)
+
+def current_step5_stats() -> Step5Stats:
+    """The running step5_stream's counters (a throwaway instance outside a run)"""
+    stats = step5_run_stats.get()
+    return stats if stats is not None else Step5Stats()
+
+class Step5Batch:
+    """
+    One streamed Step 5 batch: result rows for the loads whose routes just finished (same columns
+    as step5_calculate_mileage_concurrent) plus progress over the whole run.
+    load_positions gives each row's load position in the input frame (for re-ordering); stats are
+    the run's counters so far (final on the last batch).
+    """
 
-async def step5_calculate_mileage_concurrent(pcs: pd.DataFrame, states_gdf: gpd.GeoDataFrame, 
-                                           api_key: str, max_concurrent: int = 15) -> pd.DataFrame:
+    def __init__(self, frame: pd.DataFrame, load_positions: np.ndarray, loads_done: int, loads_total: int,
+                 failed_loads: int, routes_done: int, routes_total: int, elapsed_s: float,
+                 stats: Optional[Step5Stats] = None):
+        self.frame = frame
+        self.load_positions = load_positions
+        self.loads_done = loads_done
+        self.loads_total = loads_total
+        self.failed_loads = failed_loads
+        self.routes_done = routes_done
+        self.routes_total = routes_total
+        self.elapsed_s = elapsed_s
+        self.stats = stats if stats is not None else Step5Stats()
+
+    @property
+    def done(self) -> bool:
+        return self.routes_done == self.routes_total
+
+    @property
+    def eta_s(self) -> float:
+        """Remaining seconds at the average pace so far"""
+        if not self.routes_done:
+            return float("nan")
+        return self.elapsed_s / self.routes_done * (self.routes_total - self.routes_done)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Pre-flight Gate: loads that cannot be routed get their status before any request
+# ──────────────────────────────────────────────────────────────────────────────
+
+PLACEHOLDER_CITIES = {"NAN", "NONE", "NULL", "N A", "NA", "TBD", "TBA", "UNKNOWN", "UNK", "TEST", "XXX", "CITY"}
+CONUS_BBOX_LNGLAT = (-125.0, 24.3, -66.8, 49.5)  # min lng, min lat, max lng, max lat (contiguous US, small margin)
+
+def _placeholder_city_mask(cities: pd.Series) -> np.ndarray:
+    """Per row: the cleaned city is empty, has no letters or is a placeholder (checked once per distinct value)"""
+    codes, uniques = pd.factorize(cities.astype(str))
+    cleaned = pd.Series([clean_location_name(city) for city in uniques], dtype=object).str.upper()
+    letters = cleaned.str.replace(r"[^A-Z]+", " ", regex=True).str.strip()
+    bad = (letters == "") | letters.isin(PLACEHOLDER_CITIES)
+    return bad.to_numpy(dtype=bool)[codes]
+
+def preflight_statuses(pcs: pd.DataFrame, index: LocationIndex, origin_ids: np.ndarray, dest_ids: np.ndarray,
+                       location_coords: dict) -> np.ndarray:
     """
-    Phase 5: Calculate mileage for each route segment (following plan.md Step 5.1 & 5.2)
-    Uses concurrent async processing for better performance
+    Vectorized data-quality gate between Step 3 and the routing pool. Returns per load the code
+    (into RESULT_STATUSES) of the first problem found, or -1 for loads that go on to routing:
+    INVALID_STATE, INVALID_CITY, SAME_LOCATION (same canonical location after chaining), then
+    OUT_OF_BOUNDS (a cached coordinate outside CONUS_BBOX_LNGLAT - usually a bad geocode, but
+    also AK/HI, which have no state boundaries to attribute against).
+    """
+    valid_states = list(STATE_MAPPING)
+    bad_state = ~(pcs["Ship St"].astype(str).isin(valid_states) & pcs["Cons St"].astype(str).isin(valid_states)).to_numpy()
+    bad_city = _placeholder_city_mask(pcs["Ship City"]) | _placeholder_city_mask(pcs["Cons City"])
+
+    # Bounds per distinct location, then per load
+    coords = np.full((len(index), 2), np.nan)
+    for loc_id, name in enumerate(index.names):
+        cached = location_coords.get(name)
+        if cached:
+            coords[loc_id] = cached[:2]
+    min_lng, min_lat, max_lng, max_lat = CONUS_BBOX_LNGLAT
+    lat, lng = coords[:, 0], coords[:, 1]
+    outside = ~np.isnan(lat) & ~((lat >= min_lat) & (lat <= max_lat) & (lng >= min_lng) & (lng <= max_lng))
+
+    statuses = np.full(len(pcs), -1, dtype=np.int8)
+    for status, mask in reversed([
+        (STATUS_INVALID_STATE, bad_state),
+        (STATUS_INVALID_CITY, bad_city),
+        (STATUS_SAME_LOCATION, origin_ids == dest_ids),
+        (STATUS_OUT_OF_BOUNDS, outside[origin_ids] | outside[dest_ids]),
+    ]):
+        statuses[mask] = RESULT_STATUSES.index(status)
+    return statuses
+
+async def step5_stream(pcs: pd.DataFrame, states_gdf: gpd.GeoDataFrame, api_key: str, max_concurrent: int = 15,
+                       backend: Optional[RoutingBackend] = None, location_coords: Optional[dict] = None,
+                       route_cache: Optional[dict] = None, session: Optional[aiohttp.ClientSession] = None,
+                       keep_load_index: bool = False, batch_size: int = 25):
+    """
+    Phase 5 as an async generator: yields a Step5Batch each time batch_size distinct routes have
+    finished (in completion order), so callers can show partial results, write incrementally or
+    start downstream work early. step5_calculate_mileage_concurrent collects the whole stream.
+    Routing goes through `backend` (defaults to HERE; see make_routing_backend)
+    Locations are canonicalized to integer ids first, so each distinct origin/destination
+    pair is routed once no matter how many loads share it.
+    Batch runs pass the same location_coords / route_cache (and HTTP session) to every call so
+    geocodes and routes are shared across reporting periods and workbooks; a route another
+    concurrent call is already fetching is awaited instead of requested twice.
     """
-    logger.info(f"Phase 5: Calculating state-by-state mileage (concurrent with max {max_concurrent} requests)...")
+    if backend is None:
+        backend = HereRoutingBackend(api_key)
+
+    logger.info(f"Phase 5: Calculating state-by-state mileage (concurrent with max {max_concurrent} requests, backend: {backend.name})...")
     
-    location_coords = load_geocoding_cache()
+    if location_coords is None:
+        location_coords = load_geocoding_cache()
     logger.info(f"Using {len(location_coords)} cached coordinates for mileage calculation")
     
-    total_routes = len(pcs)
+    circuity = CircuityModel.load()
+    stats = Step5Stats()
+    logger.info(f"Geodesic fallback circuity factor: {circuity.factor:.3f} ({len(circuity.ratios)} learned samples)")
+    
+    # Canonicalize Ship/Cons locations once (vectorized over distinct values) → integer id pairs
+    index = LocationIndex()
+    origin_ids = index.encode(pcs["Ship City"], pcs["Ship St"])
+    dest_ids = index.encode(pcs["Cons City"], pcs["Cons St"])
+    shared = index.share_coords(location_coords)
+
+    # Pre-flight gate: rejected loads get their status up front; only clean loads reach the routing pool
+    preflight = preflight_statuses(pcs, index, origin_ids, dest_ids, location_coords)
+    clean = preflight < 0
+    rejected = np.flatnonzero(~clean)
+    pair_codes = np.full(len(pcs), -1, dtype=np.int64)
+    pair_codes[clean], pair_keys = pd.factorize(origin_ids[clean].astype(np.int64) * len(index) + dest_ids[clean])
+    pair_origins = (pair_keys // len(index)).astype(np.int32)
+    pair_dests = (pair_keys % len(index)).astype(np.int32)
+    logger.info(f"Canonicalized {len(index)} locations ({shared} coordinates shared across spelling variants); "
+                f"{len(pair_keys)} distinct routes for {len(pcs) - len(rejected)} loads")
+    if len(rejected):
+        loads = pcs.iloc[rejected]
+        rejects = pd.DataFrame({
+            "Load": loads["Load"].to_numpy(),
+            "Origin": (loads["Ship City"].astype(str) + ", " + loads["Ship St"].astype(str)).to_numpy(),
+            "Destination": (loads["Cons City"].astype(str) + ", " + loads["Cons St"].astype(str)).to_numpy(),
+            "Status": np.asarray(RESULT_STATUSES)[preflight[rejected]],
+        })
+        reject_file = debug_path("phase5_preflight_rejects.csv")
+        rejects.to_csv(reject_file, index=False)
+        status_counts = rejects["Status"].value_counts()
+        logger.warning(f"Pre-flight gate: {len(rejected)} loads not routed "
+                       f"({', '.join(f'{status} {count}' for status, count in status_counts.items())}) - listed in {reject_file}")
+
+    # Consult the quota ledger before any request (upper bound: every uncached endpoint and, on HERE, every route)
+    ledger = get_here_quota_ledger()
+    if HERE_CASSETTE != "replay":
+        endpoints = np.unique(np.concatenate([pair_origins, pair_dests]))
+        planned_calls = sum(index.names[loc_id] not in location_coords for loc_id in endpoints)
+        if backend.name == "here":
+            planned_calls += len(pair_keys)
+        log_here_quota(ledger, planned_calls)
+
     start_time = time.time()
     semaphore = asyncio.Semaphore(max_concurrent)
     
-    async def process_single_route(session: aiohttp.ClientSession, idx: int, row: pd.Series, route_num: int) -> tuple:
-        """Process a single route and return mileage records"""
+    async def process_route_pair(session: aiohttp.ClientSession, origin_id: int, dest_id: int) -> tuple:
+        """
+        Route one distinct origin/destination id pair; returns (state miles, estimated flag,
+        HERE endpoints whose open circuit breaker affected the route)
+        """
+        origin, destination = index.names[origin_id], index.names[dest_id]
+        if route_cache is None:
+            return await route_pair(session, origin, destination)
+
+        route_key = (location_alias_key(origin), location_alias_key(destination))
+        cached = route_cache.get(route_key)
+        if cached is not None:
+            # Finished result, or a future for a route another concurrent call is fetching
+            return await cached if isinstance(cached, asyncio.Future) else cached
+
+        in_flight = asyncio.get_running_loop().create_future()
+        route_cache[route_key] = in_flight
+        result = ({}, False, ())
+        try:
+            result = await route_pair(session, origin, destination)
+        finally:
+            if result[0] and not result[1] and not result[2]:
+                route_cache[route_key] = result
+            else:
+                del route_cache[route_key]  # Failures and geodesic estimates (transient HERE errors, open circuit) are retried by later calls
+            in_flight.set_result(result)
+        return result
+
+    async def route_pair(session: aiohttp.ClientSession, origin: str, destination: str) -> tuple:
         async with semaphore:
+            estimated = False
+            
+            # Simple route calculation - no CA consolidation (removed per corrected requirements)
+            rejections = set()
+            token = here_breaker_rejections.set(rejections)
             try:
-                route_rows = []
-                
-                # Format locations with cleaning (strip warehouse IDs per feedback)
-                ship_state = STATE_MAPPING.get(row['Ship St'], row['Ship St'])
-                cons_state = STATE_MAPPING.get(row['Cons St'], row['Cons St'])
-                
-                # Clean city names to remove warehouse IDs and building numbers
-                clean_ship_city = clean_location_name(row['Ship City'])
-                clean_cons_city = clean_location_name(row['Cons City'])
-                
-                # Convert state abbreviations to full names for cache lookup compatibility
-                ship_state_full = STATE_MAPPING.get(row['Ship St'], row['Ship St'])
-                cons_state_full = STATE_MAPPING.get(row['Cons St'], row['Cons St'])
-                
-                # Format locations to match geocoding cache format ("CITY, State, USA")
-                origin = f"{clean_ship_city}, {ship_state_full}, USA"
-                destination = f"{clean_cons_city}, {cons_state_full}, USA"
-                
-                # Skip same-city routes (these are local deliveries, not interstate)
-                if clean_ship_city.upper() == clean_cons_city.upper() and row['Ship St'] == row['Cons St']:
-                    logger.debug(f"Skipping same-city route: {origin} → {destination}")
-                    # Return empty result - no interstate mileage needed
-                    return [], True  # Mark as successful but no miles
-                
-                route_had_miles = False
-                error_reason = None
-                
-                # Simple route calculation - no CA consolidation (removed per corrected requirements)
-                interstate_miles = await calculate_state_miles_async(session, origin, destination, states_gdf, api_key, location_coords)
-                
-                # If HERE API failed, set error per feedback.md requirements
-                if not interstate_miles:
-                    logger.debug(f"API returned empty result for {origin} → {destination}")
-                    interstate_miles = {}  # Initialize empty dict to prevent iteration errors
-                    error_reason = "GEOCODE_ERR"
-                
-                # Add interstate miles to output
-                for state, miles in interstate_miles.items():
-                    route_had_miles = True
-                    route_rows.append({
-                        "Company": row["Company"],  # Use actual company from data
-                        "Ref No": row["Ref"],
-                        "Load": row["Load"],
-                        "Trip": row["Trip"],
-                        "Truck": row["Truck"],
-                        "Trailer": row["Trailer"],
-                        "PU Date F": row["PU"],
-                        "Del Date F": row["DEL"],
-                        "State": state,
-                        "Miles": miles
-                    })
-                
-                # If no mileage was calculated, add an ERROR record
-                if not route_had_miles:
-                    logger.warning(f"GEOCODE_ERR: Load {row['Load']} failed route calculation ({origin} → {destination})")
-                    
-                    route_rows.append({
-                        "Company": row["Company"],
-                        "Ref No": row["Ref"],
-                        "Load": row["Load"],
-                        "Trip": row["Trip"],
-                        "Truck": row["Truck"],
-                        "Trailer": row["Trailer"],
-                        "PU Date F": row["PU"],
-                        "Del Date F": row["DEL"],
-                        "State": "ERROR",
-                        "Miles": "GEOCODE_ERR"
-                    })
-                
-                return route_rows, route_had_miles
-                
-            except Exception as e:
-                logger.warning(f"GEOCODE_ERR: Load {row['Load']} exception: {str(e)[:100]}")
-                # Always return an ERROR record even for exceptions
-                error_record = [{
-                    "Company": row["Company"],
-                    "Ref No": row["Ref"],
-                    "Load": row["Load"],
-                    "Trip": row["Trip"],
-                    "Truck": row["Truck"],
-                    "Trailer": row["Trailer"],
-                    "PU Date F": row["PU"],
-                    "Del Date F": row["DEL"],
-                    "State": "ERROR",
-                    "Miles": "GEOCODE_ERR"
-                }]
-                return error_record, False
-    
-    # Process routes concurrently
-    connector = aiohttp.TCPConnector(limit=max_concurrent * 2, limit_per_host=max_concurrent)
-    timeout = aiohttp.ClientTimeout(total=30)
-    
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        tasks = [process_single_route(session, idx, row, i + 1) for i, (idx, row) in enumerate(pcs.iterrows())]
-        
-        output_rows = []
-        successful_routes = failed_routes = 0
-        batch_size = 25  # Reduced batch size for better progress reporting
-        
-        for i in range(0, len(tasks), batch_size):
-            batch_results = await asyncio.gather(*tasks[i:i + batch_size], return_exceptions=True)
+                interstate_miles = await calculate_state_miles_async(session, origin, destination, states_gdf, api_key, location_coords, backend)
+            finally:
+                here_breaker_rejections.reset(token)
+            origin_coords = location_coords.get(origin)
+            dest_coords = location_coords.get(destination)
             
-            for result in batch_results:
-                if isinstance(result, Exception):
-                    failed_routes += 1
-                else:
-                    route_rows, route_had_miles = result
-                    output_rows.extend(route_rows)
-                    if route_had_miles:
-                        successful_routes += 1
-                    else:
-                        failed_routes += 1
+            if interstate_miles and origin_coords and dest_coords:
+                # Learn road circuity from successful routes for the offline fallback
+                circuity.observe(sum(interstate_miles.values()), geodesic_miles(origin_coords, dest_coords))
+            elif not interstate_miles and origin_coords and dest_coords and backend.name != "archive":
+                # Routing failed but both ends are geocoded: offline geodesic estimate, flagged as such
+                # (not when re-attributing: a route missing from the archive must not replace real HERE miles)
+                interstate_miles = estimate_state_miles_geodesic(origin_coords, dest_coords, states_gdf, circuity.factor)
+                estimated = bool(interstate_miles)
+                stats.fallbacks += 1
+                if estimated:
+                    logger.warning(f"ESTIMATED: routing failed, geodesic fallback used ({origin} → {destination})")
             
-            # Progress update (more frequent reporting)
-            completed = min(i + batch_size, len(tasks))
-            if completed % 50 == 0 or completed == len(tasks):
-                elapsed = time.time() - start_time
-                avg_time = elapsed / completed if completed > 0 else 0
-                remaining = (len(tasks) - completed) * avg_time
-                success_rate = (successful_routes / completed) * 100 if completed > 0 else 0
-                fallback_count = getattr(step5_calculate_mileage_concurrent, '_fallback_count', 0)
-                logger.info(f"Progress: {completed}/{len(tasks)} ({completed/len(tasks)*100:.1f}%) - Success: {success_rate:.1f}% - Fallbacks: {fallback_count} - ETA: {remaining/60:.1f} min")
-    
-    # Final statistics with error breakdowns
-    result_df = pd.DataFrame(output_rows)
+            if not interstate_miles:
+                logger.debug(f"API returned empty result for {origin} → {destination}")
+            return interstate_miles or {}, estimated, tuple(sorted(rejections))
+
+    async def numbered_route_pair(session: aiohttp.ClientSession, pair_code: int) -> tuple:
+        step5_run_stats.set(stats)  # This task's context only
+        # Quota priority (per task context): routes carrying many loads keep going to HERE past the soft budget
+        if bounds[pair_code + 1] - bounds[pair_code] >= HERE_QUOTA_PRIORITY_LOADS:
+            here_request_priority.set("high")
+        try:
+            return pair_code, await process_route_pair(session, int(pair_origins[pair_code]), int(pair_dests[pair_code]))
+        except Exception as e:
+            logger.warning(f"Route {index.names[pair_origins[pair_code]]} → {index.names[pair_dests[pair_code]]} exception: {str(e)[:100]}")
+            return pair_code, ({}, False, ())
+
+    # Loads per distinct route (positions into pcs)
+    order = np.argsort(pair_codes, kind="stable")
+    bounds = np.searchsorted(pair_codes[order], np.arange(len(pair_keys) + 1))
+    loads_done = failed_loads = routes_done = failed_pairs = 0
+    breaker_pairs = []
+
+    def build_batch(finished: List[tuple], rejected_loads: Optional[np.ndarray] = None) -> Step5Batch:
+        """
+        Expand finished per-route results (or pre-flight rejected loads, one ERROR row each)
+        onto their loads (columnar, joined to the load table once)
+        """
+        nonlocal loads_done, failed_loads, routes_done, failed_pairs
+        builder = StateMilesBuilder()
+        if rejected_loads is not None:
+            for status_code in np.unique(preflight[rejected_loads]):
+                builder.add(rejected_loads[preflight[rejected_loads] == status_code], {}, RESULT_STATUSES[status_code])
+            loads_done += len(rejected_loads)
+            failed_loads += len(rejected_loads)
+        for pair_code, (interstate_miles, estimated, tripped) in finished:
+            load_indices = order[bounds[pair_code]:bounds[pair_code + 1]]
+            loads_done += len(load_indices)
+            if tripped:
+                breaker_pairs.append((pair_code, load_indices, tripped, bool(interstate_miles)))
+            if interstate_miles:
+                builder.add(load_indices, interstate_miles, STATUS_ESTIMATED if estimated else STATUS_OK)
+            else:
+                # If HERE API failed, add an ERROR record per feedback.md requirements
+                failed_loads += len(load_indices)
+                failed_pairs += 1
+                origin = index.names[pair_origins[pair_code]]
+                destination = index.names[pair_dests[pair_code]]
+                loads = pcs["Load"].iloc[load_indices].tolist()
+                logger.warning(f"GEOCODE_ERR: Load {', '.join(map(str, loads))} failed route calculation ({origin} → {destination})")
+                builder.add(load_indices, {}, STATUS_GEOCODE_ERR)
+        previous = routes_done
+        routes_done += len(finished)
+
+        batch = Step5Batch(builder.to_frame(pcs, keep_index=keep_load_index), builder.row_loads(), loads_done, len(pcs),
+                           failed_loads, routes_done, len(pair_keys), time.time() - start_time, stats)
+
+        # Progress update (every 50 routes)
+        if routes_done and (routes_done // 50 > previous // 50 or batch.done):
+            success_rate = (routes_done - failed_pairs) / routes_done * 100
+            logger.info(f"Progress: {routes_done}/{len(pair_keys)} routes ({routes_done/len(pair_keys)*100:.1f}%) - Success: {success_rate:.1f}% - Fallbacks: {stats.fallbacks} - ETA: {batch.eta_s/60:.1f} min")
+        return batch
+
+    if len(rejected):
+        yield build_batch([], rejected)
+
+    # Process distinct routes concurrently (on the caller's shared session if one was passed)
+    if session is None:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=max_concurrent * 2, limit_per_host=max_concurrent)
+        session_context = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+    else:
+        session_context = contextlib.nullcontext(session)
+
+    async with session_context as session:
+        tasks = [asyncio.ensure_future(numbered_route_pair(session, pair_code)) for pair_code in range(len(pair_keys))]
+        try:
+            finished = []
+            for next_done in asyncio.as_completed(tasks):
+                finished.append(await next_done)
+                if len(finished) >= batch_size:
+                    yield build_batch(finished)
+                    finished = []
+            if finished:
+                yield build_batch(finished)
+        finally:
+            for task in tasks:
+                task.cancel()  # Consumer stopped early: no orphaned requests
+
+    circuity.save()
+    get_here_latency_stats().save()
+
+    logger.info(f"Phase 5 routing finished: {len(pair_keys)} distinct origin/destination pairs in {(time.time() - start_time)/60:.1f} minutes")
+    logger.info(f"  • Failed routes: {failed_pairs}")
+    logger.info(f"  • Pre-flight rejected loads: {len(rejected)}")
+    logger.info(f"  • API errors: {stats.api_errors}")
+    if stats.polyline_errors:
+        logger.info(f"  • Polylines that could not be split by state: {stats.polyline_errors}")
+    logger.info(f"  • Geodesic fallback attempts: {stats.fallbacks} (circuity {circuity.factor:.3f})")
+    if stats.simplified_routes:
+        length_delta_m = stats.length_out_m - stats.length_in_m
+        logger.info(f"  • Simplified routes: {stats.simplified_routes}, {stats.vertices_in:,} → {stats.vertices_out:,} vertices "
+                    f"({stats.vertices_out / stats.vertices_in * 100:.1f}%), length delta {length_delta_m / 1609.34:+.2f} mi "
+                    f"({length_delta_m / stats.length_in_m * 100:+.3f}%)")
+    if breaker_pairs:
+        breaker_loads = pd.DataFrame([
+            {
+                "Load": load,
+                "Origin": index.names[pair_origins[pair_code]],
+                "Destination": index.names[pair_dests[pair_code]],
+                "Circuit": ", ".join(tripped),
+                "Status": STATUS_ESTIMATED if routed else STATUS_GEOCODE_ERR,
+            }
+            for pair_code, load_indices, tripped, routed in sorted(breaker_pairs, key=lambda pair: pair[0])
+            for load in pcs["Load"].iloc[load_indices]
+        ])
+        breaker_file = debug_path("phase5_circuit_breaker_loads.csv")
+        breaker_loads.to_csv(breaker_file, index=False)
+        status_counts = breaker_loads["Status"].value_counts()
+        logger.warning(f"  • Loads affected by an open HERE circuit or the quota budget: {len(breaker_loads)} "
+                       f"({status_counts.get(STATUS_ESTIMATED, 0)} estimated, {status_counts.get(STATUS_GEOCODE_ERR, 0)} GEOCODE_ERR) - listed in {breaker_file}")
+        if len(breaker_loads) <= 50:
+            logger.warning(f"    - Loads: {', '.join(map(str, breaker_loads['Load']))}")
+    for endpoint, breaker in here_breakers.items():
+        trips, rejected = stats.breaker_trips.get(endpoint, 0), stats.breaker_rejected.get(endpoint, 0)
+        if trips or rejected:
+            logger.info(f"  • HERE {endpoint} circuit: opened {trips}x, {rejected} requests failed fast (now {breaker.state})")
+    if stats.hedges:
+        logger.info(f"  • Hedged HERE requests: {stats.hedges}/{stats.hedge_requests} ({stats.hedge_wins} answered first by the hedge)")
+    ledger.flush()
+    if ledger.monthly_quota or ledger.daily_quota:
+        logger.info(f"  • HERE quota: {ledger.month_used} requests this month, {ledger.day_used} today "
+                    f"({ledger.used_pct():.1f}% of budget, level {ledger.level()}); {stats.quota_refused} requests kept off HERE by the budget")
+
+def collect_step5_batches(pcs: pd.DataFrame, batches: List[Step5Batch], keep_load_index: bool = False) -> pd.DataFrame:
+    """Streamed Step 5 batches → the single result frame, ordered by load as if computed in one pass"""
+    if not batches:
+        return StateMilesBuilder().to_frame(pcs, keep_index=keep_load_index)
+    frame = pd.concat([batch.frame for batch in batches], ignore_index=not keep_load_index)
+    order = np.argsort(np.concatenate([batch.load_positions for batch in batches]), kind="stable")
+    frame = frame.take(order)
+    if not keep_load_index:
+        frame = frame.reset_index(drop=True)
+    # Per-batch State categories differ; rebuild them in first-seen order (as a single builder would)
+    states = frame["State"].astype(str)
+    frame["State"] = pd.Categorical(states, categories=pd.unique(states))
+    return frame
+
+async def step5_calculate_mileage_concurrent(pcs: pd.DataFrame, states_gdf: gpd.GeoDataFrame, 
+                                           api_key: str, max_concurrent: int = 15,
+                                           backend: Optional[RoutingBackend] = None,
+                                           location_coords: Optional[dict] = None,
+                                           route_cache: Optional[dict] = None,
+                                           session: Optional[aiohttp.ClientSession] = None,
+                                           keep_load_index: bool = False,
+                                           update_rollups: bool = False) -> pd.DataFrame:
+    """
+    Phase 5: Calculate mileage for each route segment (following plan.md Step 5.1 & 5.2)
+    Uses concurrent async processing for better performance
+    Collects step5_stream (see there for backend, location and route cache sharing) into one DataFrame.
+    With update_rollups each batch is also folded into the IFTA rollups; only real runs set it,
+    so validation and ad-hoc subsets leave the rollups alone.
+    """
+    start_time = time.time()
+    batches = []
+    backend_name = backend.name if backend is not None else HereRoutingBackend.name
+    async for batch in step5_stream(
+        pcs, states_gdf, api_key, max_concurrent=max_concurrent, backend=backend, location_coords=location_coords,
+        route_cache=route_cache, session=session, keep_load_index=keep_load_index,
+    ):
+        if update_rollups:
+            update_ifta_rollups(replaceable_rows(batch.frame, backend_name))
+        batches.append(batch)
+    result_df = collect_step5_batches(pcs, batches, keep_load_index=keep_load_index)
     total_time = time.time() - start_time
+    total_routes = len(pcs)
+    failed_routes = batches[-1].failed_loads if batches else 0
+    successful_routes = total_routes - failed_routes
     
     # Count different types of records
     error_records = result_df[result_df['State'] == 'ERROR']
@@ -1078,22 +2812,19 @@ async def step5_calculate_mileage_concurrent(pcs: pd.DataFrame, states_gdf: gpd.
     # Analyze error types
     error_counts = {}
     if len(error_records) > 0:
-        error_types = error_records['Miles'].value_counts()
+        error_types = error_records['Status'].value_counts()
         for error_type, count in error_types.items():
-            error_counts[error_type] = count
-    
-    error_count = getattr(calculate_state_miles_async, '_error_count', 0)
-    fallback_count = getattr(step5_calculate_mileage_concurrent, '_fallback_count', 0)
+            if count:
+                error_counts[error_type] = count
     
     logger.info(f"Phase 5 completed in {total_time/60:.1f} minutes:")
-    logger.info(f"  • Total routes processed: {total_routes}")
-    logger.info(f"  • Successful routes: {successful_routes} ({successful_routes/total_routes*100:.1f}%)")
-    logger.info(f"  • Failed routes: {failed_routes} ({failed_routes/total_routes*100:.1f}%)")
+    logger.info(f"  • Total routes processed: {total_routes} ({batches[-1].routes_total if batches else 0} distinct origin/destination pairs)")
+    logger.info(f"  • Successful routes: {successful_routes} ({successful_routes/max(total_routes, 1)*100:.1f}%)")
+    logger.info(f"  • Failed routes: {failed_routes} ({failed_routes/max(total_routes, 1)*100:.1f}%)")
     logger.info(f"  • Generated records: {len(result_df)} total ({len(successful_records)} valid, {len(error_records)} errors)")
-    logger.info(f"  • Average time per route: {total_time/total_routes:.2f} seconds")
+    logger.info(f"  • Average time per route: {total_time/max(total_routes, 1):.2f} seconds")
     logger.info(f"  • Speed improvement: ~{max_concurrent}x faster than sequential")
-    logger.info(f"  • API errors: {error_count}")
-    logger.info(f"  • Great circle fallback attempts: {fallback_count}")
+    logger.info(f"  • Estimated (geodesic) loads: {result_df.loc[result_df['Status'] == STATUS_ESTIMATED, 'Load'].nunique()}")
     
     if error_counts:
         logger.info(f"  • Error breakdown:")
@@ -1103,12 +2834,798 @@ async def step5_calculate_mileage_concurrent(pcs: pd.DataFrame, states_gdf: gpd.
     logger.info(f"--------------------------------")
     
     # Save debug CSV output
-    debug_file = DEBUG_DIR / "phase5_state_miles.csv"
+    debug_file = debug_path("phase5_state_miles.csv")
     result_df.to_csv(debug_file, index=False)
     logger.info(f"Phase 5 debug file saved: {debug_file}")
     
     return result_df
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Sharded Step 5: SQLite work queue + worker processes
+# ──────────────────────────────────────────────────────────────────────────────
+
+def shard_ids_for(pcs: pd.DataFrame, n_shards: int) -> np.ndarray:
+    """
+    Shard per load, keyed on Trailer (Step 3 groups and chains loads per trailer, so trailers are
+    independent). Uses pandas' fixed-key hash, so the assignment is identical in every process and run.
+    """
+    trailer_hash = pd.util.hash_pandas_object(pcs["Trailer"].astype(str), index=False).to_numpy()
+    return (trailer_hash % np.uint64(n_shards)).astype(np.int64)
+
+class ShardQueue:
+    """
+    Step 5 work queue in one SQLite file: pickled load shards in, pickled result frames out.
+    Any process that can open the file (local workers, or other machines via a shared drive)
+    claims pending shards with `python prototype.py worker <queue file>`. Finished routes are
+    published to a shared table so workers reuse each other's routes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id INTEGER PRIMARY KEY, status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT, payload BLOB NOT NULL, result BLOB, error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS routes (
+                origin TEXT, destination TEXT, state_miles TEXT, estimated INTEGER,
+                PRIMARY KEY (origin, destination)
+            );
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    @classmethod
+    def create(cls, pcs: pd.DataFrame, n_shards: int, config: dict) -> "ShardQueue":
+        """New queue holding `pcs` split into shards (empty shards are skipped)"""
+        SHARD_QUEUE_DIR.mkdir(parents=True, exist_ok=True)
+        queue = cls(SHARD_QUEUE_DIR / f"step5_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}.sqlite")
+        shard_ids = shard_ids_for(pcs, n_shards)
+        with queue.conn:
+            queue.conn.execute("BEGIN")
+            queue.conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                   [(key, json.dumps(value)) for key, value in config.items()])
+            for shard_id in np.unique(shard_ids):
+                payload = pickle.dumps(pcs[shard_ids == shard_id], protocol=pickle.HIGHEST_PROTOCOL)
+                queue.conn.execute("INSERT INTO shards (shard_id, payload) VALUES (?, ?)", (int(shard_id), payload))
+        return queue
+
+    def config(self) -> dict:
+        return {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM meta")}
+
+    def claim(self, worker: str) -> Optional[Tuple[int, pd.DataFrame]]:
+        """Atomically take the lowest pending shard; None when the queue is drained"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT shard_id, payload FROM shards WHERE status = 'pending' ORDER BY shard_id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE shards SET status = 'claimed', worker = ? WHERE shard_id = ?", (worker, row[0]))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return None if row is None else (row[0], pickle.loads(row[1]))
+
+    def complete(self, shard_id: int, result_df: pd.DataFrame):
+        self.conn.execute("UPDATE shards SET status = 'done', result = ?, error = NULL WHERE shard_id = ?",
+                          (pickle.dumps(result_df, protocol=pickle.HIGHEST_PROTOCOL), shard_id))
+
+    def fail(self, shard_id: int, error: str):
+        self.conn.execute("UPDATE shards SET status = 'failed', error = ? WHERE shard_id = ?", (error, shard_id))
+
+    def requeue_unfinished(self) -> int:
+        """Put shards claimed by workers that died back to pending; returns how many"""
+        return self.conn.execute("UPDATE shards SET status = 'pending', worker = NULL WHERE status = 'claimed'").rowcount
+
+    def status_counts(self) -> Dict[str, int]:
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM shards GROUP BY status").fetchall())
+
+    def load_routes(self) -> Dict[tuple, tuple]:
+        return {(origin, destination): (json.loads(state_miles), bool(estimated), ())
+                for origin, destination, state_miles, estimated in
+                self.conn.execute("SELECT origin, destination, state_miles, estimated FROM routes")}
+
+    def publish_routes(self, route_cache: Dict[tuple, tuple]):
+        rows = [(origin, destination, json.dumps(value[0]), int(value[1]))
+                for (origin, destination), value in route_cache.items() if isinstance(value, tuple)]
+        self.conn.executemany("INSERT OR IGNORE INTO routes VALUES (?, ?, ?, ?)", rows)
+
+    def merged_results(self) -> pd.DataFrame:
+        """
+        Deterministic merge: every shard result is labelled with its loads' positions in the
+        Step 3 table, so a stable sort restores exactly the single-process row order.
+        """
+        frames = [pickle.loads(result) for (result,) in
+                  self.conn.execute("SELECT result FROM shards WHERE status = 'done' ORDER BY shard_id")]
+        if not frames:
+            return StateMilesBuilder().to_frame(pd.DataFrame(columns=list(STATE_MILES_LOAD_COLUMNS)))
+        merged = pd.concat(frames)
+        for column in ("State", "Status"):
+            merged[column] = merged[column].astype("category")
+        merged["Status"] = merged["Status"].cat.set_categories(RESULT_STATUSES)
+        return merged.sort_index(kind="stable").reset_index(drop=True)
+
+def run_shard_worker(queue_path, worker: Optional[str] = None) -> int:
+    """
+    Worker loop: claim shards until the queue is drained, running Step 5 on each.
+    Boundaries, geocoding cache and routing backend are loaded once per worker; routes finished
+    by other workers are picked up before each shard. Returns the number of shards processed.
+    """
+    configure_logging()
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    queue = ShardQueue(queue_path)
+    config = queue.config()
+    api_key = _load_api_key_for_backend(config["routing_backend"])
+    backend = make_routing_backend(config["routing_backend"], api_key)
+    states_gdf = load_state_boundaries()
+    location_coords = load_geocoding_cache()
+    route_cache: Dict[tuple, tuple] = {}
+
+    processed = 0
+    try:
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                break
+            shard_id, pcs = claimed
+            route_cache.update(queue.load_routes())
+            try:
+                result_df = asyncio.run(step5_calculate_mileage_concurrent(
+                    pcs, states_gdf, api_key, max_concurrent=config["max_concurrent"], backend=backend,
+                    location_coords=location_coords, route_cache=route_cache, keep_load_index=True,
+                    update_rollups=config.get("update_rollups", False),
+                ))
+            except Exception as e:
+                logger.error(f"Worker {worker}: shard {shard_id} failed: {e}")
+                queue.fail(shard_id, f"{type(e).__name__}: {e}")
+                continue
+            queue.complete(shard_id, result_df)
+            queue.publish_routes(route_cache)
+            processed += 1
+            logger.info(f"Worker {worker}: shard {shard_id} done ({len(pcs)} loads → {len(result_df)} records)")
+    finally:
+        queue.close()
+    return processed
+
+def step5_sharded(pcs: pd.DataFrame, n_workers: int = STEP5_WORKERS, n_shards: Optional[int] = None,
+                  max_concurrent: int = 10, routing_backend: str = ROUTING_BACKEND,
+                  update_rollups: bool = False) -> pd.DataFrame:
+    """
+    Sharded Step 5: split the Step 3 load table by Trailer into a SQLite work queue and run
+    `n_workers` local worker processes on it (more machines can join with `prototype.py worker`).
+    Shards left behind by a crashed worker are finished in-process. Output rows are in the same
+    order as step5_calculate_mileage_concurrent on the whole table; update_rollups is passed on to
+    the workers through the queue.
+    """
+    n_workers = max(1, n_workers)
+    n_shards = n_shards or n_workers * 4  # Several shards per worker evens out uneven trailers
+    pcs = pcs.reset_index(drop=True)  # Index = position in the Step 3 table (merge key)
+    queue = ShardQueue.create(pcs, n_shards, {"routing_backend": routing_backend, "max_concurrent": max_concurrent,
+                                                "update_rollups": update_rollups})
+    logger.info(f"Phase 5 (sharded): {len(pcs)} loads in {queue.status_counts().get('pending', 0)} shards, "
+                f"{n_workers} worker processes, queue {queue.path}")
+
+    start_time = time.time()
+    context = multiprocessing.get_context("spawn")  # Fresh interpreters: no inherited event loop or sockets
+    workers = [context.Process(target=run_shard_worker, args=(str(queue.path),), name=f"step5-worker-{i}")
+               for i in range(n_workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    requeued = queue.requeue_unfinished()
+    if requeued:
+        logger.warning(f"{requeued} shards left unfinished by exited workers - processing in-process")
+        run_shard_worker(queue.path, worker="coordinator")
+
+    counts = queue.status_counts()
+    if counts.get("failed"):
+        failed = queue.conn.execute("SELECT shard_id, error FROM shards WHERE status = 'failed'").fetchall()
+        queue.close()
+        raise RuntimeError(f"{len(failed)} Step 5 shards failed: " + "; ".join(f"#{i}: {e}" for i, e in failed))
+
+    result_df = queue.merged_results()
+    queue.close()
+    for suffix in ("", "-wal", "-shm"):  # Failed runs keep their queue for inspection / re-run
+        Path(f"{queue.path}{suffix}").unlink(missing_ok=True)
+    logger.info(f"Phase 5 (sharded) completed in {(time.time() - start_time)/60:.1f} minutes:")
+    logger.info(f"  • Shards: {counts.get('done', 0)} done across {n_workers} workers")
+    logger.info(f"  • Generated records: {len(result_df)} ({(result_df['Status'] != STATUS_OK).sum()} not OK)")
+
+    debug_file = debug_path("phase5_state_miles.csv")
+    result_df.to_csv(debug_file, index=False)
+    logger.info(f"Phase 5 debug file saved: {debug_file}")
+    return result_df
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Result Cache: serve stored results for re-uploaded workbooks
+# ──────────────────────────────────────────────────────────────────────────────
+
+def pipeline_config(period: Optional[ReportingPeriod] = None, **overrides) -> dict:
+    """
+    Configuration that affects step 1-5 output (date window, routing parameters, cache version).
+    Callers pass anything else that changes results (e.g. max_concurrent does NOT, so leave it out).
+    """
+    if period is None:
+        period = parse_period(REPORTING_PERIOD)
+    config = {
+        "version": RESULT_CACHE_VERSION,
+        "period_start": str(period.start.date()),
+        "period_end": str(period.end.date()),
+        "routing_backend": ROUTING_BACKEND,
+        "here_route_params": HERE_ROUTE_PARAMS,
+        "circuity_factor": CIRCUITY_FACTOR,
+        "virtual_returns": VIRTUAL_RETURNS,
+        "state_boundaries": STATE_BOUNDARY_LEVEL,
+        "route_simplify_tolerance_m": ROUTE_SIMPLIFY_TOLERANCE_M,
+    }
+    config.update(overrides)
+    return config
+
+def result_cache_key(workbook_bytes: bytes, config: dict) -> str:
+    """Build a cache key from the workbook content hash plus the pipeline configuration"""
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(workbook_bytes).digest())
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+def load_cached_results(cache_key: str) -> Optional[pd.DataFrame]:
+    """Return the stored result_df for this key, or None if it was never computed"""
+    cache_file = RESULT_CACHE_DIR / f"{cache_key}.pkl"
+    if not cache_file.exists():
+        return None
+    try:
+        result_df = pd.read_pickle(cache_file)
+        if result_df["Status"].isin(RETRYABLE_STATUSES).any():
+            logger.info(f"Ignoring cached results with estimated/failed rows (stored before they were excluded): {cache_file}")
+            return None
+        logger.info(f"Loaded cached results ({len(result_df)} rows) from {cache_file}")
+        return result_df
+    except Exception as e:
+        logger.warning(f"Error loading cached results {cache_file}: {e}")
+        return None
+
+def save_cached_results(cache_key: str, result_df: pd.DataFrame) -> Optional[Path]:
+    """
+    Persist result_df under the cache key (atomic write so a crashed run never leaves a partial file).
+    Results with ESTIMATED or GEOCODE_ERR rows are not stored (returns None): those come from HERE
+    failures, an open circuit or the quota budget, and the next upload should route them again.
+    """
+    degraded = result_df["Status"].isin(RETRYABLE_STATUSES)
+    if degraded.any():
+        logger.info(f"Results not cached: {int(degraded.sum())} estimated/failed rows would be retried by the next run")
+        return None
+    RESULT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_file = RESULT_CACHE_DIR / f"{cache_key}.pkl"
+    tmp_file = cache_file.with_suffix(".pkl.tmp")
+    result_df.to_pickle(tmp_file)
+    os.replace(tmp_file, cache_file)
+    logger.info(f"Saved {len(result_df)} result rows to cache: {cache_file}")
+    return cache_file
+
+# ──────────────────────────────────────────────────────────────────────────────
+# IFTA Rollups: miles by company, truck, state and month, maintained as Step 5 streams
+# ──────────────────────────────────────────────────────────────────────────────
+
+IFTA_ROLLUP_DIMENSIONS = ["company", "truck", "state", "month"]
+
+class IftaRollups:
+    """
+    Materialized IFTA totals by company, truck, jurisdiction (state) and PU month in one SQLite
+    file. Step 5 batches are ingested as they stream; a reprocessed load (rerun, reattribute)
+    first has its previous per-state miles subtracted, so totals are replaced, never double counted.
+    GEOCODE_ERR and pre-flight rejected loads contribute nothing until a rerun routes them.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path or IFTA_ROLLUP_FILE)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS load_miles (
+                company TEXT, load TEXT, truck TEXT, state TEXT, month TEXT, miles REAL, estimated INTEGER,
+                PRIMARY KEY (company, load, state)
+            );
+            CREATE TABLE IF NOT EXISTS rollup (
+                company TEXT, truck TEXT, state TEXT, month TEXT,
+                miles REAL, estimated_miles REAL, loads INTEGER,
+                PRIMARY KEY (company, truck, state, month)
+            );
+        """)
+
+    @staticmethod
+    def load_rows(result_df: pd.DataFrame) -> pd.DataFrame:
+        """Step 5 rows → load_miles rows (routed states only)"""
+        routed = result_df[~result_df["Status"].isin(ERROR_STATUSES)]
+        return pd.DataFrame({
+            "company": routed["Company"].astype(str).to_numpy(),
+            "load": routed["Load"].astype(str).to_numpy(),
+            "truck": routed["Truck"].astype(str).to_numpy(),
+            "state": routed["State"].astype(str).to_numpy(),
+            "month": pd.to_datetime(routed["PU Date F"]).dt.strftime("%Y-%m").fillna("").to_numpy(),
+            "miles": routed["Miles"].to_numpy(dtype=np.float64),
+            "estimated": (routed["Status"] == STATUS_ESTIMATED).to_numpy(dtype=np.int64),
+        })
+
+    def ingest(self, result_df: pd.DataFrame) -> int:
+        """Replace the contribution of every load in result_df; returns the rollup cells touched"""
+        if result_df.empty:
+            return 0
+        new = self.load_rows(result_df)
+        keys = result_df[["Company", "Load"]].astype(str).drop_duplicates().itertuples(index=False, name=None)
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS ingest_keys (company TEXT, load TEXT)")
+            self.conn.execute("DELETE FROM ingest_keys")
+            self.conn.executemany("INSERT INTO ingest_keys VALUES (?, ?)", keys)
+            old = pd.read_sql_query(
+                "SELECT lm.* FROM load_miles lm JOIN ingest_keys k ON lm.company = k.company AND lm.load = k.load",
+                self.conn,
+            )
+            self.conn.execute("DELETE FROM load_miles WHERE (company, load) IN (SELECT company, load FROM ingest_keys)")
+            self.conn.executemany("INSERT OR REPLACE INTO load_miles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  new.itertuples(index=False, name=None))
+
+            # Net change per rollup cell: new contribution minus the one it replaces
+            sign = np.concatenate([np.full(len(old), -1.0), np.ones(len(new))])
+            changes = pd.concat([old, new], ignore_index=True).assign(
+                miles=lambda frame: frame["miles"] * sign,
+                estimated_miles=lambda frame: frame["miles"] * frame["estimated"],
+                loads=sign.astype(np.int64),
+            )
+            delta = changes.groupby(IFTA_ROLLUP_DIMENSIONS, as_index=False)[["miles", "estimated_miles", "loads"]].sum()
+            self.conn.executemany("""
+                INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (company, truck, state, month) DO UPDATE SET
+                    miles = miles + excluded.miles,
+                    estimated_miles = estimated_miles + excluded.estimated_miles,
+                    loads = loads + excluded.loads
+            """, delta.itertuples(index=False, name=None))
+            self.conn.execute("DELETE FROM rollup WHERE loads <= 0")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(delta)
+
+    def totals(self, period: Optional[ReportingPeriod] = None, by: List[str] = ("state",)) -> pd.DataFrame:
+        """
+        Summed miles for the months of `period` (whole months; default: everything), grouped by
+        any of IFTA_ROLLUP_DIMENSIONS. Reads the rollup table only, never the row-level outputs.
+        """
+        by = list(by)
+        unknown = set(by) - set(IFTA_ROLLUP_DIMENSIONS)
+        if unknown:
+            raise ValueError(f"Unknown rollup dimensions: {sorted(unknown)} (choose from {IFTA_ROLLUP_DIMENSIONS})")
+        where, params = "", []
+        if period is not None:
+            where, params = "WHERE month BETWEEN ? AND ?", [period.start.strftime("%Y-%m"), period.end.strftime("%Y-%m")]
+        columns = ", ".join(by)
+        totals = pd.read_sql_query(
+            f"SELECT {columns}, SUM(miles) AS miles, SUM(estimated_miles) AS estimated_miles "
+            f"FROM rollup {where} GROUP BY {columns} ORDER BY {columns}",
+            self.conn, params=params,
+        )
+        totals[["miles", "estimated_miles"]] = totals[["miles", "estimated_miles"]].round(1)
+        return totals.rename(columns=lambda column: column.replace("_", " ").title())
+
+@functools.lru_cache(maxsize=1)
+def get_ifta_rollups() -> Optional[IftaRollups]:
+    """The process's rollup store (None when IFTA_ROLLUPS is off)"""
+    return IftaRollups(IFTA_ROLLUP_FILE) if IFTA_ROLLUPS else None
+
+def replaceable_rows(result_df: pd.DataFrame, backend_name: str) -> pd.DataFrame:
+    """
+    Rows allowed to replace a load's stored miles (rollups, results store). Re-attribution (the
+    'archive' backend) only replaces loads it could route from the archive; a route recorded
+    before the archive existed keeps its earlier HERE result instead of an error row.
+    """
+    if backend_name != ArchiveRoutingBackend.name:
+        return result_df
+    return result_df[~result_df["Status"].isin(ERROR_STATUSES)]
+
+def update_ifta_rollups(result_df: pd.DataFrame):
+    """Fold a Step 5 batch into the rollups; rollup problems never fail the run itself"""
+    try:
+        rollups = get_ifta_rollups()
+        if rollups is not None:
+            rollups.ingest(result_df)
+    except Exception as e:
+        logger.warning(f"IFTA rollup update failed ({len(result_df)} rows): {e}")
+
+def write_ifta_totals(period: Optional[str] = None) -> Path:
+    """CLI `ifta`: per-state totals and the company/truck/state/month detail for a period from the rollups"""
+    reporting_period = parse_period(period or REPORTING_PERIOD)
+    rollups = IftaRollups(IFTA_ROLLUP_FILE)
+    by_state = rollups.totals(reporting_period, by=["state"])
+    detail = rollups.totals(reporting_period, by=IFTA_ROLLUP_DIMENSIONS)
+
+    period_dir = OUTPUT_DIR / reporting_period.label
+    period_dir.mkdir(parents=True, exist_ok=True)
+    state_file = period_dir / f"ifta_by_state_{reporting_period.label}.csv"
+    by_state.to_csv(state_file, index=False)
+    detail.to_csv(period_dir / f"ifta_detail_{reporting_period.label}.csv", index=False)
+
+    logger.info(f"IFTA totals for {reporting_period.label} ({len(by_state)} jurisdictions, {by_state['Miles'].sum():.1f} miles):")
+    for state, miles, estimated_miles in by_state[["State", "Miles", "Estimated Miles"]].itertuples(index=False, name=None):
+        logger.info(f"  • {state}: {miles:.1f} miles ({estimated_miles:.1f} estimated)")
+    logger.info(f"IFTA totals saved: {state_file}")
+    return state_file
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Results Store: Step 5 rows across quarters as partitioned Parquet (company / quarter)
+# ──────────────────────────────────────────────────────────────────────────────
+
+RESULTS_STORE_COLUMNS = ["Company", "Quarter", "Ref No", "Load", "Trip", "Truck", "Trailer",
+                         "PU Date F", "Del Date F", "Origin", "Destination", "State", "Miles", "Status"]
+
+class ResultsStore:
+    """
+    Every run's Step 5 rows in one Parquet file per company and quarter
+    (RESULTS_STORE_DIR/<company>/<quarter>.parquet), sorted by PU date.
+    Appending replaces a load's earlier rows in its partition (latest run wins, like the IFTA
+    rollups); queries read only the partitions and columns they need, with filters pushed down.
+    Each partition update holds that partition's lock, so concurrent runs (batch workbooks, shard
+    coordinators, the app) do not drop each other's rows.
+    """
+    LOCK_TIMEOUT_S = 600  # A partition rewrite takes seconds; waiting this long means a stuck writer
+
+    def __init__(self, root: Optional[Path] = None):
+        self.root = Path(root or RESULTS_STORE_DIR)
+
+    @contextlib.contextmanager
+    def partition_lock(self, part_file: Path):
+        """Cross-process lock on one partition (SQLite BEGIN IMMEDIATE on a sidecar file, so it works on Windows too)"""
+        conn = sqlite3.connect(str(part_file.with_name(f"{part_file.name}.lock")), timeout=self.LOCK_TIMEOUT_S,
+                               isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield
+        finally:
+            conn.close()  # Closing rolls back the empty transaction and releases the lock
+
+    @staticmethod
+    def company_dir(company: str) -> str:
+        return re.sub(r"[^A-Za-z0-9]+", "_", str(company)).strip("_") or "_"
+
+    @staticmethod
+    def to_store_rows(result_df: pd.DataFrame, loads: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """Step 5 rows (plus origin/destination from the Step 3 loads) → store schema, plain strings"""
+        frame = result_df.astype({"Company": str, "Ref No": str, "Load": str, "Trip": str, "Truck": str,
+                                  "Trailer": str, "State": str, "Status": str})
+        pu_dates = pd.to_datetime(frame["PU Date F"])
+        frame["Quarter"] = (pu_dates.dt.year.astype("Int64").astype(str) + "Q"
+                            + pu_dates.dt.quarter.astype("Int64").astype(str)).where(pu_dates.notna(), "unknown")
+        frame["Origin"] = frame["Destination"] = ""
+        if loads is not None:
+            routes = pd.DataFrame({
+                "Company": loads["Company"].astype(str).to_numpy(),
+                "Load": loads["Load"].astype(str).to_numpy(),
+                "Origin": (loads["Ship City"].astype(str) + ", " + loads["Ship St"].astype(str)).to_numpy(),
+                "Destination": (loads["Cons City"].astype(str) + ", " + loads["Cons St"].astype(str)).to_numpy(),
+            }).drop_duplicates(["Company", "Load"])
+            frame = frame.drop(columns=["Origin", "Destination"]).merge(routes, on=["Company", "Load"], how="left")
+            frame[["Origin", "Destination"]] = frame[["Origin", "Destination"]].fillna("")
+        return frame[RESULTS_STORE_COLUMNS]
+
+    def append(self, result_df: pd.DataFrame, loads: Optional[pd.DataFrame] = None) -> int:
+        """Write a run's rows into their company/quarter partitions; returns the rows written"""
+        if result_df.empty:
+            return 0
+        rows = self.to_store_rows(result_df, loads)
+        for (company, quarter), part in rows.groupby(["Company", "Quarter"], sort=False):
+            part_file = self.root / self.company_dir(company) / f"{quarter}.parquet"
+            part_file.parent.mkdir(parents=True, exist_ok=True)
+            with self.partition_lock(part_file):  # Read-modify-replace must not interleave with another writer
+                if part_file.exists():
+                    existing = pd.read_parquet(part_file)
+                    part = pd.concat([existing[~existing["Load"].isin(part["Load"].unique())], part], ignore_index=True)
+                part = part.sort_values(["PU Date F", "Load"], kind="stable")
+                tmp_file = part_file.with_name(f"{part_file.name}.{os.getpid()}.tmp")
+                part.to_parquet(tmp_file, index=False, row_group_size=50_000)
+                os.replace(tmp_file, part_file)
+        return len(rows)
+
+    def files(self, company: Optional[str] = None, period: Optional[ReportingPeriod] = None) -> List[Path]:
+        """Partition files for a company and/or the quarters overlapping a period (path pruning only)"""
+        pattern = f"{self.company_dir(company) if company else '*'}/*.parquet"
+        quarters = {quarter.label for quarter in period.quarters()} if period is not None else None
+        return sorted(path for path in self.root.glob(pattern) if quarters is None or path.stem in quarters)
+
+    def scan(self, columns: List[str], company: Optional[str] = None, period: Optional[ReportingPeriod] = None,
+             where=None) -> pd.DataFrame:
+        """Selected columns from the matching partitions; `where` is a pyarrow.dataset expression"""
+        import pyarrow.dataset as pads
+
+        files = self.files(company, period)
+        if not files:
+            return pd.DataFrame(columns=columns)
+        conditions = [] if where is None else [where]
+        if company:
+            conditions.append(pads.field("Company") == company)
+        if period is not None:
+            conditions.append((pads.field("PU Date F") >= period.start.to_datetime64())
+                              & (pads.field("PU Date F") < (period.end + pd.Timedelta(days=1)).to_datetime64()))
+        condition = functools.reduce(lambda left, right: left & right, conditions) if conditions else None
+        return pads.dataset([str(path) for path in files], format="parquet").to_table(
+            columns=columns, filter=condition).to_pandas()
+
+    def miles_by_state(self, period: Optional[ReportingPeriod] = None, company: Optional[str] = None) -> pd.DataFrame:
+        """Miles per state per quarter (routed rows only), quarters as columns"""
+        import pyarrow.dataset as pads
+
+        rows = self.scan(["Quarter", "State", "Miles"], company, period, where=~pads.field("Status").isin(ERROR_STATUSES))
+        if rows.empty:
+            return pd.DataFrame()
+        return rows.pivot_table(index="State", columns="Quarter", values="Miles", aggfunc="sum", fill_value=0).round(1)
+
+    def truck_history(self, truck: str, company: Optional[str] = None, period: Optional[ReportingPeriod] = None) -> pd.DataFrame:
+        """One row per load the truck ran: dates, route, total miles, states and status"""
+        import pyarrow.dataset as pads
+
+        rows = self.scan(["Company", "Quarter", "Load", "Ref No", "PU Date F", "Del Date F", "Origin", "Destination",
+                          "State", "Miles", "Status"], company, period, where=pads.field("Truck") == str(truck))
+        if rows.empty:
+            return rows
+        return (rows.groupby(["Company", "Quarter", "Load"], sort=False)
+                .agg(**{"Ref No": ("Ref No", "first"), "PU Date F": ("PU Date F", "first"),
+                        "Del Date F": ("Del Date F", "first"), "Origin": ("Origin", "first"),
+                        "Destination": ("Destination", "first"), "Miles": ("Miles", "sum"),
+                        "States": ("State", lambda states: " ".join(states)), "Status": ("Status", "first")})
+                .reset_index().sort_values("PU Date F", kind="stable").round({"Miles": 1}))
+
+    def errored_routes(self, period: Optional[ReportingPeriod] = None, company: Optional[str] = None) -> pd.DataFrame:
+        """Failed routes (GEOCODE_ERR and pre-flight rejections): origin → destination, status, how many loads and which, last seen"""
+        import pyarrow.dataset as pads
+
+        rows = self.scan(["Company", "Load", "PU Date F", "Origin", "Destination", "Status"], company, period,
+                         where=pads.field("Status").isin(ERROR_STATUSES))
+        if rows.empty:
+            return rows
+        return (rows.groupby(["Origin", "Destination", "Status"])
+                .agg(Loads=("Load", "nunique"), **{"Load Numbers": ("Load", lambda loads: ", ".join(sorted(set(loads))))},
+                     **{"Last PU": ("PU Date F", "max")})
+                .reset_index().sort_values("Loads", ascending=False, kind="stable"))
+
+def store_results(result_df: pd.DataFrame, loads: Optional[pd.DataFrame] = None):
+    """Append a run to the results store (RESULTS_STORE); store problems never fail the run itself"""
+    if not RESULTS_STORE:
+        return
+    try:
+        start_time = time.time()
+        written = ResultsStore(RESULTS_STORE_DIR).append(result_df, loads)
+        logger.info(f"Results store: {written} rows appended in {time.time() - start_time:.2f}s ({RESULTS_STORE_DIR})")
+    except Exception as e:
+        logger.warning(f"Results store append failed: {e}")
+
+def run_query(question: str, *args: str) -> pd.DataFrame:
+    """
+    CLI `query`: states [PERIOD] [COMPANY] | truck TRUCK [PERIOD] | errors [PERIOD] [COMPANY]
+    PERIOD is anything parse_period accepts; "all" (or omitted) means every stored quarter.
+    """
+    def period_arg(position: int) -> Optional[ReportingPeriod]:
+        spec = args[position] if len(args) > position else "all"
+        return None if spec == "all" else parse_period(spec)
+
+    store = ResultsStore(RESULTS_STORE_DIR)
+    start_time = time.time()
+    if question == "states":
+        answer = store.miles_by_state(period_arg(0), *args[1:2])
+    elif question == "truck" and args:
+        answer = store.truck_history(args[0], period=period_arg(1))
+    elif question == "errors":
+        answer = store.errored_routes(period_arg(0), *args[1:2])
+    else:
+        raise ValueError("Usage: query states [PERIOD] [COMPANY] | truck TRUCK [PERIOD] | errors [PERIOD] [COMPANY]")
+    elapsed_ms = (time.time() - start_time) * 1000
+    with pd.option_context("display.max_rows", 500, "display.width", 200):
+        print(answer.to_string() if not answer.empty else "(no stored rows match)")
+    logger.info(f"Query answered in {elapsed_ms:.0f} ms")
+    return answer
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Run Planner: expected HERE calls, cache hits and wall time (no network)
+# ──────────────────────────────────────────────────────────────────────────────
+
+DEFAULT_HERE_LATENCY_S = {"geocode": 0.3, "routing": 0.8}  # Until latency samples have been recorded
+
+def plan_step5(pcs: pd.DataFrame, routing_backend: str = ROUTING_BACKEND, max_concurrent: int = 10,
+               location_coords: Optional[dict] = None) -> dict:
+    """
+    Dry run of Step 5 over the Step 3 output: the same location canonicalization and route
+    dedupe, checked against the geocoding cache and the route archive. Returns expected HERE
+    calls per endpoint, quota share (on top of the usage already in the quota ledger) and
+    estimated wall time from recorded latency. No network.
+    Geocode failures skip their routes in a real run, so the call counts are an upper bound.
+    """
+    location_coords = dict(load_geocoding_cache() if location_coords is None else location_coords)
+
+    index = LocationIndex()
+    origin_ids = index.encode(pcs["Ship City"], pcs["Ship St"])
+    dest_ids = index.encode(pcs["Cons City"], pcs["Cons St"])
+    index.share_coords(location_coords)
+    preflight = preflight_statuses(pcs, index, origin_ids, dest_ids, location_coords)
+    clean = preflight < 0
+    pair_keys = pd.unique(origin_ids[clean].astype(np.int64) * len(index) + dest_ids[clean])
+    pair_origins, pair_dests = pair_keys // len(index), pair_keys % len(index)
+    rejected = pd.Series(np.asarray(RESULT_STATUSES)[preflight[~clean]]).value_counts()
+
+    endpoints = np.unique(np.concatenate([pair_origins, pair_dests]))
+    to_geocode = int(sum(index.names[loc_id] not in location_coords for loc_id in endpoints))
+
+    archived = 0
+    if ROUTE_ARCHIVE_FILE.exists():
+        archive = RouteArchive(ROUTE_ARCHIVE_FILE)
+        archived = sum((index.names[o], index.names[d]) in archive for o, d in zip(pair_origins, pair_dests))
+
+    replay = HERE_CASSETTE == "replay"
+    here_calls = {"geocode": 0, "routing": 0}
+    if routing_backend != "archive" and not replay:
+        here_calls["geocode"] = to_geocode
+    if routing_backend == "here" and not replay:
+        here_calls["routing"] = len(pair_origins)
+
+    stats = get_here_latency_stats()
+    latency = {}
+    for endpoint in here_calls:
+        mean = stats.mean(endpoint)
+        latency[endpoint] = {
+            "mean_s": mean if mean is not None else DEFAULT_HERE_LATENCY_S[endpoint],
+            "p95_s": stats.percentile(endpoint, 95),
+            "samples": stats.count(endpoint),
+        }
+
+    # HERE wait time: bounded by latency spread over max_concurrent slots or by the global request budget
+    total_calls = sum(here_calls.values())
+    latency_bound = sum(here_calls[e] * latency[e]["mean_s"] for e in here_calls) / max(max_concurrent, 1)
+    rate_bound = total_calls / HERE_MAX_RPS if HERE_MAX_RPS > 0 else 0.0
+    ledger = get_here_quota_ledger()
+    ledger.flush()
+
+    return {
+        "routing_backend": routing_backend,
+        "cassette_replay": replay,
+        "loads": len(pcs),
+        "locations": int(len(endpoints)),
+        "locations_cached": int(len(endpoints)) - to_geocode,
+        "locations_to_geocode": to_geocode,
+        "routes": int(len(pair_origins)),
+        "rejected_loads": {status: int(count) for status, count in rejected.items()},
+        "routes_archived": int(archived),
+        "here_calls": here_calls,
+        "here_calls_total": total_calls,
+        "quota_pct": round(total_calls / HERE_MONTHLY_QUOTA * 100, 2) if HERE_MONTHLY_QUOTA else None,
+        "quota_used": {"month": ledger.month_used, "day": ledger.day_used},
+        "quota_used_pct": round(ledger.used_pct(), 2),
+        "quota_pct_after": round(ledger.used_pct(total_calls), 2),
+        "quota_level_after": ledger.level(total_calls),
+        "latency": latency,
+        "estimated_seconds": round(max(latency_bound, rate_bound), 1),
+    }
+
+def log_plan(plan: dict):
+    """Human-readable plan summary (CLI `plan`)"""
+    logger.info(f"Run plan ({plan['routing_backend']} backend{', cassette replay' if plan['cassette_replay'] else ''}):")
+    rejected = plan["rejected_loads"]
+    logger.info(f"  • Loads: {plan['loads']} ({sum(rejected.values())} rejected by the pre-flight gate, not routed"
+                f"{''.join(f', {status} {count}' for status, count in rejected.items())})")
+    logger.info(f"  • Distinct locations: {plan['locations']} ({plan['locations_cached']} cached, {plan['locations_to_geocode']} to geocode)")
+    logger.info(f"  • Distinct routes: {plan['routes']} ({plan['routes_archived']} already in the route archive)")
+    for endpoint, calls in plan["here_calls"].items():
+        stats = plan["latency"][endpoint]
+        source = f"{stats['samples']} samples, p95 {stats['p95_s']:.2f}s" if stats["samples"] else "default, no samples yet"
+        logger.info(f"  • HERE {endpoint} calls: {calls} (mean {stats['mean_s']:.2f}s, {source})")
+    if plan["quota_pct"] is not None:
+        logger.info(f"  • Monthly quota use: {plan['here_calls_total']}/{HERE_MONTHLY_QUOTA} ({plan['quota_pct']:.1f}%)")
+    if HERE_MONTHLY_QUOTA or HERE_DAILY_QUOTA:
+        level = plan["quota_level_after"]
+        logger.info(f"  • Quota budget: {plan['quota_used']['month']} used this month, {plan['quota_used']['day']} today "
+                    f"({plan['quota_used_pct']:.1f}%) → {plan['quota_pct_after']:.1f}% after this run (level {level})")
+        if level != "ok":
+            logger.warning(f"    - Past the {level} budget {'only high-priority requests go' if level == 'soft' else 'nothing goes'} to HERE; "
+                           f"the rest is served from the route archive, the cassette or the geodesic estimate")
+    logger.info(f"  • Estimated HERE time: {plan['estimated_seconds']/60:.1f} min (HERE budget {HERE_MAX_RPS:g} req/s)")
+
+def run_plan(period: Optional[str] = None, max_concurrent: int = 10) -> dict:
+    """CLI `plan`: Steps 1-3 on INPUT_FILE, then plan_step5 - nothing is sent to HERE"""
+    reporting_period = parse_period(period or REPORTING_PERIOD)
+    pcs, inv = step1_read_excel_data(period=reporting_period)
+    pcs_with_refs = step3_detect_round_trips(step2_filter_fleet_data(pcs, inv))
+    if VIRTUAL_RETURNS:
+        pcs_with_refs = step4_add_virtual_returns(pcs_with_refs)
+    plan = plan_step5(pcs_with_refs, ROUTING_BACKEND, max_concurrent=max_concurrent)
+    log_plan(plan)
+    return plan
+
+def report_here_quota(month: Optional[str] = None) -> pd.DataFrame:
+    """CLI `quota`: HERE requests per day and endpoint for a month (YYYY-MM) from the quota ledger"""
+    ledger = get_here_quota_ledger()
+    usage = ledger.usage(month)
+    month = month or ledger.today()[:7]
+    if usage.empty:
+        logger.info(f"No HERE requests recorded for {month} ({ledger.path})")
+        return usage
+    by_day = usage.pivot_table(index="day", columns="endpoint", values="requests", aggfunc="sum", fill_value=0)
+    by_day["total"] = by_day.sum(axis=1)
+    logger.info(f"HERE requests in {month} ({ledger.path}):\n{by_day.to_string()}")
+    for endpoint, requests in usage.groupby("endpoint")["requests"].sum().items():
+        logger.info(f"  • {endpoint}: {requests}")
+    log_here_quota(ledger)
+    return by_day
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Startup Benchmark: cold-start time of the module and the cache-only CLI
+# ──────────────────────────────────────────────────────────────────────────────
+
+STARTUP_HEAVY_MODULES = ("geopandas", "shapely", "pyproj", "aiohttp", "openpyxl")
+STARTUP_BUDGET_S = 1.0  # Cache-only and planning commands should start well inside this
+
+def benchmark_startup(runs: int = 5) -> pd.DataFrame:
+    """
+    CLI `startup`: wall time of a bare `import prototype` and of the cache-only `query errors`
+    command, each in fresh interpreters (median of `runs`), with the heavy stacks each one loaded.
+    The slowest top-level imports come from one `-X importtime` run.
+    """
+    # Runs the CLI as `python prototype.py ...` would, then reports which heavy stacks it imported
+    probe = ("import runpy, sys\n"
+             "sys.argv = ['prototype.py'] + {argv!r}\n"
+             "try:\n"
+             "    runpy.run_path('prototype.py', run_name='__main__') if {argv!r} else __import__('prototype')\n"
+             "finally:\n"
+             "    print('loaded:' + ','.join(m for m in {heavy!r} if m in sys.modules))\n")
+    commands = {"import prototype": [], "query errors": ["query", "errors"]}
+
+    rows = []
+    for name, argv in commands.items():
+        code = probe.format(argv=argv, heavy=STARTUP_HEAVY_MODULES)
+        timings, loaded = [], ""
+        for _ in range(runs):
+            started = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, capture_output=True, text=True)
+            timings.append(time.perf_counter() - started)
+            if proc.returncode != 0:
+                raise RuntimeError(f"Startup probe '{name}' failed:\n{proc.stderr[-2000:]}")
+            loaded = proc.stdout.strip().splitlines()[-1].removeprefix("loaded:")
+        rows.append({"Command": name, "Median s": statistics.median(timings), "Min s": min(timings),
+                     "Heavy modules": loaded or "-"})
+    results = pd.DataFrame(rows)
+
+    # -X importtime lines: "import time: self [us] | cumulative | package", children listed (indented)
+    # before their parent - the direct imports of prototype are the 1-level entries preceding it
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import prototype"],
+                          cwd=BASE_DIR, capture_output=True, text=True)
+    direct_imports, pending = [], []
+    for line in proc.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        package = fields[2][1:]  # One space after the separator, then two per nesting level
+        if not package.startswith(" "):
+            direct_imports, pending = (pending if package == "prototype" else direct_imports), []
+        elif not package.startswith("   "):
+            pending.append((int(fields[1]) / 1e6, package.strip()))
+
+    logger.info(f"Startup benchmark ({runs} cold runs each, budget {STARTUP_BUDGET_S:.1f}s):")
+    for row in results.to_dict("records"):
+        logger.info(f"  • {row['Command']}: {row['Median s']:.2f}s median, {row['Min s']:.2f}s best - "
+                    f"heavy modules: {row['Heavy modules']}")
+    logger.info("Slowest imports under `import prototype`:")
+    for seconds, package in sorted(direct_imports, reverse=True)[:8]:
+        logger.info(f"  • {package}: {seconds:.3f}s")
+    over_budget = results[results["Median s"] > STARTUP_BUDGET_S]
+    if not over_budget.empty:
+        logger.warning(f"Over the startup budget: {', '.join(over_budget['Command'])}")
+    return results
+
 # # ──────────────────────────────────────────────────────────────────────────────
 # # Phase 6: Output Generation
 # # ──────────────────────────────────────────────────────────────────────────────
@@ -1150,7 +3667,7 @@ async def step5_calculate_mileage_concurrent(pcs: pd.DataFrame, states_gdf: gpd.
 #     logger.info(f"  • CSV: {csv_file}")
     
 #     # Save debug CSV output (final formatted data)
-#     debug_file = DEBUG_DIR / "phase6_final_output.csv"
+#     debug_file = debug_path("phase6_final_output.csv")
 #     final_output.to_csv(debug_file, index=False)
 #     logger.info(f"Phase 6 debug file saved: {debug_file}")
     
@@ -1325,8 +3842,8 @@ async def run_validation_test():
     logger.info("🧪 RUNNING VALIDATION TEST ON REPRESENTATIVE TRIPS")
     
     try:
-        # Load API key for Step 5
-        api_key = load_api_key()
+        # Load API key for Step 5 (not needed with HERE_CASSETTE=replay)
+        api_key = _load_api_key_for_backend("here")
         logger.info("HERE API key loaded for mileage calculation")
         
         # Load test data
@@ -1379,43 +3896,43 @@ async def run_validation_test():
             
             # Calculate total miles or show error status
             total_miles = 0
-            has_error = False
+            error_status = None
             states_list = []
             
             for _, row in load_rows.iterrows():
-                if row['Miles'] == 'GEOCODE_ERR':
-                    has_error = True
+                if row['Status'] in ERROR_STATUSES:
+                    error_status = row['Status']
                     break
-                elif pd.notna(row['Miles']) and isinstance(row['Miles'], (int, float)):
+                elif pd.notna(row['Miles']):
                     total_miles += row['Miles']
                     states_list.append(f"{row['State']}:{row['Miles']:.1f}")
             
-            if has_error:
-                miles_info = "FAILED (GEOCODE_ERR)"
+            if error_status:
+                miles_info = f"FAILED ({error_status})"
             else:
                 miles_info = f"{total_miles:.1f} total ({', '.join(states_list)})"
             
             logger.info(f"  Load {first_row['Load']} (Ref {first_row['Ref No']}): {miles_info}")
             
         # Save complete test results with mileage
-        test_output_file = DEBUG_DIR / "validation_test_results_with_mileage.csv"
+        test_output_file = debug_path("validation_test_results_with_mileage.csv")
         test_with_mileage.to_csv(test_output_file, index=False)
         logger.info(f"\nComplete test results saved: {test_output_file}")
         
         # Also save a summary view for easier analysis
-        summary_file = DEBUG_DIR / "validation_summary.csv"
+        summary_file = debug_path("validation_summary.csv")
         summary_data = []
         for load_num in test_with_mileage['Load'].unique():
             load_rows = test_with_mileage[test_with_mileage['Load'] == load_num]
             first_row = load_rows.iloc[0]
             
             total_miles = 0
-            has_error = False
+            error_status = None
             for _, row in load_rows.iterrows():
-                if row['Miles'] == 'GEOCODE_ERR':
-                    has_error = True
+                if row['Status'] in ERROR_STATUSES:
+                    error_status = row['Status']
                     break
-                elif pd.notna(row['Miles']) and isinstance(row['Miles'], (int, float)):
+                elif pd.notna(row['Miles']):
                     total_miles += row['Miles']
             
             summary_data.append({
@@ -1423,8 +3940,8 @@ async def run_validation_test():
                 'Ref': first_row['Ref No'],
                 'Truck': first_row['Truck'],
                 'Trailer': first_row['Trailer'],
-                'Total_Miles': 'GEOCODE_ERR' if has_error else f"{total_miles:.1f}",
-                'Status': 'FAILED' if has_error else 'SUCCESS'
+                'Total_Miles': error_status or f"{total_miles:.1f}",
+                'Status': 'FAILED' if error_status else 'SUCCESS'
             })
         
         summary_df = pd.DataFrame(summary_data)
@@ -1443,26 +3960,228 @@ async def run_validation_test():
 # Main Processing Function
 # ──────────────────────────────────────────────────────────────────────────────
 
-def main():
+def _load_api_key_for_backend(routing_backend: str = ROUTING_BACKEND) -> Optional[str]:
+    """HERE API key; the local routing backend only needs it to geocode uncached locations"""
+    if routing_backend == "archive":
+        return None  # Re-attribution never calls HERE
+    try:
+        api_key = load_api_key()
+        logger.info("HERE API key loaded successfully")
+        return api_key
+    except RuntimeError:
+        if HERE_CASSETTE == "replay":
+            return "replay"  # Requests are answered from the cassette; the key is never sent
+        if routing_backend == "here":
+            raise
+        logger.warning("No HERE API key - relying on geocoding cache for the local routing backend")
+        return None
+
+def write_period_results(result_df: pd.DataFrame, period: ReportingPeriod, output_dir: Optional[Path] = None) -> Path:
+    """Write one period's Step 5 results to output/<period>/ (batch runs partition by quarter)"""
+    period_dir = output_dir or OUTPUT_DIR / period.label
+    period_dir.mkdir(parents=True, exist_ok=True)
+    output_file = period_dir / f"state_miles_{period.label}.csv"
+    result_df.to_csv(output_file, index=False)
+    return output_file
+
+def run_period_batch(period_specs: List[str], max_concurrent: int = 10) -> Dict[str, Path]:
+    """
+    Batch mode: process several quarters in one run (e.g. ["2025"] for an annual re-filing).
+    The workbook is read once for the combined window; geocodes, routes and state boundaries
+    are shared across quarters; Steps 2-5 run per quarter and results land in output/<quarter>/.
+    """
+    periods = split_into_quarters(period_specs)
+    if not periods:
+        raise ValueError("No reporting periods given")
+    logger.info(f"Batch run over {len(periods)} quarters: {', '.join(period.label for period in periods)}")
+
+    api_key = _load_api_key_for_backend()
+    backend = make_routing_backend(ROUTING_BACKEND, api_key)
+    span = ReportingPeriod(periods[0].start, max(period.end for period in periods),
+                           f"{periods[0].label}-{periods[-1].label}")
+    pcs_all, inv = step1_read_excel_data(period=span)
+
+    # Shared across quarters
+    states_gdf = load_state_boundaries()
+    location_coords = load_geocoding_cache()
+    route_cache: Dict[tuple, tuple] = {}
+
+    async def process_periods() -> Dict[str, Path]:
+        outputs = {}
+        for period in periods:
+            logger.info(f"── {period.label} ({period.start.date()} → {period.end.date()}) ──")
+            pcs = pcs_all.loc[period.mask(pcs_all["PU"])]
+            if pcs.empty:
+                logger.warning(f"No loads in {period.label}, skipping")
+                continue
+            pcs_with_refs = step3_detect_round_trips(step2_filter_fleet_data(pcs, inv))
+            if VIRTUAL_RETURNS:
+                pcs_with_refs = step4_add_virtual_returns(pcs_with_refs)
+            result_df = await step5_calculate_mileage_concurrent(
+                pcs_with_refs, states_gdf, api_key, max_concurrent=max_concurrent, backend=backend,
+                location_coords=location_coords, route_cache=route_cache, update_rollups=True,
+            )
+            outputs[period.label] = write_period_results(result_df, period)
+            store_results(result_df, pcs_with_refs)
+        return outputs
+
+    outputs = asyncio.run(process_periods())
+    logger.info(f"Batch run completed: {len(outputs)} quarters, {len(route_cache)} distinct routes shared")
+    for label, output_file in outputs.items():
+        logger.info(f"  • {label}: {output_file}")
+    return outputs
+
+def resolve_workbooks(source: str) -> List[Path]:
+    """Workbooks in a directory (every .xlsx) or matching a glob; Excel lock files (~$...) are skipped"""
+    path = Path(source)
+    candidates = path.glob("*.xlsx") if path.is_dir() else (Path(match) for match in glob.glob(source))
+    return sorted(workbook for workbook in candidates if workbook.is_file() and not workbook.name.startswith("~$"))
+
+def summarize_workbook_results(results: Dict[Path, pd.DataFrame], outputs: Dict[Path, Path]) -> pd.DataFrame:
+    """One summary row per workbook (loads, records by status, miles) plus a TOTAL row"""
+    rows = []
+    for workbook, result_df in results.items():
+        status_counts = result_df["Status"].value_counts()
+        rows.append({
+            "Workbook": workbook.name,
+            "Loads": result_df["Load"].nunique(),
+            "Records": len(result_df),
+            **{status: int(status_counts.get(status, 0)) for status in RESULT_STATUSES},
+            "Miles": round(float(result_df["Miles"].sum()), 1),
+            "Output": str(outputs[workbook]),
+        })
+    summary = pd.DataFrame(rows)
+    if not summary.empty:
+        totals = {column: summary[column].sum() for column in summary.columns if column not in ("Workbook", "Output")}
+        summary = pd.concat([summary, pd.DataFrame([{"Workbook": "TOTAL", **totals, "Output": ""}])], ignore_index=True)
+    return summary
+
+def run_workbook_batch(source: str, period: Optional[str] = None, max_concurrent: int = 10) -> Path:
+    """
+    Batch mode over workbooks (a directory or glob, e.g. one export per carrier company).
+    Steps 1-3 run per workbook; Step 5 runs for all workbooks concurrently on one HTTP session,
+    one geocode/route cache and the global HERE rate budget (HERE_MAX_RPS), so a route shared by
+    several workbooks is requested once. Writes output/<workbook>/ per workbook plus a combined summary.
+    """
+    workbooks = resolve_workbooks(source)
+    if not workbooks:
+        raise FileNotFoundError(f"No .xlsx workbooks found for: {source}")
+    reporting_period = parse_period(period or REPORTING_PERIOD)
+    logger.info(f"Batch run over {len(workbooks)} workbooks ({reporting_period.label}, HERE budget {HERE_MAX_RPS:g} req/s)")
+
+    api_key = _load_api_key_for_backend()
+    backend = make_routing_backend(ROUTING_BACKEND, api_key)
+    states_gdf = load_state_boundaries()
+    location_coords = load_geocoding_cache()
+    route_cache: Dict[tuple, tuple] = {}
+
+    prepared: Dict[Path, pd.DataFrame] = {}
+    for workbook in workbooks:
+        logger.info(f"── {workbook.name} ──")
+        try:
+            pcs, inv = step1_read_excel_data(period=reporting_period, input_file=workbook)
+            prepared[workbook] = step3_detect_round_trips(step2_filter_fleet_data(pcs, inv))
+            if VIRTUAL_RETURNS:
+                prepared[workbook] = step4_add_virtual_returns(prepared[workbook])
+        except Exception as e:
+            logger.error(f"Skipping {workbook.name}: {e}")
+
+    async def route_workbooks() -> list:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=max_concurrent * 2, limit_per_host=max_concurrent)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+            return await asyncio.gather(*(
+                step5_calculate_mileage_concurrent(
+                    pcs, states_gdf, api_key, max_concurrent=max_concurrent, backend=backend,
+                    location_coords=location_coords, route_cache=route_cache, session=session,
+                    update_rollups=True,
+                )
+                for pcs in prepared.values()
+            ), return_exceptions=True)
+
+    start_time = time.time()
+    results: Dict[Path, pd.DataFrame] = {}
+    outputs: Dict[Path, Path] = {}
+    for workbook, result_df in zip(prepared, asyncio.run(route_workbooks())):
+        if isinstance(result_df, Exception):
+            logger.error(f"Step 5 failed for {workbook.name}: {result_df}")
+            continue
+        results[workbook] = result_df
+        outputs[workbook] = write_period_results(result_df, reporting_period, OUTPUT_DIR / workbook.stem)
+        store_results(result_df, prepared[workbook])
+
+    summary = summarize_workbook_results(results, outputs)
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    summary_file = OUTPUT_DIR / f"batch_summary_{reporting_period.label}.csv"
+    summary.to_csv(summary_file, index=False)
+
+    logger.info(f"Batch run completed in {(time.time() - start_time)/60:.1f} minutes:")
+    logger.info(f"  • Workbooks processed: {len(results)}/{len(workbooks)}")
+    logger.info(f"  • Distinct routes (shared across workbooks): {len(route_cache)}")
+    logger.info(f"  • Summary: {summary_file}")
+    return summary_file
+
+def run_reattribute(period: Optional[str] = None, n_workers: Optional[int] = None) -> Path:
+    """
+    Reattribute mode: recompute a period's state miles from the route archive with the current
+    boundaries, rounding and threshold - no HERE calls. Steps 1-3 run as usual; Step 5 runs on the
+    archive backend, sharded across n_workers processes (default: all cores).
+    """
+    reporting_period = parse_period(period or REPORTING_PERIOD)
+    n_workers = n_workers or os.cpu_count() or 1
+    logger.info(f"Re-attributing {reporting_period.label} from the route archive ({n_workers} workers)...")
+
+    pcs, inv = step1_read_excel_data(period=reporting_period)
+    pcs_with_refs = step3_detect_round_trips(step2_filter_fleet_data(pcs, inv))
+    if VIRTUAL_RETURNS:
+        pcs_with_refs = step4_add_virtual_returns(pcs_with_refs)
+    if n_workers > 1:
+        result_df = step5_sharded(pcs_with_refs, n_workers=n_workers, routing_backend="archive", update_rollups=True)
+    else:
+        result_df = asyncio.run(step5_calculate_mileage_concurrent(
+            pcs_with_refs, load_state_boundaries(), None, backend=make_routing_backend("archive"), update_rollups=True))
+
+    # Loads whose route is not in the archive keep their stored results (rollups were filtered per batch)
+    output_dir = OUTPUT_DIR / "reattributed" / reporting_period.label
+    reattributed = replaceable_rows(result_df, ArchiveRoutingBackend.name)
+    skipped = result_df[~result_df.index.isin(reattributed.index)]
+    output_file = write_period_results(reattributed.reset_index(drop=True), reporting_period, output_dir)
+    store_results(reattributed, pcs_with_refs)
+    logger.info(f"Re-attributed results: {output_file} ({reattributed['Load'].nunique()} loads)")
+    if not skipped.empty:
+        skipped_file = output_dir / f"not_reattributed_{reporting_period.label}.csv"
+        skipped[["Company", "Load", "Ref No", "Truck", "PU Date F", "Status"]].to_csv(skipped_file, index=False)
+        logger.warning(f"  • {skipped['Load'].nunique()} loads not re-attributed (route not in the archive, or rejected "
+                       f"pre-flight); their stored results are unchanged - listed in {skipped_file}")
+    return output_file
+
+def main(period: Optional[str] = None):
     """
     Main processing function - executes all phases following plan.md
     """
     logger.info("Starting IFTA PCS Trips Processing System...")
     
     try:
-        # Load API key
-        api_key = load_api_key()
-        logger.info("HERE API key loaded successfully")
+        api_key = _load_api_key_for_backend()
+        backend = make_routing_backend(ROUTING_BACKEND, api_key)
         
-        pcs, inv = step1_read_excel_data()
+        pcs, inv = step1_read_excel_data(period=parse_period(period or REPORTING_PERIOD))
         pcs_filtered = step2_filter_fleet_data(pcs, inv)
         pcs_with_refs = step3_detect_round_trips(pcs_filtered)
         
-        # Skip Step 4 - virtual returns not needed with proper Truck+Trailer logic
+        # Step 4 is off by default - virtual returns not needed with proper Truck+Trailer logic
+        if VIRTUAL_RETURNS:
+            pcs_with_refs = step4_add_virtual_returns(pcs_with_refs)
         
         # Load state boundaries and calculate mileage (async version for performance)
-        states_gdf = load_state_boundaries()
-        output_df = asyncio.run(step5_calculate_mileage_concurrent(pcs_with_refs, states_gdf, api_key, max_concurrent=10))
+        if STEP5_WORKERS > 1:
+            # Sharded across worker processes (each worker loads its own boundaries/backend)
+            output_df = step5_sharded(pcs_with_refs, n_workers=STEP5_WORKERS, max_concurrent=10, update_rollups=True)
+        else:
+            states_gdf = load_state_boundaries()
+            output_df = asyncio.run(step5_calculate_mileage_concurrent(pcs_with_refs, states_gdf, api_key, max_concurrent=10,
+                                                                       backend=backend, update_rollups=True))
+        store_results(output_df, pcs_with_refs)
         
         # excel_file, csv_file = step6_generate_output(output_df)
         
@@ -1507,13 +4226,49 @@ def main():
         raise
 
 if __name__ == "__main__":
-    import sys
+    configure_logging()
     
     # Check command line arguments
+    #   python prototype.py [PERIOD]            - single period (default REPORTING_PERIOD)
+    #   python prototype.py batch PERIOD...     - one run over every quarter in the given periods
+    #   python prototype.py workbooks DIR|GLOB [PERIOD] - every workbook, shared caches and HERE budget
+    #   python prototype.py worker QUEUE_FILE  - join a sharded Step 5 run (STEP5_WORKERS > 1) from any machine
+    #   python prototype.py build-raster [METERS]  - precompute the state raster (STATE_RASTER_DIR)
+    #   python prototype.py boundaries [METERS...] - simplified boundary levels + accuracy report (BOUNDARY_DIR)
+    #   python prototype.py reattribute [PERIOD]   - recompute state miles from the route archive (no HERE calls)
+    #   python prototype.py plan [PERIOD]          - dry run: expected HERE calls, cache hits and wall time
+    #   python prototype.py quota [MONTH]          - HERE requests per day and endpoint from the quota ledger
+    #   python prototype.py ifta [PERIOD]          - IFTA totals by state (and company/truck/month) from the rollups
+    #   python prototype.py query states|truck|errors ...  - questions over every stored run (results store)
+    #   python prototype.py startup [RUNS]         - cold-start benchmark of the module and the cache-only CLI
+    #   python prototype.py validate
     if len(sys.argv) > 1:
         if sys.argv[1] == "validate":
             asyncio.run(run_validation_test())
+        elif sys.argv[1] == "batch":
+            run_period_batch(sys.argv[2:] or [REPORTING_PERIOD])
+        elif sys.argv[1] == "workbooks" and len(sys.argv) > 2:
+            run_workbook_batch(sys.argv[2], *sys.argv[3:4])
+        elif sys.argv[1] == "worker" and len(sys.argv) > 2:
+            run_shard_worker(sys.argv[2])
+        elif sys.argv[1] == "reattribute":
+            run_reattribute(*sys.argv[2:3])
+        elif sys.argv[1] == "plan":
+            run_plan(*sys.argv[2:3])
+        elif sys.argv[1] == "quota":
+            report_here_quota(*sys.argv[2:3])
+        elif sys.argv[1] == "ifta":
+            write_ifta_totals(*sys.argv[2:3])
+        elif sys.argv[1] == "query" and len(sys.argv) > 2:
+            run_query(*sys.argv[2:])
+        elif sys.argv[1] == "startup":
+            benchmark_startup(int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+        elif sys.argv[1] == "boundaries":
+            build_boundary_levels([float(tolerance) for tolerance in sys.argv[2:]] or None)
+        elif sys.argv[1] == "build-raster":
+            resolution = float(sys.argv[2]) if len(sys.argv) > 2 else STATE_RASTER_RESOLUTION_M
+            build_state_raster(load_state_boundaries(), resolution)
         else:
-            main()
+            main(sys.argv[1])
     else:
         main() 
\ No newline at end of file
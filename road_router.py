@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Local road-graph router for Step 5 (no network, no HERE quota)
+
+Preprocess a road network once into a compact on-disk contraction hierarchy:
+    python road_router.py build <network file> [--speed-column SPEED] [--truck-restricted-column NO_TRUCKS]
+
+The network file is any line layer geopandas can read (GeoJSON, shapefile, GeoPackage),
+e.g. the FHWA National Highway Freight Network. Segments flagged in the truck-restriction
+column are dropped. Lines are split at state borders so every edge belongs to one state.
+
+Then run the pipeline with ROUTING_BACKEND=local (see prototype.LocalGraphRoutingBackend).
+"""
+
+import sys
+import json
+import heapq
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+BASE_DIR = Path(__file__).parent
+STATE_SHP = BASE_DIR / "cb_2024_us_state_500k.shp"
+DEFAULT_GRAPH_DIR = BASE_DIR / "road_graph"
+
+DEFAULT_SPEED_MPH = 55.0
+SNAP_DECIMALS = 5  # ~1 m: segment endpoints closer than this become the same node
+MAX_SNAP_METERS = 50_000  # Reject origins/destinations this far from the network
+WITNESS_SETTLE_LIMIT = 200  # Bound on local witness searches during contraction
+GRAPH_FORMAT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Build: road network file → contraction hierarchy on disk
+# ──────────────────────────────────────────────────────────────────────────────
+
+def _load_network_edges(network_file: Path, states_file: Path, speed_column: Optional[str],
+                        restriction_column: Optional[str], default_speed_mph: float):
+    """
+    Read road lines, drop truck-restricted segments, split at state borders.
+    Returns (node_lat, node_lon, edge_u, edge_v, edge_seconds, edge_meters, edge_state, state_codes)
+    """
+    import geopandas as gpd
+
+    lines = gpd.read_file(network_file)
+    logger.info(f"Read {len(lines)} road segments from {network_file}")
+
+    if restriction_column:
+        restricted = lines[restriction_column].fillna(0).astype(bool)
+        lines = lines[~restricted]
+        logger.info(f"Dropped {int(restricted.sum())} truck-restricted segments")
+
+    lines = lines.to_crs(epsg=4326)
+    if speed_column and speed_column in lines.columns:
+        speeds = _speeds_mph(lines[speed_column], default_speed_mph)
+    else:
+        speeds = np.full(len(lines), default_speed_mph)
+    lines = lines.assign(_speed_mph=speeds)[["_speed_mph", "geometry"]]
+
+    states = gpd.read_file(states_file)[["STUSPS", "geometry"]].to_crs(epsg=4326)
+    pieces = gpd.overlay(lines, states, how="intersection", keep_geom_type=True)
+    pieces = pieces.explode(index_parts=False).reset_index(drop=True)
+    pieces = pieces[pieces.geometry.geom_type == "LineString"]
+    logger.info(f"{len(pieces)} segments after splitting at state borders")
+
+    # Lengths in meters from an equal-area projection (same CRS as the state overlay in Step 5)
+    meters = pieces.geometry.to_crs(epsg=5070).length.to_numpy()
+
+    starts = np.array([g.coords[0][:2] for g in pieces.geometry])
+    ends = np.array([g.coords[-1][:2] for g in pieces.geometry])
+    endpoints = np.round(np.vstack([starts, ends]), SNAP_DECIMALS)
+    node_xy, inverse = np.unique(endpoints, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    edge_u = inverse[:len(pieces)]
+    edge_v = inverse[len(pieces):]
+
+    state_codes = sorted(pieces["STUSPS"].unique())
+    state_lookup = {code: i for i, code in enumerate(state_codes)}
+    edge_state = pieces["STUSPS"].map(state_lookup).to_numpy()
+
+    speed_ms = pieces["_speed_mph"].to_numpy() * 0.44704
+    edge_seconds = meters / np.maximum(speed_ms, 1.0)
+
+    keep = edge_u != edge_v  # Self loops never lie on a shortest path
+    return (node_xy[:, 1], node_xy[:, 0], edge_u[keep], edge_v[keep],
+            edge_seconds[keep], meters[keep], edge_state[keep], state_codes)
+
+def _speeds_mph(values, default: float) -> np.ndarray:
+    """Numeric speed column with missing/zero values replaced by the default speed"""
+    import pandas as pd
+
+    speeds = pd.to_numeric(values, errors="coerce").to_numpy(dtype=float, copy=True)
+    speeds[~np.isfinite(speeds) | (speeds <= 0)] = default
+    return speeds
+
+class _Contractor:
+    """Contraction hierarchy construction on an undirected graph (edge-difference ordering, lazy updates)"""
+
+    def __init__(self, num_nodes: int):
+        self.adj: List[Dict[int, Tuple[float, int]]] = [dict() for _ in range(num_nodes)]
+        # Edge table: originals have child_a == -1; shortcuts reference the two edges they replace
+        self.child_a: List[int] = []
+        self.child_b: List[int] = []
+        self.state: List[int] = []
+        self.meters: List[float] = []
+        self.contracted = [False] * num_nodes
+        self.depth = [0] * num_nodes
+        self.up: List[List[Tuple[int, float, int]]] = [[] for _ in range(num_nodes)]
+
+    def add_original(self, u: int, v: int, seconds: float, meters: float, state: int):
+        existing = self.adj[u].get(v)
+        if existing is not None and existing[0] <= seconds:
+            return
+        edge_id = len(self.child_a)
+        self.child_a.append(-1)
+        self.child_b.append(-1)
+        self.state.append(state)
+        self.meters.append(meters)
+        self.adj[u][v] = (seconds, edge_id)
+        self.adj[v][u] = (seconds, edge_id)
+
+    def _witness_costs(self, source: int, skip: int, limit: float) -> Dict[int, float]:
+        """Bounded Dijkstra from source that avoids the node being contracted"""
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        while heap and settled < WITNESS_SETTLE_LIMIT:
+            d, node = heapq.heappop(heap)
+            if d > dist.get(node, float("inf")):
+                continue
+            if d > limit:
+                break
+            settled += 1
+            for nbr, (w, _) in self.adj[node].items():
+                if nbr == skip or self.contracted[nbr]:
+                    continue
+                nd = d + w
+                if nd < dist.get(nbr, float("inf")):
+                    dist[nbr] = nd
+                    heapq.heappush(heap, (nd, nbr))
+        return dist
+
+    def _shortcuts_for(self, node: int) -> List[Tuple[int, int, float, int, int]]:
+        """Shortcuts (u, w, seconds, edge_uv, edge_vw) needed if `node` were contracted now"""
+        nbrs = [(n, w, e) for n, (w, e) in self.adj[node].items() if not self.contracted[n]]
+        shortcuts = []
+        for i, (u, w_u, e_u) in enumerate(nbrs):
+            targets = nbrs[i + 1:]
+            if not targets:
+                continue
+            limit = w_u + max(w for _, w, _ in targets)
+            witness = self._witness_costs(u, node, limit)
+            for w_node, w_w, e_w in targets:
+                via = w_u + w_w
+                if witness.get(w_node, float("inf")) > via:
+                    shortcuts.append((u, w_node, via, e_u, e_w))
+        return shortcuts
+
+    def _priority(self, node: int) -> int:
+        degree = sum(1 for n in self.adj[node] if not self.contracted[n])
+        return len(self._shortcuts_for(node)) - degree + self.depth[node]
+
+    def contract_all(self):
+        num_nodes = len(self.adj)
+        heap = [(self._priority(n), n) for n in range(num_nodes)]
+        heapq.heapify(heap)
+        order = 0
+        while heap:
+            _, node = heapq.heappop(heap)
+            if self.contracted[node]:
+                continue
+            # Lazy update: re-evaluate and push back if it is no longer the cheapest node
+            priority = self._priority(node)
+            if heap and priority > heap[0][0]:
+                heapq.heappush(heap, (priority, node))
+                continue
+
+            for u, w_node, seconds, e_u, e_w in self._shortcuts_for(node):
+                existing = self.adj[u].get(w_node)
+                if existing is not None and existing[0] <= seconds:
+                    continue
+                edge_id = len(self.child_a)
+                self.child_a.append(e_u)
+                self.child_b.append(e_w)
+                self.state.append(-1)
+                self.meters.append(self.meters[e_u] + self.meters[e_w])
+                self.adj[u][w_node] = (seconds, edge_id)
+                self.adj[w_node][u] = (seconds, edge_id)
+
+            for nbr, (w, e) in self.adj[node].items():
+                if not self.contracted[nbr]:
+                    self.up[node].append((nbr, w, e))
+                    self.depth[nbr] = max(self.depth[nbr], self.depth[node] + 1)
+            self.contracted[node] = True
+            order += 1
+            if order % 10000 == 0:
+                logger.info(f"Contracted {order}/{num_nodes} nodes ({len(self.child_a)} edges incl. shortcuts)")
+
+def contract_graph(num_nodes: int, edge_u: np.ndarray, edge_v: np.ndarray, edge_seconds: np.ndarray,
+                   edge_meters: np.ndarray, edge_state: np.ndarray) -> Dict[str, np.ndarray]:
+    """Contract an undirected graph and return the upward CSR graph plus the (shortcut) edge table"""
+    contractor = _Contractor(num_nodes)
+    for u, v, sec, m, st in zip(edge_u.tolist(), edge_v.tolist(), edge_seconds.tolist(),
+                                edge_meters.tolist(), edge_state.tolist()):
+        contractor.add_original(u, v, sec, m, st)
+    contractor.contract_all()
+
+    # Upward graph in CSR form: for node v, up edges are head[first_out[v]:first_out[v+1]]
+    first_out = np.zeros(num_nodes + 1, dtype=np.int64)
+    first_out[1:] = np.cumsum([len(edges) for edges in contractor.up])
+    head = np.fromiter((h for edges in contractor.up for h, _, _ in edges), dtype=np.int32, count=first_out[-1])
+    weight = np.fromiter((w for edges in contractor.up for _, w, _ in edges), dtype=np.float32, count=first_out[-1])
+    edge = np.fromiter((e for edges in contractor.up for _, _, e in edges), dtype=np.int32, count=first_out[-1])
+    return {
+        "first_out": first_out,
+        "head": head,
+        "weight": weight,
+        "edge": edge,
+        "edge_child_a": np.asarray(contractor.child_a, dtype=np.int32),
+        "edge_child_b": np.asarray(contractor.child_b, dtype=np.int32),
+        "edge_state": np.asarray(contractor.state, dtype=np.int16),
+        "edge_meters": np.asarray(contractor.meters, dtype=np.float32),
+    }
+
+def build_road_graph(network_file: Path, out_dir: Path = DEFAULT_GRAPH_DIR, states_file: Path = STATE_SHP,
+                     speed_column: Optional[str] = None, restriction_column: Optional[str] = None,
+                     default_speed_mph: float = DEFAULT_SPEED_MPH) -> Path:
+    """Preprocess a road network into a contraction hierarchy stored as memory-mappable .npy arrays"""
+    (node_lat, node_lon, edge_u, edge_v, edge_seconds, edge_meters,
+     edge_state, state_codes) = _load_network_edges(Path(network_file), Path(states_file), speed_column,
+                                                   restriction_column, default_speed_mph)
+    num_nodes = len(node_lat)
+    logger.info(f"Building contraction hierarchy: {num_nodes} nodes, {len(edge_u)} edges")
+
+    arrays = contract_graph(num_nodes, edge_u, edge_v, edge_seconds, edge_meters, edge_state)
+    arrays["node_lat"] = np.asarray(node_lat, dtype=np.float32)
+    arrays["node_lon"] = np.asarray(node_lon, dtype=np.float32)
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(out_dir / f"{name}.npy", array)
+    meta = {
+        "version": GRAPH_FORMAT_VERSION,
+        "source": str(network_file),
+        "states": state_codes,
+        "num_nodes": num_nodes,
+        "num_edges": len(arrays["edge_child_a"]),
+        "speed_column": speed_column,
+        "truck_restricted_column": restriction_column,
+    }
+    with open(out_dir / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+    logger.info(f"Road graph written to {out_dir} ({meta['num_edges']} edges incl. shortcuts)")
+    return out_dir
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Query: bidirectional upward Dijkstra + shortcut unpacking
+# ──────────────────────────────────────────────────────────────────────────────
+
+class RoadGraph:
+    """Memory-mapped contraction hierarchy; safe to share between processes (read-only)"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray], meta: dict):
+        self.meta = meta
+        self.states = meta["states"]
+        self.node_lat = arrays["node_lat"]
+        self.node_lon = arrays["node_lon"]
+        self.first_out = arrays["first_out"]
+        self.head = arrays["head"]
+        self.weight = arrays["weight"]
+        self.edge = arrays["edge"]
+        self.edge_child_a = arrays["edge_child_a"]
+        self.edge_child_b = arrays["edge_child_b"]
+        self.edge_state = arrays["edge_state"]
+        self.edge_meters = arrays["edge_meters"]
+        self._snap_cache: Dict[Tuple[float, float], Optional[int]] = {}
+
+    @property
+    def num_nodes(self) -> int:
+        return int(self.meta["num_nodes"])
+
+    @property
+    def num_edges(self) -> int:
+        return int(self.meta["num_edges"])
+
+    @classmethod
+    def load(cls, graph_dir: Path = DEFAULT_GRAPH_DIR) -> "RoadGraph":
+        graph_dir = Path(graph_dir)
+        meta_file = graph_dir / "meta.json"
+        if not meta_file.exists():
+            raise FileNotFoundError(f"Road graph not found: {graph_dir} (run `python road_router.py build` first)")
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("version") != GRAPH_FORMAT_VERSION:
+            raise RuntimeError(f"Road graph {graph_dir} has format {meta.get('version')}, expected {GRAPH_FORMAT_VERSION}")
+        names = ["node_lat", "node_lon", "first_out", "head", "weight", "edge",
+                 "edge_child_a", "edge_child_b", "edge_state", "edge_meters"]
+        arrays = {name: np.load(graph_dir / f"{name}.npy", mmap_mode="r") for name in names}
+        return cls(arrays, meta)
+
+    def snap(self, lat: float, lng: float) -> Optional[int]:
+        """Nearest graph node (equirectangular distance), None if farther than MAX_SNAP_METERS"""
+        key = (round(lat, 5), round(lng, 5))
+        if key in self._snap_cache:
+            return self._snap_cache[key]
+        dlat = self.node_lat - np.float32(lat)
+        dlon = (self.node_lon - np.float32(lng)) * np.float32(np.cos(np.radians(lat)))
+        dist2 = dlat * dlat + dlon * dlon
+        node = int(np.argmin(dist2))
+        meters = float(np.sqrt(dist2[node])) * 111_320.0
+        result = node if meters <= MAX_SNAP_METERS else None
+        self._snap_cache[key] = result
+        return result
+
+    def _upward_search(self, dist: Dict[int, float], parent: Dict[int, Tuple[int, int]],
+                       heap: list) -> Optional[Tuple[float, int]]:
+        """Settle one node of an upward search; returns (distance, node) or None when exhausted"""
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            start, end = int(self.first_out[node]), int(self.first_out[node + 1])
+            heads = self.head[start:end].tolist()
+            weights = self.weight[start:end].tolist()
+            edges = self.edge[start:end].tolist()
+            for nbr, w, e in zip(heads, weights, edges):
+                nd = d + w
+                if nd < dist.get(nbr, float("inf")):
+                    dist[nbr] = nd
+                    parent[nbr] = (node, e)
+                    heapq.heappush(heap, (nd, nbr))
+            return d, node
+        return None
+
+    def shortest_path_edges(self, source: int, target: int) -> Optional[List[int]]:
+        """Original (unpacked) edge ids of the fastest path, None if unreachable"""
+        if source == target:
+            return []
+        dist_f, dist_b = {source: 0.0}, {target: 0.0}
+        parent_f: Dict[int, Tuple[int, int]] = {}
+        parent_b: Dict[int, Tuple[int, int]] = {}
+        heap_f, heap_b = [(0.0, source)], [(0.0, target)]
+        best, meeting = float("inf"), None
+
+        while heap_f or heap_b:
+            min_f = heap_f[0][0] if heap_f else float("inf")
+            min_b = heap_b[0][0] if heap_b else float("inf")
+            if min(min_f, min_b) >= best:
+                break
+            if min_f <= min_b:
+                settled = self._upward_search(dist_f, parent_f, heap_f)
+                other = dist_b
+            else:
+                settled = self._upward_search(dist_b, parent_b, heap_b)
+                other = dist_f
+            if settled is None:
+                continue
+            d, node = settled
+            if node in other and d + other[node] < best:
+                best, meeting = d + other[node], node
+
+        if meeting is None:
+            return None
+
+        path: List[int] = []
+        node = meeting
+        while node != source:
+            node, e = parent_f[node]
+            path.append(e)
+        path.reverse()
+        node = meeting
+        while node != target:
+            node, e = parent_b[node]
+            path.append(e)
+        return self._unpack(path)
+
+    def _unpack(self, edges: List[int]) -> List[int]:
+        originals = []
+        stack = list(reversed(edges))
+        while stack:
+            e = stack.pop()
+            a = int(self.edge_child_a[e])
+            if a < 0:
+                originals.append(e)
+            else:
+                stack.append(int(self.edge_child_b[e]))
+                stack.append(a)
+        return originals
+
+    def route_state_meters(self, origin_coords: tuple, dest_coords: tuple) -> Dict[str, float]:
+        """Meters driven per state between two (lat, lng) points; {} if no route"""
+        source = self.snap(float(origin_coords[0]), float(origin_coords[1]))
+        target = self.snap(float(dest_coords[0]), float(dest_coords[1]))
+        if source is None or target is None:
+            return {}
+        path = self.shortest_path_edges(source, target)
+        if not path:
+            return {}
+        idx = np.asarray(path, dtype=np.int64)
+        totals = np.bincount(self.edge_state[idx], weights=self.edge_meters[idx], minlength=len(self.states))
+        return {self.states[i]: float(m) for i, m in enumerate(totals) if m > 0}
+
+# ──────────────────────────────────────────────────────────────────────────────
+# CLI
+# ──────────────────────────────────────────────────────────────────────────────
+
+def main(argv: List[str]):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the local road graph used by ROUTING_BACKEND=local")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Preprocess a road network file into a contraction hierarchy")
+    build.add_argument("network_file", type=Path)
+    build.add_argument("--out", type=Path, default=DEFAULT_GRAPH_DIR)
+    build.add_argument("--states", type=Path, default=STATE_SHP)
+    build.add_argument("--speed-column", help="Column with segment speed in mph")
+    build.add_argument("--truck-restricted-column", help="Truthy column marking segments closed to trucks")
+    build.add_argument("--default-speed", type=float, default=DEFAULT_SPEED_MPH)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        build_road_graph(args.network_file, args.out, args.states, args.speed_column,
+                         args.truck_restricted_column, args.default_speed)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main(sys.argv[1:])
@@ -0,0 +1,64 @@
+"""decode_flexpolyline_np against the HERE flexible polyline specification"""
+
+import numpy as np
+import pytest
+
+from prototype import decode_flexpolyline_np
+
+ENCODING_TABLE = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+# Examples from the specification (github.com/heremaps/flexible-polyline), (lat, lng) at precision 5
+SPEC_COORDS = [(50.10228, 8.69821), (50.10201, 8.69567), (50.10063, 8.69150), (50.09878, 8.68752)]
+SPEC_2D = "BFoz5xJ67i1B1B7PzIhaxL7Y"
+SPEC_3D = "BlBoz5xJ67i1BU1B7PUzIhaUxL7YU"  # Same points with an altitude of 10 on each
+
+
+def encode_unsigned(value: int) -> str:
+    chars = []
+    while value > 0x1F:
+        chars.append(ENCODING_TABLE[(value & 0x1F) | 0x20])
+        value >>= 5
+    chars.append(ENCODING_TABLE[value])
+    return "".join(chars)
+
+
+def encode_signed(value: int) -> str:
+    return encode_unsigned(~(value << 1) if value < 0 else value << 1)
+
+
+def encode(coords, precision: int) -> str:
+    """Reference 2D encoder following the specification"""
+    out = [encode_unsigned(1), encode_unsigned(precision)]
+    last_lat = last_lng = 0
+    for lat, lng in coords:
+        lat_i, lng_i = round(lat * 10 ** precision), round(lng * 10 ** precision)
+        out += [encode_signed(lat_i - last_lat), encode_signed(lng_i - last_lng)]
+        last_lat, last_lng = lat_i, lng_i
+    return "".join(out)
+
+
+@pytest.mark.parametrize("encoded", [SPEC_2D, SPEC_3D])
+def test_spec_examples(encoded):
+    coords = decode_flexpolyline_np(encoded)
+    expected = np.array([(lng, lat) for lat, lng in SPEC_COORDS])
+    assert coords.shape == (4, 2) and coords.flags["C_CONTIGUOUS"]
+    np.testing.assert_allclose(coords, expected, atol=1e-9)
+
+
+def test_reference_encoder_reproduces_spec():
+    assert encode(SPEC_COORDS, 5) == SPEC_2D
+
+
+@pytest.mark.parametrize("precision", [0, 5, 7])
+def test_round_trip_negative_and_large_deltas(precision):
+    rng = np.random.default_rng(precision)
+    coords = np.column_stack((rng.uniform(-89, 89, 50), rng.uniform(-179, 179, 50))).round(precision)
+    decoded = decode_flexpolyline_np(encode(coords.tolist(), precision))
+    np.testing.assert_allclose(decoded, coords[:, ::-1], atol=10 ** -precision / 2)
+
+
+@pytest.mark.parametrize("encoded", ["", "BF!", "CFoz5xJ67i1B", "BFoz5xJ67i1", "BFoz5xJ"])
+def test_invalid_input_raises(encoded):
+    # Empty, bad character, unsupported version, truncated varint, odd number of values
+    with pytest.raises(ValueError):
+        decode_flexpolyline_np(encoded)
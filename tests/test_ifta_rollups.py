@@ -0,0 +1,67 @@
+"""IftaRollups: ingesting Step 5 rows, replacing reprocessed loads, reading totals"""
+
+import pandas as pd
+import pytest
+
+from prototype import IftaRollups, parse_period
+
+
+def step5_rows(rows) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=["Company", "Load", "Truck", "State", "PU Date F", "Miles", "Status"]).astype(
+        {"PU Date F": "datetime64[ns]"})
+
+
+@pytest.fixture
+def rollups(tmp_path):
+    store = IftaRollups(tmp_path / "rollups.sqlite")
+    yield store
+    store.conn.close()
+
+
+def state_miles(rollups, period=None) -> dict:
+    totals = rollups.totals(parse_period(period) if period else None)
+    return dict(zip(totals["State"], totals["Miles"]))
+
+
+def test_ingest_sums_routed_rows_only(rollups):
+    rollups.ingest(step5_rows([
+        ("ACME", "1", "T1", "CA", "2025-04-03", 100.0, "OK"),
+        ("ACME", "1", "T1", "AZ", "2025-04-03", 50.0, "OK"),
+        ("ACME", "2", "T2", "AZ", "2025-05-10", 25.0, "ESTIMATED"),
+        ("ACME", "3", "T2", "ERROR", "2025-05-11", 0.0, "GEOCODE_ERR"),
+    ]))
+
+    assert state_miles(rollups) == {"AZ": 75.0, "CA": 100.0}
+    by_state = rollups.totals(by=["state"]).set_index("State")
+    assert by_state.loc["AZ", "Estimated Miles"] == 25.0
+    assert by_state.loc["CA", "Estimated Miles"] == 0.0
+
+
+def test_reingested_load_replaces_its_miles(rollups):
+    rollups.ingest(step5_rows([
+        ("ACME", "1", "T1", "CA", "2025-04-03", 100.0, "OK"),
+        ("ACME", "1", "T1", "AZ", "2025-04-03", 50.0, "OK"),
+        ("ACME", "2", "T2", "NV", "2025-04-05", 10.0, "OK"),
+    ]))
+    # Rerun of load 1: the route no longer touches AZ
+    rollups.ingest(step5_rows([("ACME", "1", "T1", "CA", "2025-04-03", 120.0, "OK")]))
+
+    assert state_miles(rollups) == {"CA": 120.0, "NV": 10.0}
+    cells = rollups.conn.execute("SELECT state, loads FROM rollup ORDER BY state").fetchall()
+    assert cells == [("CA", 1), ("NV", 1)]
+
+
+def test_totals_filter_by_period_and_dimension(rollups):
+    rollups.ingest(step5_rows([
+        ("ACME", "1", "T1", "CA", "2025-03-31", 10.0, "OK"),
+        ("ACME", "2", "T1", "CA", "2025-04-01", 20.0, "OK"),
+        ("BETA", "3", "T9", "CA", "2025-06-30", 30.0, "OK"),
+        ("BETA", "4", "T9", "CA", "2025-07-01", 40.0, "OK"),
+    ]))
+
+    assert state_miles(rollups, "2025Q2") == {"CA": 50.0}
+    by_company = rollups.totals(parse_period("2025Q2"), by=["company", "month"])
+    assert by_company[["Company", "Month", "Miles"]].values.tolist() == [["ACME", "2025-04", 20.0],
+                                                                        ["BETA", "2025-06", 30.0]]
+    with pytest.raises(ValueError):
+        rollups.totals(by=["driver"])
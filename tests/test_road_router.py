@@ -0,0 +1,95 @@
+"""Contraction hierarchy queries must match plain Dijkstra on the original graph"""
+
+import heapq
+import random
+
+import numpy as np
+import pytest
+
+from road_router import GRAPH_FORMAT_VERSION, RoadGraph, contract_graph
+
+
+def random_graph(num_nodes: int, extra_edges: int, seed: int):
+    """Connected undirected graph: a random spanning tree plus extra edges (integer seconds)"""
+    rng = random.Random(seed)
+    edges = [(rng.randrange(node), node, rng.randint(1, 30)) for node in range(1, num_nodes)]
+    edges += [(rng.randrange(num_nodes), rng.randrange(num_nodes), rng.randint(1, 30)) for _ in range(extra_edges)]
+    return [(u, v, seconds) for u, v, seconds in edges if u != v]
+
+
+def dijkstra(num_nodes: int, edges, source: int) -> list:
+    adj = [[] for _ in range(num_nodes)]
+    for u, v, seconds in edges:
+        adj[u].append((v, seconds))
+        adj[v].append((u, seconds))
+    dist = [float("inf")] * num_nodes
+    dist[source] = 0
+    heap = [(0, source)]
+    while heap:
+        d, node = heapq.heappop(heap)
+        if d > dist[node]:
+            continue
+        for nbr, seconds in adj[node]:
+            if d + seconds < dist[nbr]:
+                dist[nbr] = d + seconds
+                heapq.heappush(heap, (d + seconds, nbr))
+    return dist
+
+
+def road_graph(num_nodes: int, edges, edge_state=None) -> RoadGraph:
+    u, v, seconds = (np.array(column) for column in zip(*edges))
+    # Meters equal to seconds, so an unpacked path's meters add up to its travel time
+    arrays = contract_graph(num_nodes, u, v, seconds.astype(float), seconds.astype(float),
+                            np.zeros(len(edges), dtype=np.int16) if edge_state is None else np.asarray(edge_state))
+    arrays["node_lat"] = np.zeros(num_nodes, dtype=np.float32)
+    arrays["node_lon"] = np.arange(num_nodes, dtype=np.float32) * 0.01
+    meta = {"version": GRAPH_FORMAT_VERSION, "states": ["AA", "BB"], "num_nodes": num_nodes,
+            "num_edges": len(arrays["edge_child_a"])}
+    return RoadGraph(arrays, meta)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_ch_matches_dijkstra(seed):
+    num_nodes = 60
+    edges = random_graph(num_nodes, extra_edges=90, seed=seed)
+    graph = road_graph(num_nodes, edges)
+
+    for source in range(0, num_nodes, 7):
+        expected = dijkstra(num_nodes, edges, source)
+        for target in range(num_nodes):
+            path = graph.shortest_path_edges(source, target)
+            assert path is not None
+            assert all(graph.edge_child_a[e] < 0 for e in path)  # Shortcuts fully unpacked
+            assert float(graph.edge_meters[path].sum()) == pytest.approx(expected[target])
+
+
+def test_unpacked_path_is_connected():
+    num_nodes = 40
+    # Without parallel edges, original edge ids are the input positions
+    unique = {}
+    for u, v, seconds in random_graph(num_nodes, extra_edges=60, seed=3):
+        unique.setdefault(frozenset((u, v)), (u, v, seconds))
+    edges = list(unique.values())
+    graph = road_graph(num_nodes, edges)
+
+    path = graph.shortest_path_edges(0, num_nodes - 1)
+    node = 0
+    for e in path:
+        u, v, _ = edges[e]
+        assert node in (u, v)
+        node = v if node == u else u
+    assert node == num_nodes - 1
+
+
+def test_unreachable_and_same_node():
+    edges = [(0, 1, 5), (2, 3, 5)]
+    graph = road_graph(4, edges)
+    assert graph.shortest_path_edges(0, 3) is None
+    assert graph.shortest_path_edges(2, 2) == []
+
+
+def test_route_state_meters_splits_by_edge_state():
+    # 0 -(AA, 10)- 1 -(BB, 20)- 2, plus a slower direct edge 0-2
+    edges = [(0, 1, 10), (1, 2, 20), (0, 2, 50)]
+    graph = road_graph(3, edges, edge_state=[0, 1, 0])
+    assert graph.route_state_meters((0.0, 0.0), (0.0, 0.02)) == {"AA": 10.0, "BB": 20.0}
@@ -0,0 +1,69 @@
+"""step4_add_virtual_returns on a hand-built load table"""
+
+import pandas as pd
+
+from prototype import VIRTUAL_RETURN_CITY, step4_add_virtual_returns
+
+COLUMNS = ["Load", "Trip", "Truck", "Trailer", "Ship City", "Ship St", "Cons City", "Cons St",
+           "PU", "DEL", "Company", "Ref", "Inv No"]
+
+
+def loads() -> pd.DataFrame:
+    rows = [
+        # Ends in AZ, truck never returns to CA → virtual return
+        (101, "T1", "X1", "LOS ANGELES", "CA", "PHOENIX", "AZ", "2025-05-01", "2025-05-02", "1"),
+        # Group delivers to CA itself → nothing added
+        (201, "T2", "X2", "LOS ANGELES", "CA", "LAS VEGAS", "NV", "2025-05-01", "2025-05-02", "2"),
+        (202, "T2", "X2", "LAS VEGAS", "NV", "FONTANA", "CA", "2025-05-03", "2025-05-04", "2.2"),
+        # Same truck+trailer picks up a CA delivery 3 days later (within the window) → nothing added
+        (301, "T3", "X3", "LOS ANGELES", "CA", "TUCSON", "AZ", "2025-05-01", "2025-05-02", "3"),
+        (401, "T3", "X3", "TUCSON", "AZ", "ONTARIO", "CA", "2025-05-05", "2025-05-06", "4"),
+        # Next CA delivery 18 days later (outside the window) → virtual return
+        (501, "T5", "X5", "LOS ANGELES", "CA", "RENO", "NV", "2025-05-01", "2025-05-02", "5"),
+        (601, "T5", "X5", "RENO", "NV", "FRESNO", "CA", "2025-05-20", "2025-05-21", "6"),
+        # CA delivery the next day, but with another trailer → virtual return
+        (701, "T6", "X6", "LOS ANGELES", "CA", "PHOENIX", "AZ", "2025-05-01", "2025-05-02", "7"),
+        (801, "T6", "X7", "PHOENIX", "AZ", "LOS ANGELES", "CA", "2025-05-03", "2025-05-04", "8"),
+    ]
+    frame = pd.DataFrame([
+        {"Load": load, "Trip": f"TR{load}", "Truck": truck, "Trailer": trailer, "Ship City": ship_city,
+         "Ship St": ship_st, "Cons City": cons_city, "Cons St": cons_st, "PU": pd.Timestamp(pu),
+         "DEL": pd.Timestamp(delivered), "Company": "ACME", "Ref": ref, "Inv No": f"INV{load}"}
+        for load, truck, trailer, ship_city, ship_st, cons_city, cons_st, pu, delivered, ref in rows
+    ])
+    return frame[COLUMNS]
+
+
+def test_virtual_returns_inserted_after_their_ref_group():
+    result = step4_add_virtual_returns(loads())
+
+    assert result["Load"].astype(str).tolist() == [
+        "101", "VIRTUAL_101", "201", "202", "301", "401", "501", "VIRTUAL_501", "601", "701", "VIRTUAL_701", "801",
+    ]
+    assert list(result.columns) == COLUMNS
+
+
+def test_virtual_leg_fields():
+    result = step4_add_virtual_returns(loads())
+    leg = result[result["Load"] == "VIRTUAL_101"].iloc[0]
+
+    assert (leg["Trip"], leg["Truck"], leg["Trailer"], leg["Company"]) == ("TR101", "T1", "X1", "ACME")
+    assert (leg["Ship City"], leg["Ship St"]) == ("PHOENIX", "AZ")
+    assert (leg["Cons City"], leg["Cons St"]) == (VIRTUAL_RETURN_CITY, "CA")
+    assert leg["PU"] == pd.Timestamp("2025-05-02")
+    assert leg["DEL"] == pd.Timestamp("2025-05-03")
+    assert leg["Ref"] == "1.2"
+    assert pd.isna(leg["Inv No"])
+
+
+def test_original_rows_unchanged():
+    original = loads()
+    result = step4_add_virtual_returns(original)
+    kept = result[~result["Load"].astype(str).str.startswith("VIRTUAL_")].reset_index(drop=True)
+    pd.testing.assert_frame_equal(kept.astype({"Load": int}), original, check_dtype=False)
+
+
+def test_no_candidates_returns_same_rows():
+    original = loads().iloc[[1, 2, 3, 4]].reset_index(drop=True)
+    result = step4_add_virtual_returns(original)
+    pd.testing.assert_frame_equal(result, original, check_dtype=False)